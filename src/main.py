@@ -1,3 +1,38 @@
+import math as m
+import random as rd
+import sys
+import os
+import re
+import time
+import json
+import hashlib
+import shutil
+import glob
+import array
+import argparse
+import struct
+import threading
+import multiprocessing
+import socket
+import bisect
+import zlib
+import itertools
+import heapq
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+try:
+    import numpy as np
+except ImportError:
+    np = None # numpy is optional, without it the solver runs on the pure python backend
+try:
+    import maya.cmds as cmds
+    import maya.OpenMaya as om
+except ImportError:
+    cmds, om = None, None # the particle cache tools do not need maya, so they can also run on machines without it
+# the modules are imported at the top of the script so that worker processes which import this script also have them
+
 
 def createUI():
     '''
@@ -36,36 +71,38 @@ def createUI():
         The subsequent tabs will inform users of different instructions to best use the simulation, such as appropriate
         physical parameter values and steps to create an effective simulation.       
         
+        Only the Main tab is built when the window opens, every other tab is built the first time it is selected, and
+        closing the window hides it so that opening the tool again shows it as it was left.
     '''
     if cmds.window('Coffee_Simulation', exists=True):
-        cmds.deleteUI('Coffee_Simulation')
+        cmds.showWindow('Coffee_Simulation') # the window was only hidden when it was closed, so it is shown again as it was left
+        return
         
-    winID = cmds.window('Coffee_Simulation', widthHeight=(500,430),resizeToFitChildren=True, sizeable=False) #creates the general window   
-
-    newDirectory = queryDirectory() # queries the directory from the user when they start the program
+    winID = cmds.window('Coffee_Simulation', widthHeight=(500,430),resizeToFitChildren=True, sizeable=False, retain=True) #creates the general window   
 
     widgets = {} # creates a local dictionary to store values to pass into separate functions at a later stage
+    widgets['Directory'] = findProjectDirectory() # the project directory is kept so that simulations can write their particle cache inside it
     
     tabs = cmds.tabLayout()
-    tab1 = cmds.columnLayout(w=500,h=430,parent=tabs)
-    tab2 = cmds.columnLayout(w=500,h=430,parent=tabs)
-    tab3 = cmds.columnLayout(w=500,h=430,parent=tabs)
-    tab4 = cmds.columnLayout(w=500,h=430,parent=tabs)
-    tab5 = cmds.columnLayout(w=500,h=430,parent=tabs)
-    tab6 = cmds.columnLayout(w=500,h=430,parent=tabs)
-    tab7 = cmds.columnLayout(w=500,h=430,parent=tabs)
-    
-    # creation of different tab layouts 
+    scrolls = [cmds.scrollLayout(w=500,h=400,childResizable=True,parent=tabs) for label, builder in UI_TABS]
+    pages = [cmds.columnLayout(parent=scroll) for scroll in scrolls]
+    # every tab scrolls, so the settings and buttons below the fixed size of the window can still be reached
+    cmds.tabLayout(tabs,edit=True, tabLabel=[(scroll, label) for scroll, (label, builder) in zip(scrolls, UI_TABS)],
+                   selectCommand=lambda *pArgs: requireTabs(widgets, [UI_TABS[cmds.tabLayout(tabs, q=True, selectTabIndex=True)-1][0]]))
+    widgets['Tabs'] = {'window': winID, 'pages': pages, 'built': set()}
+    # creation of different tab layouts, which are filled in when they are first selected
     
-    cmds.tabLayout(tabs,edit=True,
-                    tabLabel=[(tab1,'Main'),(tab2,'General'),(tab3,'Orientation'),
-                    (tab4,'Coffee'),(tab5,'Instructions'),(tab6,'Sim Instructions'),(tab7,'Coffee Instructions')])    
-    cmds.setParent(tab1)
-    
-    ######################### TAB 1 #########################
+    requireTabs(widgets, ['Main'])
+    cmds.showWindow(winID)
     
+def createMainTab(widgets):
+    '''
+        builds the Main tab, holding the physical parameters of the liquid, the liquid presets and the Simulate button
+        widgets:    dictionary containing values of all controls within the UI
+    '''
+    newDirectory = widgets['Directory']
     child1 = cmds.frameLayout(borderVisible=True, labelVisible=False, w=500,h=180)
-    img = cmds.image(image=newDirectory + "artefacts//images//coffee_design_5.png", w=250, h=180) #loads the general image of the coffee machine
+    img = cmds.image(image=findImage(newDirectory, 'coffee_design_5.png', 250, 180), w=250, h=180) #loads the general image of the coffee machine
     
     cmds.setParent('..')    
     
@@ -84,7 +121,11 @@ def createUI():
     title2 = cmds.columnLayout(columnAttach = ('left',-85))
     widgets[density] = cmds.floatSliderGrp(label=density,minValue=0,maxValue=1500,value=998.2,field=True,precision=2, w=580)
     widgets[mass] = cmds.floatSliderGrp(label=mass,minValue=0,maxValue=10,value=0.1,field=True, step= 0.01, precision=3, w=580 )
-    widgets[viscosity] = cmds.floatSliderGrp(label=viscosity,minValue=0,maxValue=10,value=3.5,field=True, w=580 )
+    widgets[viscosity] = cmds.floatSliderGrp(label=viscosity,minValue=0,maxValue=10,fieldMaxValue=10000,value=3.5,field=True, w=580 )
+    widgets['Viscosity Solver'] = cmds.optionMenu(label='Viscosity Solver', w=300)
+    for solver in VISCOSITY_SOLVERS:
+        cmds.menuItem(label=solver)
+    # solves the viscosity implicitly so thick liquids like coffee stay stable at the same time step as water, Auto does so from a viscosity of IMPLICIT_VISCOSITY
     widgets[stiffness] = cmds.floatSliderGrp(label=stiffness,minValue=0,maxValue=10,value=3.0,field=True, w=580 )
     widgets[surfaceTraction] = cmds.floatSliderGrp(label=surfaceTraction,minValue=0,maxValue=0.5,value=0.0728,field=True,step=0.01,precision=4, w=580 )
     widgets[buoyancy] =  cmds.floatSliderGrp(label=buoyancy,minValue=0,maxValue=100,value=0,field=True, w=580 )
@@ -99,27 +140,44 @@ def createUI():
     child5 = cmds.rowLayout(numberOfColumns=3,columnWidth3=[160,160,160])
     button2 = cmds.button(label='Reset', command =  lambda *pArgs: resetProc1(widgets), w=165)
     button3 = cmds.button(label='Simulate', command = lambda *pArgs:startSimulation(widgets), w=165)
-    button4 = cmds.button(label='Cancel',command= lambda *pArgs: cancelProc(winID),w=160)
-    
-    cmds.setParent(tab2)
-    
-    ######################### TAB 2 #########################
+    button4 = cmds.button(label='Cancel',command= lambda *pArgs: cancelProc(widgets['Tabs']['window']),w=160)
     
+def createGeneralTab(widgets):
+    '''
+        builds the General tab, holding the particle, spawning, animation and solver settings
+        widgets:    dictionary containing values of all controls within the UI
+    '''
+    newDirectory = widgets['Directory']
     numberOfS, radius, clusterRadius, spawnRadius, tankSize, particleColour = 'No. of Particles', 'Particle Radius', 'Cluster Radius', 'Spawn Radius', 'Tank Size', 'Particle Colour'
     child6 = cmds.frameLayout('Particle Properties',w=500)
     title3 = cmds.columnLayout(columnAttach = ('left',-50))
     widgets[numberOfS] = cmds.intSliderGrp(label=numberOfS,minValue=100,maxValue=10000,value=1000,field=True,w=540)
     widgets[radius] = cmds.floatSliderGrp(label=radius,minValue=0,maxValue=1,value=0.08,field=True,step=0.1,precision=4,w=540)
     widgets[clusterRadius] = cmds.floatSliderGrp(label=clusterRadius,minValue=0,maxValue=2,value=0.35,field=True,precision=2,w=540)
+    widgets['Auto Cluster Radius'] = cmds.checkBox(label='Auto Cluster Radius', value=False) # chooses the cluster radius from the particle spacing instead of the slider
+    widgets['Target Neighbours'] = cmds.intSliderGrp(label='Target Neighbours',minValue=10,maxValue=200,value=40,field=True,w=540)
+    widgets['Max Neighbours'] = cmds.intSliderGrp(label='Max Neighbours',minValue=0,maxValue=200,value=0,field=True,w=540)
+    # keeps only the nearest neighbours of particles in dense clumps so no particle costs more than the rest, 0 keeps every neighbour
+    widgets['Adapt Interval'] = cmds.intSliderGrp(label='Adapt Interval',minValue=0,maxValue=50,value=0,field=True,w=540)
+    # number of frames between choosing the cluster radius again as the fluid packs or spreads, 0 keeps the radius chosen on the first frame
+    widgets['Adaptive Resolution'] = cmds.checkBox(label='Adaptive Resolution', value=False)
+    widgets['Resolution Levels'] = cmds.intSliderGrp(label='Resolution Levels',minValue=1,maxValue=4,value=2,field=True,w=540)
+    widgets['Split Reserve'] = cmds.intSliderGrp(label='Split Reserve',minValue=0,maxValue=10000,value=1000,field=True,w=540)
+    # splits particles at the surface or in swirling fluid up to Resolution Levels times and merges them again inside calm fluid, taking hidden reserve particles
     widgets[spawnRadius] = cmds.floatSliderGrp(label=spawnRadius,minValue=0.5,maxValue=10,value=1.5,field=True,w=540)
+    widgets['Random Seed'] = cmds.intSliderGrp(label='Random Seed',minValue=0,maxValue=1000,value=0,field=True,w=540) # seeds random distributions, so the same settings always spawn the same particles
+    widgets['Poisson Disk'] = cmds.checkBox(label='Poisson Disk Spacing', value=False) # the random distribution keeps particles at least the spawn spacing apart
+    widgets['Spawn Spacing'] = cmds.floatSliderGrp(label='Spawn Spacing',minValue=0,maxValue=1,value=0,field=True,precision=3,w=540)
+    widgets['Relax Steps'] = cmds.intSliderGrp(label='Relax Steps',minValue=0,maxValue=100,value=0,field=True,w=540)
+    # a spawn spacing of 0 fits the number of particles into the spawn volume. Relax steps even out the density of the spawned particles before the first frame
     widgets[particleColour] = cmds.colorSliderGrp(label=particleColour,rgb=(0,0,1),w=540)
     # controls over the general aesthetic of the particles and their size.
     
     cmds.setParent('..')
 
     title5 = cmds.rowColumnLayout(numberOfColumns=2,columnAttach = (1,'both',10))
-    cmds.image(image=newDirectory + "artefacts//images//uniform",h=70, w=240)
-    cmds.image(image=newDirectory + "artefacts//images//particleRandom.png",h=70, w=230)
+    cmds.image(image=findImage(newDirectory, 'uniform', 240, 70),h=70, w=240)
+    cmds.image(image=findImage(newDirectory, 'particleRandom.png', 230, 70),h=70, w=230)
     
     #choosing whether to spawn the particles in a uniform or random distribution intially
     cmds.setParent('..')
@@ -156,27 +214,71 @@ def createUI():
     numberOfF, timeDelta = 'No. of Frames', 'Time Difference'
     widgets[numberOfF] = cmds.intSliderGrp(label=numberOfF, minValue=0,maxValue=200,value=100,field=True, width=540)
     widgets[timeDelta] = cmds.floatSliderGrp(label=timeDelta, minValue=0.0,maxValue=1.0,value=0.01,field=True, step=0.01, precision=4, width=540)
+    widgets['Reorder Interval'] = cmds.intSliderGrp(label='Reorder Interval', minValue=0,maxValue=50,value=10,field=True, width=540)
+    # number of frames between sorting particles so that spatial neighbours sit close together in memory, 0 keeps the spawn order
+    widgets['Frames Per Step'] = cmds.intSliderGrp(label='Frames Per Step', minValue=1,maxValue=8,value=1,field=True, width=540)
+    widgets['Interpolation Tolerance'] = cmds.floatSliderGrp(label='Interpolation Tolerance', minValue=0.0,maxValue=0.1,value=0.01,field=True, precision=4, width=540)
+    # solves one step every few frames and interpolates the frames in between, solving every frame where the interpolation would be out by more than the tolerance
+    widgets['Divergence Action'] = cmds.optionMenu(label='Divergence Action', w=300)
+    for action in HEALTH_ACTIONS:
+        cmds.menuItem(label=action)
+    # a step where particles move too far, pile up, stop being numbers or gain energy is solved again in smaller substeps, or the simulation stops
+    widgets['Resimulate From'] = cmds.intSliderGrp(label='Re-simulate From', minValue=2,maxValue=200,value=2,field=True, width=540)
+    cmds.button(label='Re-simulate', command=lambda *pArgs: resimulateProc(widgets), w=165)
+    # solves the last simulation again from a frame with the current settings, keeping the frames before it
+    widgets['Half Pairs'] = cmds.checkBox(label='Half Pair List', value=True) # visits every pair of neighbours once and applies the result to both particles
+    widgets['Export Format'] = cmds.optionMenu(label='Export Format', w=300)
+    cmds.menuItem(label='None')
+    cmds.menuItem(label='PLY')
+    cmds.menuItem(label='VTK')
+    cmds.menuItem(label='CSV')
+    # exports the point data of every frame into the export folder of the project directory, so that the result can be read without maya
+    widgets['Compress Cache'] = cmds.checkBox(label='Compress Cache', value=False) # rounds positions to a fine grid and stores the change from the previous frame
+    widgets['Writer Mode'] = cmds.optionMenu(label='Writer Mode', w=300)
+    for mode in OUTPUT_MODES:
+        cmds.menuItem(label=mode)
+    cmds.optionMenu(widgets['Writer Mode'], e=True, v='Thread')
+    widgets['Writer Lag'] = cmds.intSliderGrp(label='Writer Lag', minValue=1,maxValue=32,value=OUTPUT_LAG,field=True, width=540)
+    # the cache, snapshots and exported frames are written inline, from a thread or from a separate process, which may fall this many frames behind the solver
+    widgets['Backend'] = cmds.optionMenu(label='Backend', w=300)
+    for name in ['Auto'] + BACKEND_PREFERENCE:
+        cmds.menuItem(label=name)
+    # runs the solver on the fastest backend installed, or on a chosen one, e.g Python to compare against the reference solver
+    widgets['Bake Mode'] = cmds.optionMenu(label='Bake Mode', w=300)
+    cmds.menuItem(label='Every Frame')
+    cmds.menuItem(label='Decimated')
+    widgets['Key Tolerance'] = cmds.floatSliderGrp(label='Key Tolerance', minValue=0.0,maxValue=0.05,value=0.001,field=True, step=0.001, precision=4, width=540)
+    # Decimated only keys the frames needed to follow each particle within the key tolerance, which keeps scenes small and scrubbing fast
+    widgets['Time Budget'] = cmds.floatSliderGrp(label='Time Budget (min)', minValue=1,maxValue=600,value=DEFAULT_BUDGET['Time Budget'],field=True, precision=0, width=540)
+    widgets['Memory Budget'] = cmds.floatSliderGrp(label='Memory Budget (MB)', minValue=256,maxValue=65536,value=DEFAULT_BUDGET['Memory Budget'],field=True, precision=0, width=540)
+    # simulations predicted to take longer or need more memory than the budget ask before they start
     
     cmds.setParent('..')
     cmds.setParent('..')
     
-    child8 = cmds.rowLayout(numberOfColumns=3,columnWidth2=[250,250])
-    button5 = cmds.button(label='Reset', command =  lambda *pArgs: resetProc2(widgets), w=250)
-    button6 = cmds.button(label='Cancel',command= lambda *pArgs: cancelProc(winID),w=250)
+    widgets['Directory Field'] = cmds.textFieldButtonGrp(label='Project Directory', text=widgets['Directory'] or '', editable=False, buttonLabel='Change',
+                                                         buttonCommand=lambda *pArgs: changeDirectoryProc(widgets), w=500)
+    # the project directory is remembered between sessions, so it is only asked for the first time the tool is opened
     
-    cmds.setParent(tab3)
-    
-    ######################### TAB 3 #########################
+    child8 = cmds.rowLayout(numberOfColumns=3,columnWidth3=[165,165,165])
+    button5 = cmds.button(label='Reset', command =  lambda *pArgs: resetProc2(widgets), w=165)
+    button17 = cmds.button(label='Estimate', command =  lambda *pArgs: estimateProc(widgets), w=165)
+    button6 = cmds.button(label='Cancel',command= lambda *pArgs: cancelProc(widgets['Tabs']['window']),w=165)
     
+def createOrientationTab(widgets):
+    '''
+        builds the Orientation tab, holding the spawn shape of the particles and the emitter
+        widgets:    dictionary containing values of all controls within the UI
+    '''
+    newDirectory = widgets['Directory']
     child9 = cmds.frameLayout('Spawning Orientation', w=500)
     title6 = cmds.rowColumnLayout(numberOfColumns=1)
     widgets['Orientation Grp'] = cmds.radioCollection('Orientation Grp')
     widgets['Orientation Type'] = []
-    cmds.image(image=newDirectory + "artefacts//images//cylindrical1", w=495,h=170)
+    cmds.image(image=findImage(newDirectory, 'cylindrical1', 495, 170), w=495,h=170)
     cylindrical = cmds.radioButton('Cylindrical',label='Cylindrical',onCommand = lambda *pArgs:selectOrientationForm(widgets), collection=widgets['Orientation Grp'])
-    cmds.image(image=newDirectory + "artefacts//images//uniform",w=495,h=165)
+    cmds.image(image=findImage(newDirectory, 'uniform', 495, 165),w=495,h=165)
     bBox = cmds.radioButton('Bounding_Box',label='Bounding Box',onCommand = lambda *pArgs:selectOrientationForm(widgets), collection=widgets['Orientation Grp'])
-    widgets['Orientation Type'].append((cylindrical,bBox))
     
     # allows the user to control the type of orientation to initially spawn the particles from. The options are a cylindrical or bounding box orientation. 
     # Links with the uniform and random distributions which provides users with 4 different types of spawning types:
@@ -186,16 +288,42 @@ def createUI():
         # random bounding box distribution
         
     cmds.setParent('..')
+    cmds.setParent('..')
+    
+    child21 = cmds.frameLayout('Emitter', w=500)
+    title10 = cmds.columnLayout(columnAttach = ('left',-50))
+    emitter = cmds.radioButton('Emitter',label='Continuous Pour',onCommand = lambda *pArgs:selectOrientationForm(widgets), collection=widgets['Orientation Grp'])
+    widgets['Orientation Type'].append((cylindrical,bBox,emitter))
+    widgets['Pool Size'] = cmds.intSliderGrp(label='Pool Size',minValue=100,maxValue=10000,value=1000,field=True,w=540)
+    widgets['Emission Rate'] = cmds.floatSliderGrp(label='Emission Rate',minValue=0,maxValue=100,value=10,field=True,precision=2,w=540)
+    widgets['Emission Speed'] = cmds.floatSliderGrp(label='Emission Speed',minValue=0,maxValue=10,value=1.0,field=True,precision=2,w=540)
+    widgets['Emitter Jitter'] = cmds.floatSliderGrp(label='Emitter Jitter',minValue=0,maxValue=0.5,value=0.02,field=True,precision=3,w=540)
+    widgets['Lifespan'] = cmds.intSliderGrp(label='Lifespan',minValue=0,maxValue=200,value=0,field=True,w=540)
+    # particles are poured from a nozzle over time instead of all spawning on the first frame. The pool size is the most particles alive at once,
+    # the emission rate is the number of particles emitted each frame and a lifespan of 0 keeps particles alive until the end of the simulation.
+    title11 = cmds.rowColumnLayout(numberOfColumns=4, columnAttach=[(1,'both',10)])
+    p, d = 'Emitter Position', 'Emitter Direction'
+    cmds.text('Nozzle')
+    widgets[p], widgets[d] = [], []
+    widgets[p].append((cmds.floatField(w=130), cmds.floatField(v=1.0,w=130), cmds.floatField(w=130)))
+    cmds.text('Direction')
+    widgets[d].append((cmds.floatField(), cmds.floatField(v=-1.0), cmds.floatField()))
+    # position of the nozzle and the direction particles are poured in
+    cmds.setParent('..')
+    cmds.setParent('..')
+    cmds.setParent('..')
     
     child10 = cmds.rowLayout(numberOfColumns=2,columnWidth2=[250,250])
     button10 = cmds.button(label='Delete Particles',command= lambda *pArgs: deleteGeometry('pSpheres'),w=250)
-    button10 = cmds.button(label='Cancel',command= lambda *pArgs: cancelProc(winID),w=250)
+    button10 = cmds.button(label='Cancel',command= lambda *pArgs: cancelProc(widgets['Tabs']['window']),w=250)
     
     # other options to delete all particles within the system after the simulation has run
-    cmds.setParent(tab5)
-    
-    ######################### TAB 4 #########################
     
+def createInstructionsTab(widgets):
+    '''
+        builds the Instructions tab, holding the default parameters of each liquid and what the parameters do
+        widgets:    dictionary containing values of all controls within the UI
+    '''
     child11 = cmds.frameLayout('Default parameters',w=500)
     
     text1 = '''
@@ -265,24 +393,25 @@ def createUI():
     cmds.setParent('..')
     
     title7 = cmds.rowLayout(numberOfColumns=2)
-    button12 = cmds.button(label='Cancel',command= lambda *pArgs: cancelProc(winID),w=500)
-    
-    cmds.setParent(tab4)
-    
-    ######################### TAB 5 #########################
+    button12 = cmds.button(label='Cancel',command= lambda *pArgs: cancelProc(widgets['Tabs']['window']),w=500)
     
+def createCoffeeTab(widgets):
+    '''
+        builds the Coffee tab, holding the coffee machine, cup and roast
+        widgets:    dictionary containing values of all controls within the UI
+    '''
+    newDirectory = widgets['Directory']
     child13 = cmds.frameLayout('Choose a machine',w=500)
     child14 = cmds.paneLayout(configuration='vertical2')
-    cmds.iconTextButton(style='iconAndTextVertical',label='Model 1',image=newDirectory + "artefacts//images//coffee_machine", command = lambda *pArgs: loadObjProc(newDirectory + 'artefacts//MayaScene//' ,'coffee_machine','body'), w=240,h=200)
-    cmds.iconTextButton(style='iconAndTextVertical',label='Model 2',image=newDirectory + "artefacts//images//second_coffee_machine.PNG", command = lambda *pArgs: loadObjProc(newDirectory + 'artefacts//MayaScene//','sec_coffee_machine','Componente_2_005'), w=240,h=200)    
-   
+    cmds.iconTextButton(style='iconAndTextVertical',label='Model 1',image=findImage(newDirectory, 'coffee_machine', 240, 200), command = lambda *pArgs: loadObjProc(newDirectory + 'artefacts//MayaScene//' ,'coffee_machine','body'), w=240,h=200)
+    cmds.iconTextButton(style='iconAndTextVertical',label='Model 2',image=findImage(newDirectory, 'second_coffee_machine.PNG', 240, 200), command = lambda *pArgs: loadObjProc(newDirectory + 'artefacts//MayaScene//','sec_coffee_machine','Componente_2_005'), w=240,h=200)
     cmds.setParent('..')
     # allows the user to select from 2 types of machines by selecting machine icons
     child15 = cmds.frameLayout('Choose a cup',w=500)
     child16 = cmds.paneLayout(configuration='vertical3')
-    cmds.iconTextButton(style='iconAndTextVertical',label='Mug',image=newDirectory + "artefacts//images//mug", command = lambda *pArgs: loadObjProc(newDirectory + 'artefacts//MayaScene//','mug','pCylinder3'),w=160,h=120)
-    cmds.iconTextButton(style='iconAndTextVertical',label='Cup',image=newDirectory + "artefacts//images//cup", command = lambda *pArgs: loadObjProc(newDirectory + 'artefacts//MayaScene//','cup','cup_GEO'),w=165,h=120)
-    cmds.iconTextButton(style='iconAndTextVertical',label='Glass',image=newDirectory + "artefacts//images//glass", command = lambda *pArgs: loadObjProc(newDirectory + 'artefacts//MayaScene//','glass','Tube001'),w=165,h=120)
+    cmds.iconTextButton(style='iconAndTextVertical',label='Mug',image=findImage(newDirectory, 'mug', 160, 120), command = lambda *pArgs: loadObjProc(newDirectory + 'artefacts//MayaScene//','mug','pCylinder3'),w=160,h=120)
+    cmds.iconTextButton(style='iconAndTextVertical',label='Cup',image=findImage(newDirectory, 'cup', 165, 120), command = lambda *pArgs: loadObjProc(newDirectory + 'artefacts//MayaScene//','cup','cup_GEO'),w=165,h=120)
+    cmds.iconTextButton(style='iconAndTextVertical',label='Glass',image=findImage(newDirectory, 'glass', 165, 120), command = lambda *pArgs: loadObjProc(newDirectory + 'artefacts//MayaScene//','glass','Tube001'),w=165,h=120)
     cmds.setParent('..')
     # allows the user to select from 3 different types of cups by selecting cup icons.
     child17 = cmds.rowLayout(numberOfColumns=1)
@@ -296,19 +425,21 @@ def createUI():
     cmds.setParent('..')
     # different coffee types and roast options as drop-down menus for users to change the roast of their coffee; which will affect the colour of simulated particles.
     title9 = cmds.rowLayout(numberOfColumns=1)
-    button14 = cmds.button(label='Cancel',command= lambda *pArgs: cancelProc(winID),w=500)
-    
-    cmds.setParent(tab6)
-    
-    ######################### TAB 6 #########################
+    button14 = cmds.button(label='Cancel',command= lambda *pArgs: cancelProc(widgets['Tabs']['window']),w=500)
     
+def createSimInstructionsTab(widgets):
+    '''
+        builds the Sim Instructions tab, holding the limitations of the simulation
+        widgets:    dictionary containing values of all controls within the UI
+    '''
     child17 = cmds.frameLayout('Simulation Instructions',w=500)
     
     text5 ='''
         - Simulations with more than 1600 particles and a cluster radius greater than
           0.35 can take up to an 30 minutes. If you wish to increase the number of 
           simulated particles, reducing the cluster radius will enable the simulation
-          to run faster. 
+          to run faster. Press Estimate in the General tab to see how long the current
+          settings will take and how much memory they need before simulating.
           
         - A time step of 0.01 seconds is used in fluid simulations. Greater values will 
           have effects on the motion of the particles. If the time difference is too high
@@ -339,12 +470,14 @@ def createUI():
     cmds.setParent('..')
     
     child18 = cmds.rowLayout(numberOfColumns=1)
-    button16 = cmds.button(label='Cancel',command= lambda *pArgs: cancelProc(winID),w=500)
-    
-    cmds.setParent(tab7)
-    
-    ######################### TAB 7 #########################
+    button16 = cmds.button(label='Cancel',command= lambda *pArgs: cancelProc(widgets['Tabs']['window']),w=500)
     
+def createCoffeeInstructionsTab(widgets):
+    '''
+        builds the Coffee Instructions tab, holding the steps to create a simulation
+        widgets:    dictionary containing values of all controls within the UI
+    '''
+    newDirectory = widgets['Directory']
     text6 = '''    
     - Set physical parameters in the 'main' tab. 
       To simulate a default liquid press on one of 
@@ -364,7 +497,7 @@ def createUI():
    '''
     child19 = cmds.frameLayout('Machine Instructions', w=500)
     child20 = cmds.paneLayout(configuration='vertical2')
-    cmds.image(image=newDirectory + 'artefacts//images//coffee_front_img.png', w=230,h=200)
+    cmds.image(image=findImage(newDirectory, 'coffee_front_img.png', 230, 200), w=230,h=200)
     cmds.rowColumnLayout()
     cmds.text('Steps to create simulation:', font="boldLabelFont",align='center')
     cmds.text(text6,align='left',font="smallPlainLabelFont")  
@@ -388,14 +521,93 @@ def createUI():
         achieve realistic results. '''    
     # warnings and endnotes that outline things users shouldn't attempt to avoid the simulation crashing on them.     
     cmds.text(text8,align='center',font="boldLabelFont")  
-    cmds.button(label='Cancel', command= lambda *pArgs: cancelProc(winID),w=500)
+    cmds.button(label='Cancel', command= lambda *pArgs: cancelProc(widgets['Tabs']['window']),w=500)
     
-    cmds.showWindow(winID)
+UI_TABS = [('Main', createMainTab), ('General', createGeneralTab), ('Orientation', createOrientationTab), ('Coffee', createCoffeeTab),
+           ('Instructions', createInstructionsTab), ('Sim Instructions', createSimInstructionsTab), ('Coffee Instructions', createCoffeeInstructionsTab)]
+# label and builder of every tab, in the order they are shown
+CONTROL_TABS = ['Main', 'General', 'Orientation'] # tabs holding the controls read by queryParams
+DIRECTORY_OPTION = 'coffeeWorksDirectory' # maya option variable remembering the project directory between sessions
+IMAGE_CACHE = {} # paths of the images already found this session, by project directory, image name and size shown at
+
+def requireTabs(widgets, labels):
+    '''
+        builds the tabs that have not been built yet, so that their controls can be read or changed
+        widgets:    dictionary containing values of all controls within the UI
+        labels:    list of labels from UI_TABS of the tabs needed
+    '''
+    tabs = widgets['Tabs']
+    for page, (label, builder) in zip(tabs['pages'], UI_TABS):
+        if label in labels and label not in tabs['built']:
+            tabs['built'].add(label)
+            cmds.setParent(page)
+            builder(widgets)
+
+def findImage(directory, name, width, height):
+    '''
+        finds the image to show in the UI, shrunk to the size it is shown at. Shrunk images are kept in the
+        thumbnails folder of the project directory, so each image is only read at full size once, and the path is
+        remembered for the rest of the session.
+        directory:    project directory
+        name:    file name of the image in artefacts/images, the extension may be left out
+        width, height:    size the image is shown at
+        return:    path of the shrunk image, or of the image itself if it could not be shrunk
+    '''
+    key = (directory, name, width, height)
+    if key not in IMAGE_CACHE:
+        directory = directory or ''
+        source = directory + 'artefacts//images//' + name
+        if not os.path.exists(source) and glob.glob(source + '.*'):
+            source = glob.glob(source + '.*')[0] # maya finds images without an extension, so the UI names some of them that way
+        thumbnail = directory + 'thumbnails//%s_%dx%d.png' % (os.path.splitext(os.path.basename(source))[0], width, height)
+        IMAGE_CACHE[key] = source
+        if os.path.exists(thumbnail) and os.path.getmtime(thumbnail) >= os.path.getmtime(source):
+            IMAGE_CACHE[key] = thumbnail
+        elif om is not None and os.path.exists(source):
+            try:
+                if not os.path.exists(directory + 'thumbnails'):
+                    os.makedirs(directory + 'thumbnails')
+                image = om.MImage()
+                image.readFromFile(source)
+                image.resize(width, height, True)
+                image.writeToFile(thumbnail, 'png')
+                IMAGE_CACHE[key] = thumbnail
+            except (RuntimeError, OSError, IOError):
+                pass # the full size image is shown if it cannot be shrunk, e.g when the project directory is read only
+    return IMAGE_CACHE[key]
+
+def findProjectDirectory():
+    '''
+        finds the project directory, only asking the user for it the first time the tool is opened, or when the
+        remembered directory no longer holds the artefacts folder
+        return:    the project directory, '//' separated like queryDirectory, or None if the user cancelled
+    '''
+    if cmds.optionVar(exists=DIRECTORY_OPTION):
+        directory = cmds.optionVar(q=DIRECTORY_OPTION)
+        if os.path.isdir(directory + 'artefacts'):
+            return directory
+    directory = queryDirectory()
+    if directory:
+        cmds.optionVar(sv=(DIRECTORY_OPTION, directory)) # option variables are saved in the maya preferences
+    return directory
+
+def changeDirectoryProc(widgets, *pArgs):
+    '''
+        asks for a new project directory, which is remembered for the following sessions. The particle cache, store and
+        snapshots of the following simulations are kept in the new directory.
+        widgets:    dictionary containing values of all controls within the UI
+    '''
+    directory = queryDirectory()
+    if directory:
+        cmds.optionVar(sv=(DIRECTORY_OPTION, directory))
+        widgets['Directory'] = directory
+        cmds.textFieldButtonGrp(widgets['Directory Field'], e=True, text=directory)
 
 def cancelProc(winID,*pArgs):  
-    # function to cancel the currently opened tab when the window is open
+    # function to cancel the currently opened tab when the window is open. The window is hidden rather than deleted so
+    # that opening the tool again shows it straight away
     print 'Cancelled'
-    cmds.deleteUI(winID)        
+    cmds.window(winID, e=True, visible=False)
    
 def loadObjProc(filePath,name,objName,*pArgs):        
     '''
@@ -455,6 +667,7 @@ def loadDefaultParams(widgets, *pArgs):
         physical parameters to default values by the specified type of liquid.
         widgets:    dictionary containing values to all UI controls in the program
     '''
+    requireTabs(widgets, ['General']) # the particle colour is on the General tab
     queryParams = cmds.radioButtonGrp(widgets['Type Of Liquid'],q=True,sl=True) # if one of the radioButtonGrp options for type of liquid is selected, execute an action
     if queryParams==1:
         cmds.floatSliderGrp(widgets['Density'], q=True, e=True, v=1036.2)
@@ -490,9 +703,11 @@ def resetProc1(widgets, *pArgs):
         physical parameters to simulate a realistic water.
         widgets:    dictionary containing values of all controls within the UI
     '''
+    requireTabs(widgets, ['General'])
     cmds.floatSliderGrp(widgets['Density'], q=True, e=True, v = 998.2)
     cmds.floatSliderGrp(widgets['Mass'], q=True, e=True, v = 0.1)
     cmds.floatSliderGrp(widgets['Viscosity'], q=True, e=True,  v = 3.5)
+    cmds.optionMenu(widgets['Viscosity Solver'], e=True, v = 'Auto')
     cmds.floatSliderGrp(widgets['Stiffness'], q=True, e=True, v = 3)
     cmds.floatSliderGrp(widgets['Delta'], q=True, e=True,  v = 0.0728)
     cmds.floatSliderGrp(widgets['Buoyancy'], q=True, e=True, v = 0)
@@ -507,10 +722,34 @@ def resetProc2(widgets,*pArgs):
     cmds.intSliderGrp(widgets['No. of Particles'], q=True, e=True, v = 1000)
     cmds.floatSliderGrp(widgets['Particle Radius'], q=True, e=True, v = 0.035)
     cmds.floatSliderGrp(widgets['Cluster Radius'], q=True, e=True,  v = 0.35)
+    cmds.checkBox(widgets['Auto Cluster Radius'], e=True, v = False)
+    cmds.intSliderGrp(widgets['Target Neighbours'], q=True, e=True, v = 40)
+    cmds.intSliderGrp(widgets['Max Neighbours'], q=True, e=True, v = 0)
+    cmds.intSliderGrp(widgets['Adapt Interval'], q=True, e=True, v = 0)
+    cmds.checkBox(widgets['Adaptive Resolution'], e=True, v = False)
+    cmds.intSliderGrp(widgets['Resolution Levels'], q=True, e=True, v = 2)
+    cmds.intSliderGrp(widgets['Split Reserve'], q=True, e=True, v = 1000)
     cmds.floatSliderGrp(widgets['Spawn Radius'], q=True, e=True, v = 1.5)
-    cmds.floatSliderGrp(widgets['Tank Size'], q=True, e=True,  v = 6)
     cmds.intSliderGrp(widgets['No. of Frames'], q=True, e=True, v = 60)
     cmds.floatSliderGrp(widgets['Time Difference'], q=True, e=True, v = 0.01)  
+    cmds.intSliderGrp(widgets['Reorder Interval'], q=True, e=True, v = 10)
+    cmds.checkBox(widgets['Half Pairs'], e=True, v = True)
+    cmds.intSliderGrp(widgets['Frames Per Step'], q=True, e=True, v = 1)
+    cmds.floatSliderGrp(widgets['Interpolation Tolerance'], q=True, e=True, v = 0.01)
+    cmds.optionMenu(widgets['Divergence Action'], e=True, v = 'Rollback')
+    cmds.optionMenu(widgets['Export Format'], e=True, v = 'None')
+    cmds.checkBox(widgets['Compress Cache'], e=True, v = False)
+    cmds.optionMenu(widgets['Writer Mode'], e=True, v = 'Thread')
+    cmds.intSliderGrp(widgets['Writer Lag'], q=True, e=True, v = OUTPUT_LAG)
+    cmds.optionMenu(widgets['Backend'], e=True, v = 'Auto')
+    cmds.optionMenu(widgets['Bake Mode'], e=True, v = 'Every Frame')
+    cmds.floatSliderGrp(widgets['Key Tolerance'], q=True, e=True, v = 0.001)
+    cmds.floatSliderGrp(widgets['Time Budget'], q=True, e=True, v = DEFAULT_BUDGET['Time Budget'])
+    cmds.floatSliderGrp(widgets['Memory Budget'], q=True, e=True, v = DEFAULT_BUDGET['Memory Budget'])
+    cmds.intSliderGrp(widgets['Random Seed'], q=True, e=True, v = 0)
+    cmds.checkBox(widgets['Poisson Disk'], e=True, v = False)
+    cmds.floatSliderGrp(widgets['Spawn Spacing'], q=True, e=True, v = 0)
+    cmds.intSliderGrp(widgets['Relax Steps'], q=True, e=True, v = 0)
 
 def selectOrientationType(widgets,*pArgs):
     '''
@@ -539,12 +778,16 @@ def selectOrientationForm(widgets,*pArgs):
     if queryGrp=='Cylindrical': 
         print 'Cylindrical orientation selected'  #  informs the user if the spawn orientation type they selected is 'Cylindrical'  
         cmds.radioCollection(widgets['Orientation Grp'],e=True,sl=widgets['Orientation Type'][0][0] )   #  if the second type is selected, flag the control of that type to selected
+    if queryGrp=='Emitter':
+        print 'Continuous pour selected'
+        cmds.radioCollection(widgets['Orientation Grp'],e=True,sl=widgets['Orientation Type'][0][2] )
 
 def roastProc(widgets, *pArgs):
     '''
         changes the colour of the particles corresponding to a coffee roast level specified by the user.
         widgets:    dictionary containing values of all controls within the UI
     '''
+    requireTabs(widgets, ['General'])
     queryRoast = cmds.optionMenu(widgets['Coffee Roast'], q=True,v=True) # action to retrieve the value from the drop-down menu controlling coffee roast types.
     if queryRoast=='light': # if light roast is selected, change to light brown particle colour
         cmds.colorSliderGrp(widgets['Particle Colour'], e=True, enable=False, rgbValue=(0.7,0.4,0.1))
@@ -564,14 +807,19 @@ def deleteGeometry(groupName, *pArgs):
         cmds.select(groupName)
         cmds.delete()
                 
-def startSimulation(widgets, *pArgs):           
+def queryParams(widgets):
     '''
-        starts the simulation using values specified by user within the program.
+        reads the value of every user specified parameter from the UI
+
+        widgets:    dictionary containing values of all controls within the UI
+        return:    dictionary containing values for each user specified parameter
     '''
+    requireTabs(widgets, CONTROL_TABS) # tabs that were never selected are built with their default values
     params = {} # local dictionary that will contain values for each user specified parameter
     params['Density'] = cmds.floatSliderGrp(widgets['Density'], q=True, v=True)
     params['Mass'] = cmds.floatSliderGrp(widgets['Mass'], q=True, v=True)
     params['Viscosity'] = cmds.floatSliderGrp(widgets['Viscosity'], q=True, v=True)
+    params['Viscosity Solver'] = cmds.optionMenu(widgets['Viscosity Solver'], q=True, v=True)
     params['Stiffness'] = cmds.floatSliderGrp(widgets['Stiffness'], q=True, v=True)
     params['Delta'] = cmds.floatSliderGrp(widgets['Delta'], q=True, v=True)
     params['Buoyancy'] = cmds.floatSliderGrp(widgets['Buoyancy'], q=True, v=True)
@@ -579,9 +827,37 @@ def startSimulation(widgets, *pArgs):
     params['No. of Particles'] = cmds.intSliderGrp(widgets['No. of Particles'], q=True, v=True)
     params['Particle Radius'] = cmds.floatSliderGrp(widgets['Particle Radius'], q=True, v=True)
     params['Cluster Radius'] = cmds.floatSliderGrp(widgets['Cluster Radius'], q=True, v=True)
+    params['Auto Cluster Radius'] = cmds.checkBox(widgets['Auto Cluster Radius'], q=True, v=True)
+    params['Target Neighbours'] = cmds.intSliderGrp(widgets['Target Neighbours'], q=True, v=True)
+    params['Max Neighbours'] = cmds.intSliderGrp(widgets['Max Neighbours'], q=True, v=True)
+    params['Adapt Interval'] = cmds.intSliderGrp(widgets['Adapt Interval'], q=True, v=True)
+    params['Adaptive Resolution'] = cmds.checkBox(widgets['Adaptive Resolution'], q=True, v=True)
+    params['Resolution Levels'] = cmds.intSliderGrp(widgets['Resolution Levels'], q=True, v=True)
+    params['Split Reserve'] = cmds.intSliderGrp(widgets['Split Reserve'], q=True, v=True)
     params['Spawn Radius'] = cmds.floatSliderGrp(widgets['Spawn Radius'], q=True, v=True)
     params['No. of Frames'] = cmds.intSliderGrp(widgets['No. of Frames'], q=True, v=True)
     params['Time Difference'] = cmds.floatSliderGrp(widgets['Time Difference'], q=True, v=True) 
+    params['Reorder Interval'] = cmds.intSliderGrp(widgets['Reorder Interval'], q=True, v=True)
+    params['Half Pairs'] = cmds.checkBox(widgets['Half Pairs'], q=True, v=True)
+    params['Frames Per Step'] = cmds.intSliderGrp(widgets['Frames Per Step'], q=True, v=True)
+    params['Interpolation Tolerance'] = cmds.floatSliderGrp(widgets['Interpolation Tolerance'], q=True, v=True)
+    params['Divergence Action'] = cmds.optionMenu(widgets['Divergence Action'], q=True, v=True)
+    params['Export Format'] = cmds.optionMenu(widgets['Export Format'], q=True, v=True)
+    params['Compress Cache'] = cmds.checkBox(widgets['Compress Cache'], q=True, v=True)
+    params['Writer Mode'] = cmds.optionMenu(widgets['Writer Mode'], q=True, v=True)
+    params['Writer Lag'] = cmds.intSliderGrp(widgets['Writer Lag'], q=True, v=True)
+    params['Backend'] = cmds.optionMenu(widgets['Backend'], q=True, v=True)
+    params['Bake Mode'] = cmds.optionMenu(widgets['Bake Mode'], q=True, v=True)
+    params['Key Tolerance'] = cmds.floatSliderGrp(widgets['Key Tolerance'], q=True, v=True)
+    params['Type Of Liquid'] = cmds.radioButtonGrp(widgets['Type Of Liquid'], q=True, sl=True) # the selected liquid is stored as the phase of every particle
+    params['Cache Directory'], params['Export Directory'], params['Store Directory'], params['Snapshot Directory'] = None, None, None, None
+    params['Relax Directory'] = None
+    if widgets['Directory']:
+        params['Cache Directory'] = widgets['Directory'] + 'cache//' # every simulated frame is written to the particle cache within the project directory
+        params['Export Directory'] = widgets['Directory'] + 'export//'
+        params['Store Directory'] = widgets['Directory'] + 'store//' # completed simulations are kept here and reused when the same settings are simulated again
+        params['Snapshot Directory'] = widgets['Directory'] + 'snapshots//'
+        params['Relax Directory'] = widgets['Directory'] + 'relaxed//' # relaxed spawn layouts are kept here and reused
     params['Particle Colour'] = cmds.colorSliderGrp(widgets['Particle Colour'], q=True, rgbValue=True)
     params['Gravity'] = [] # creates an empty list to append individual gravity values from based off user entries.
     params['Gravity'].append((cmds.floatField(widgets['Gravity'][0][0], q=True, v=True), cmds.floatField(widgets['Gravity'][0][1], q=True, v=True), 
@@ -589,13 +865,94 @@ def startSimulation(widgets, *pArgs):
     params['Initial Velocity'] = [] # creates an empty list to append individual initial position values from based off user entries.
     params['Initial Velocity'].append((cmds.floatField(widgets['Initial Velocity'][0][0], q=True, v=True), cmds.floatField(widgets['Initial Velocity'][0][1], q=True, v=True), 
                     cmds.floatField(widgets['Initial Velocity'][0][2], q=True, v=True)))
+    params['Random Seed'] = cmds.intSliderGrp(widgets['Random Seed'], q=True, v=True)
+    params['Poisson Disk'] = cmds.checkBox(widgets['Poisson Disk'], q=True, v=True)
+    params['Spawn Spacing'] = cmds.floatSliderGrp(widgets['Spawn Spacing'], q=True, v=True)
+    params['Relax Steps'] = cmds.intSliderGrp(widgets['Relax Steps'], q=True, v=True)
+    params['Spawn Layout'] = (cmds.radioCollection(widgets['Orientation Grp'], q=True, sl=True), cmds.radioButtonGrp(widgets['Orientation'], q=True, sl=True))
+    params['Container Hash'] = findContainerHash('Cup') # the container is part of what makes two simulations identical
+    params['Time Budget'] = cmds.floatSliderGrp(widgets['Time Budget'], q=True, v=True)
+    params['Memory Budget'] = cmds.floatSliderGrp(widgets['Memory Budget'], q=True, v=True)
+    if cmds.radioButton(widgets['Orientation Type'][0][2], q=True, sl=True):
+        for name in ['Emission Rate', 'Emission Speed', 'Emitter Jitter']:
+            params[name] = cmds.floatSliderGrp(widgets[name], q=True, v=True)
+        for name in ['Pool Size', 'Lifespan']:
+            params[name] = cmds.intSliderGrp(widgets[name], q=True, v=True)
+        for name in ['Emitter Position', 'Emitter Direction']:
+            params[name] = [tuple([cmds.floatField(f, q=True, v=True) for f in widgets[name][0]])]
+    return params
+
+def estimateProc(widgets, *pArgs):
+    '''
+        shows how long the simulation is expected to take and how much memory it will need with the current settings
+        widgets:    dictionary containing values of all controls within the UI
+    '''
+    params = queryParams(widgets)
+    plan = planSimulation(params)
+    cmds.confirmDialog(title='Estimate', message='\n'.join([formatPlan(plan)] + checkBudget(plan, params)), button=['OK'])
+
+def checkResimulation(params, frame):
+    '''
+        checks that the last simulation can be solved again from a frame
+
+        params:    dictionary containing values for each user specified parameter
+        frame:    first frame to solve again
+        return:    a message explaining why it cannot, or None if it can
+    '''
+    snapshotDir = params['Snapshot Directory']
+    if not snapshotDir or not os.path.exists(findCacheFile(snapshotDir, frame-1)):
+        return 'There is no snapshot of frame %d, simulate from the start first.' % (frame-1)
+    if frame >= params['No. of Frames']:
+        return 'Frame %d is past the end of the simulation.' % frame
+    names = readParticleNames(snapshotDir)
+    if names is None or readParticleCache(findCacheFile(snapshotDir, frame-1))['attributes']['particles'] != len(names):
+        return 'The particles of the last simulation were not recorded with its snapshots, simulate from the start instead.'
+    if not all([cmds.objExists(name) for name in names]):
+        return 'The particles of the last simulation are no longer in the scene.'
+    return None
+
+def resimulateProc(widgets, *pArgs):
+    '''
+        solves the last simulation again from the chosen frame with the current settings. The particles and their
+        keyframes before that frame are kept, so only the frames after it have to be solved and baked.
+        widgets:    dictionary containing values of all controls within the UI
+    '''
+    params = queryParams(widgets)
+    frame = cmds.intSliderGrp(widgets['Resimulate From'], q=True, v=True)
+    problem = checkResimulation(params, frame)
+    if problem:
+        cmds.confirmDialog(title='Re-simulate', message=problem, button=['OK'])
+        return
+    pSpheres = [[name] for name in readParticleNames(params['Snapshot Directory'])] # the instance of every particle id, as the last simulation was given them
+    numSpheres = len(pSpheres)
+    lastFrame = max(listCacheFrames(params['Snapshot Directory']) + [params['No. of Frames']])
+    cmds.cutKey([p[0] for p in pSpheres], time=(frame, lastFrame), attribute=['tx', 'ty', 'tz', 'visibility', 'sx', 'sy', 'sz'], clear=True) # keys of the frames solved again
+    animateFluid(params, pSpheres, numSpheres, frame)
+
+def startSimulation(widgets, *pArgs):           
+    '''
+        starts the simulation using values specified by user within the program.
+    '''
+    params = queryParams(widgets)
+    plan = planSimulation(params) # the cost is predicted before any particle is spawned, so runs that would not fit the budget can be stopped
+    print formatPlan(plan)
+    problems = checkBudget(plan, params)
+    if problems and cmds.confirmDialog(title='Over Budget', message='\n'.join(problems + ['', formatPlan(plan)]), button=['Run Anyway', 'Cancel'],
+                                       defaultButton='Cancel', cancelButton='Cancel', dismissString='Cancel') != 'Run Anyway':
+        print 'Simulation cancelled as it is over budget.'
+        return
+    rd.seed(params['Random Seed']) # random spawn distributions are repeatable for a given seed
             
     if cmds.radioButton(widgets['Orientation Type'][0][1], q=True, sl=True):     # inspects whether the user has selected the given spawn orientation and distribution type, executing actions based off their selection            
         if cmds.radioButtonGrp(widgets['Orientation'], q=True, sl=True)==1: 
             deleteGeometry('pSpheres') # deletes any existing groups within the scene by the name of 'pSpheres'
             print 'uniform bounding box generating...'  # informs them of the type of spawn orientation and distribution type that they selected.             
             uniformBoxGenerator(params) # executes the corresponding code based off orientation entry.
-        if cmds.radioButtonGrp(widgets['Orientation'], q=True, sl=True)==2:  
+        if cmds.radioButtonGrp(widgets['Orientation'], q=True, sl=True)==2 and params['Poisson Disk']:
+            deleteGeometry('pSpheres')
+            print 'poisson disk bounding box generating...'
+            poissonGenerator(params, 'Bounding_Box')
+        elif cmds.radioButtonGrp(widgets['Orientation'], q=True, sl=True)==2:  
             deleteGeometry('pSpheres')
             print 'random bounding box generating...'              
             randomBoxGenerator(params) 
@@ -604,10 +961,18 @@ def startSimulation(widgets, *pArgs):
             deleteGeometry('pSpheres')
             print 'uniform cylinder generating...'              
             uniformCylinderGenerator(params)
-        if cmds.radioButtonGrp(widgets['Orientation'], q=True, sl=True)==2:
+        if cmds.radioButtonGrp(widgets['Orientation'], q=True, sl=True)==2 and params['Poisson Disk']:
+            deleteGeometry('pSpheres')
+            print 'poisson disk cylinder generating...'
+            poissonGenerator(params, 'Cylindrical')
+        elif cmds.radioButtonGrp(widgets['Orientation'], q=True, sl=True)==2:
             deleteGeometry('pSpheres')
             print 'random cylinder generating...'                
             randomCylinderGenerator(params) 
+    if cmds.radioButton(widgets['Orientation Type'][0][2], q=True, sl=True):
+        deleteGeometry('pSpheres')
+        print 'emitter generating...'
+        emitterGenerator(params)
 
 
 def setMaterial(objName, materialType, colour):
@@ -661,6 +1026,7 @@ def randomBoxGenerator(widgets):
     cmds.select('pSphere_Inst*')
     cmds.group(n='pSpheres') # groups all pSphere instances within the scene.
     
+    relaxSpawnedParticles(widgets, 'Bounding_Box', pSpheres) # overlapping particles are eased apart before the first frame
     animateFluid(widgets, pSpheres, numSpheres) # animates fluid based off user entries and number of Spheres specified by user.
 
 def uniformBoxGenerator(widgets):
@@ -697,6 +1063,7 @@ def uniformBoxGenerator(widgets):
     cmds.select('pSphere_Inst*')
     cmds.group(n='pSpheres') # groups all pSphere instances within the scene.                                            
     
+    relaxSpawnedParticles(widgets, 'Bounding_Box', pSpheres) # overlapping particles are eased apart before the first frame
     animateFluid(widgets, pSpheres, numSpheres) # animates fluid based off user entries and number of Spheres specified by user.
 
 def uniformCylinderGenerator(widgets):
@@ -739,6 +1106,7 @@ def uniformCylinderGenerator(widgets):
     cmds.group(n='pSpheres')
     
     length = len(pSpheres)
+    relaxSpawnedParticles(widgets, 'Cylindrical', pSpheres) # overlapping particles are eased apart before the first frame
     animateFluid(widgets, pSpheres, length) # animates fluid based off user entries and number of Spheres specified by user.
 
 def randomCylinderGenerator(widgets):
@@ -782,7 +1150,95 @@ def randomCylinderGenerator(widgets):
     cmds.group(n='pSpheres')
     
     length = len(pSpheres)
+    relaxSpawnedParticles(widgets, 'Cylindrical', pSpheres) # overlapping particles are eased apart before the first frame
     animateFluid(widgets, pSpheres, length) # animates fluid based off user entries and number of Spheres specified by user.
+
+def poissonGenerator(widgets, shape):
+    '''
+        spawns particles at random with Poisson disk spacing in the box or cylinder of the random distributions, so no
+        two particles start closer than the Spawn Spacing
+    '''
+    positions = findPoissonLayout(widgets, shape, rd.Random(widgets['Random Seed'])) # the same layout planSimulation predicts
+    pSphere, pSpheres = cmds.sphere(r=widgets['Particle Radius'],n='pSphere')[0], []
+    for i in range(len(positions)):
+        pSphereInst = cmds.instance(pSphere, n='pSphere_Inst' + str(i))
+        setMaterial(pSphereInst[0],'lambert', widgets['Particle Colour'])
+        pSpheres.append(pSphereInst)
+        cmds.move(positions[i][0],positions[i][1],positions[i][2],pSphereInst)
+
+    cmds.select('pSphere') # selects the first sphere and deletes it.
+    cmds.delete()
+
+    cmds.select('pSphere_Inst*') # groups all pSphere instances within the scene.
+    cmds.group(n='pSpheres')
+
+    relaxSpawnedParticles(widgets, shape, pSpheres)
+    animateFluid(widgets, pSpheres, len(pSpheres))
+
+def relaxSpawnedParticles(widgets, shape, pSpheres):
+    '''
+        moves spawned particles to their relaxed layout when Relax Steps is above 0, see findRelaxedLayout
+
+        widgets:    dictionary containing user controlled parameter values
+        shape:    'Bounding_Box' or 'Cylindrical'
+        pSpheres:    list of all particle instances in the system
+    '''
+    if widgets.get('Relax Steps', 0) > 0:
+        positions = findRelaxedLayout(widgets, shape, [p[0] for p in findPos(pSpheres)])
+        for pSphereInst, pos in zip(pSpheres, positions):
+            cmds.move(pos[0],pos[1],pos[2],pSphereInst)
+
+def createReserveParticles(widgets, pSpheres):
+    '''
+        creates the hidden particles which particles of Adaptive Resolution are split into, after the spawned
+        particles, and keys the size and visibility of every particle before the first frame, so the keys set as
+        particles split and merge only change them from then on. The emitter pours from its own pool instead.
+
+        widgets:    dictionary containing user controlled parameter values
+        pSpheres:    list of the spawned particle instances
+        return:    list of the reserve particle instances
+    '''
+    reserve, emitter = [], 'Emission Rate' in widgets
+    if not emitter and widgets.get('Split Reserve', 0) > 0:
+        pSphere = cmds.sphere(r=widgets['Particle Radius'],n='pSphere')[0]
+        for i in range(len(pSpheres), len(pSpheres) + widgets['Split Reserve']):
+            pSphereInst = cmds.instance(pSphere, n='pSphere_Inst' + str(i))
+            setMaterial(pSphereInst[0],'lambert', widgets['Particle Colour'])
+            cmds.parent(pSphereInst[0], 'pSpheres')
+            reserve.append(pSphereInst)
+        cmds.delete(pSphere)
+    for j, pSphereInst in enumerate(pSpheres + reserve):
+        if not emitter: # the pool of the emitter is already hidden until it is poured
+            cmds.setKeyframe(pSphereInst[0], attribute="visibility", v=int(j < len(pSpheres)), t=[0], outTangentType="step")
+        for attribute in ['sx', 'sy', 'sz']:
+            cmds.setKeyframe(pSphereInst[0], attribute=attribute, v=1.0, t=[0], outTangentType="step")
+    return reserve
+
+def emitterGenerator(widgets):
+    '''
+        creates a fixed pool of hidden particles at the emitter nozzle. Particles are poured from the pool over time 
+        by the simulation, so no objects have to be created while it is solving.
+    '''
+    numSpheres = widgets['Pool Size']
+    nozzle = widgets['Emitter Position'][0]
+    pSphere, pSpheres  = cmds.sphere(r=widgets['Particle Radius'],n='pSphere')[0], []   # creates the first particle and an empty list to contain all particle instance names.
+    for i in range(numSpheres):
+        pSphereInstName = 'pSphere_Inst' + str(i)
+        pSphereInst = cmds.instance(pSphere, n=pSphereInstName)
+        pSpheres.append(pSphereInst)
+        cmds.move(nozzle[0], nozzle[1], nozzle[2], pSphereInst)
+        cmds.setKeyframe(pSphereInst[0], attribute="visibility", v=0, t=[0], outTangentType="step") # pooled particles stay hidden until they are emitted
+        
+    for i in pSpheres:
+        setMaterial(i[0],'lambert', widgets['Particle Colour'])   # sets the colour of particles. 
+                    
+    cmds.select('pSphere') # selects the first sphere and deletes it.
+    cmds.delete()  
+    
+    cmds.select('pSphere_Inst*') # groups all pSphere instances within the scene.
+    cmds.group(n='pSpheres')
+    
+    animateFluid(widgets, pSpheres, numSpheres) # animates fluid based off user entries and number of Spheres specified by user.
         
 def findPos(pSpheresPos):
     '''
@@ -797,90 +1253,62 @@ def findPos(pSpheresPos):
             pos.append(obj) #  add coordinate values as list elements to pos list
     return pos            
 
-def findNeighbour(clusterRadius,pSpheresPos,pSpheres,particleRadius):
+def findNeighbour(clusterRadius,positions,particleRadius,active=None):
     '''
-    puts particles within a cluster group dictionary if within the specified
-    cluster radius. 
+    finds the neighbours of every particle which are within the specified
+    cluster radius. Particles are sorted into grid cells as wide as a particle neighbourhood, so only the
+    particles in the 27 surrounding cells are compared. Once the particles are reordered by findMortonOrder
+    those cells hold runs of particles lying next to each other in the particle lists.
 
     clusterRadius:    The cluster radius is the domain of each particle, which 
                         permits particles within the domain if they are less than or equal to the 
                         value.
-    pSpherePos:    the coordinates of all particles in the system
+    positions:    list of x,y,z coordinates of every particle in the system
     particleRadius:    the radius of each particle within the system
-    pSpheres:    list containing instance names for each particle in system
-    return:    returns cluster group dictionary of the clusterGroup name and any neighbouring
-                particles within the domain of another particle will be within its clusterGroup.
-    '''
-    tmpGroup = {} # empty dictionary to hold key value pairs associating clusterGroups of particles within the radius of other particles
-    for p in range(len(pSpheresPos)):
-        name = 'clusterGroup' + str(p) # names the clusterGroup of each particle within the system
-        coordsList = [] # temporary list to store x,y,z coordinates of particles into clusterGroup
-        for j in range(p,len(pSpheresPos)):
-            changeJ = [pSpheresPos[j][0][l] - pSpheresPos[p][0][l] for l in range(3)]
+    active:    optional list of booleans marking which particles of a particle pool are in use. Unused particles
+               have no neighbours and are never a neighbour of another particle.
+    return:    a list within a list of the indices of the neighbours of each particle, which includes the
+               particle itself.
+    '''
+    cellSize = clusterRadius + 2*particleRadius
+    grid = buildSpatialGrid(positions, cellSize, active)
+    neighbours = [] # list of neighbour indices for every particle within the system
+    for p in range(len(positions)):
+        coordsList = [] # temporary list to store the indices of neighbouring particles
+        nearby = findNearbyParticles(positions[p], grid, cellSize) if active is None or active[p] else None
+        if not nearby:
+            neighbours.append(coordsList) # unused particles, or particles thrown out of any grid cell, have no neighbours
+            continue
+        nearby.sort()
+        split = bisect.bisect_left(nearby, p) # particles from this one onwards come first, as they did before the grid
+        for j in nearby[split:]:
+            changeJ = [positions[j][l] - positions[p][l] for l in range(3)]
             dist_j = m.sqrt(changeJ[0]**2 + changeJ[1]**2 + changeJ[2]**2)-2*particleRadius # use to calculate the magnitude of subsequent particles by subtracting the positions
             # of previous particles within the list to that particle           
             if dist_j <= clusterRadius:
-                coordsList.append(pSpheres[j][0]) # It will iterate through the positions of all particles, and if the distance between each neighbour particle to that particle is less than or equal to the cluster Radius, 
-                #it will add the instance name of that particle to a cluster group
-        for k in range(p):
-            changeK = [pSpheresPos[k][0][l] - pSpheresPos[p][0][l] for l in range(3)] # use to calculate the distance of particles behind the current particle in list iteration
+                coordsList.append(j) # It will iterate through the positions of all particles, and if the distance between each neighbour particle to that particle is less than or equal to the cluster Radius,
+                #it will add the index of that particle to its neighbours
+        for k in nearby[:split]:
+            changeK = [positions[k][l] - positions[p][l] for l in range(3)] # use to calculate the distance of particles behind the current particle in list iteration
             dist_k = m.sqrt(changeK[0]**2 + changeK[1]**2 + changeK[2]**2)-2*particleRadius
-            if dist_k <= clusterRadius: # if the magnitude of previous neighbour particles is less than or equal to the clusterRadius add the their instance name to the the particles clusterGroup
-                coordsList.append(pSpheres[k][0])  
-        tmpGroup[name] = coordsList 
-    return tmpGroup
-
-def findMatchingPairs(clusterGroup, pSpherePos):
-    '''
-        finds the matching particle position to clusterGroup particles
-
-        clusterGroup:    dictionary containing every particle and its neighbours within a close proximity to that particle
-                         i.e clusterGroup1:{[u'pSphere1],[u'pSphere7],u'pSphere13]...}
-                         clusterGroup2:{[u'pSphere2],[u'pSphere9],u'pSphere18]...}
-                                        ...
-        pSpherePos:    list containing position values of every particle in system
-        return:    if the clusterGroup key is equivalent to the particle number, return a list containing positions of particle instances
-                   corresponding to that number.
-    '''    
-   
-    objList = []
-    for key, val in clusterGroup.items():
-        for i in pSpherePos:
-            for j in i:
-                if j[12:] == key[12:]:
-                    obj = cmds.getAttr(j + '.translate')
-                    objList.append(obj)
-    return objList
-
-def findNeighbourPos(clusterGroup):
-    '''
-        finds the position of particles within each clusterGroup
-       
-        clusterGroup:    dictionary containing every particle and its neighbours within a close proximity to that particle
-        return:    a list within a list of coordinates indicating the position of each particles
-    '''            
-    nPos = [] # empty list to contain neighbour particle x,y,z coordinates in cluster group
-    for i in range(len(clusterGroup.items())):
-        tempDist = []
-        for j in range(len(clusterGroup.items()[i][1])):
-            obj = cmds.getAttr(clusterGroup.items()[i][1][j] + '.translate') # gets the translation coordinates of each generated particle in clusterGroup vicinity
-            tempDist.append(obj)
-        nPos.append(tempDist)
-    return nPos       
-
-def findDistanceBetweenP(pos, match):
+            if dist_k <= clusterRadius: # if the magnitude of previous neighbour particles is less than or equal to the clusterRadius add their index to the particles neighbours
+                coordsList.append(k)
+        neighbours.append(coordsList)
+    return neighbours
+
+def findDistanceBetweenP(positions, neighbours):
     '''
         finds the distance between particles and their neighbours
         
-        pos:     position of each particle in system
-        objL:    list of x,y,z positions of each particle in system
+        positions:     position of each particle in system
+        neighbours:    list of neighbour indices of each particle in system
         return:    returns a list of distance coordinates between particle and its neighbours        
     '''
     distances = [] #list containing x,y,z distances of each particle to its cluster particles
-    for i in range(len(pos)):
+    for i in range(len(neighbours)):
         tmp = []
-        for j in range(len(pos[i])):
-            dist = [pos[i][j][0][l] - match[i][0][l] for l in range(3)] # subtracts the distance position of each particle by its matching neighbours
+        for j in neighbours[i]:
+            dist = [positions[j][l] - positions[i][l] for l in range(3)] # subtracts the position of each particle from the position of its neighbours
             tmp.append(dist)#x,y,z coordinates of distances between particle to its neighbours
         distances.append(tmp)
     return distances
@@ -889,10 +1317,7 @@ def findMagnitude(pos):
     '''
         finds magnitude between cluster particles in dictionary
        
-        objList:    list to retain list of distance between particle and neighbour position
-        clusterGroupDist:    dictionary of key value, clusterGroup to coordinates of particles in clusterGroup
-        pSpherePos:    instance names of all particles in system
-        pList:    temporary list containing x,y,z coordinates of distance between particles and neighbours
+        pos:    list of list containing x,y,z coordinates of distance between particles and neighbours
         return:    list of list containing distance between each particle to its neighbours        
     '''
     distL = []
@@ -939,24 +1364,24 @@ def findPressure(mass,numParticles,mainRadius,initialD,massD,k):
         pressureL.append(k*(i-initialD)) # list using calculated pressure values for each particle in system
     return pressureL
             
-def findPressureForce(pressureL, massD, mass, clusterGroup, clusterRadius, positionV, magL):
+def findPressureForce(pressureL, massD, mass, neighbours, clusterRadius, positionV, magL):
     '''
         finds the pressure force between each particle and its neighbour
         
         pressureL:    list containing pressure fields of each particle
         mass:    average mass of each particle
         massD:    list of mass density field values of each particle
-        clusterGroup:    dictionary containing clusterGroups and particles within them
+        neighbours:    list of neighbour indices of each particle in system
         clusterRadius:    maximum radius for which a neighbouring particle is 
                           contained in that neighbourhood
-        positionV:    list containing positions of cluster particles in neighbourhood
+        positionV:    list containing the distances between each particle and its neighbours
         magL:    list of magnitudes for each particle in cluster neighbourhood     
     '''  
     pressureForceL = []   #empty list to contain coordinates of pressure force vector for each particle in system
     for i in range(len(positionV)):
         pressureF, pFx, pFy, pFz = 0, 0, 0, 0
         for j in range(len(positionV[i])):
-            index = int(clusterGroup.items()[i][1][j][12:]) # checks for the associated mass density and pressure coordinates associated to the particle name of each neighbour
+            index = neighbours[i][j] # checks for the associated mass density and pressure coordinates associated to each neighbour
             nPressure, nMass= pressureL[index], massD[index]  #indexing through the associated x,y,z mass densities and pressures of neighbours with that index 
             pressureF = mass*((pressureL[i]/massD[i]**2) + (nPressure/nMass**2))
             try:
@@ -964,7 +1389,7 @@ def findPressureForce(pressureL, massD, mass, clusterGroup, clusterRadius, posit
                 pFx += pressureF*spiky[0]
                 pFy += pressureF*spiky[1]
                 pFz += pressureF*spiky[2] #temporary variables holding x,y,z coordinates of the pressureForce multiplied by the spiky kernel for each particle in system           
-            except ZeroDivisionError: # if the particle has no neighbours, the initial position will be zero, and raises a ZeroDivisionError. Try and except is used to overcome that.
+            except ZeroDivisionError: # a particle is its own neighbour at a distance of zero, which raises a ZeroDivisionError. Try and except is used to overcome that.
                 pass
         pFx *= -mass
         pFy *= -mass
@@ -972,11 +1397,11 @@ def findPressureForce(pressureL, massD, mass, clusterGroup, clusterRadius, posit
         pressureForceL.append((pFx,pFy,pFz))
     return pressureForceL
 
-def findViscosityForce(clusterGroup, velL, massD, mass, viscosity, clusterRadius, magnitude):
+def findViscosityForce(neighbours, velL, massD, mass, viscosity, clusterRadius, magnitude):
     '''
         finds the viscosity force between particles in a cluster neighbourhood
         
-        clusterGroup:    dictionary containing key value pairs of particles and there neighbours
+        neighbours:    list of neighbour indices of each particle in system
         velL:    list of velocities of neighbouring particles in cluster group
         massD:    list of mass densities of particles in neighbourhood
         viscosity:    viscosity constant
@@ -986,17 +1411,16 @@ def findViscosityForce(clusterGroup, velL, massD, mass, viscosity, clusterRadius
         return:    a list within a list of viscosity vector fields affecting each particle       
     '''   
     viscosityF = []
-    for i in range(len(clusterGroup.items())):
+    for i in range(len(neighbours)):
         finalVisX, finalVisY, finalVisZ = 0, 0, 0 #initializing values for viscosity as zero
-        for j in range(len(clusterGroup.items()[i][1])):
+        for j in range(len(neighbours[i])):
             try:
-                index = int(clusterGroup.items()[i][1][j][12:]) #  finds the index of particle neighbours for each particle in the system.
-                if index < len(clusterGroup.items()):                    
-                    visF = [((velL[index][k] - velL[i][k])/ (massD[index]))*mass for k in range(3)] # variable the viscosity force acting between particles in the system
-                    visKernel = (45.0/(m.pi*clusterRadius**6))*(clusterRadius - magnitude[i][j]) # calculating the viscosity kernel acting on each particle in the system
-                    finalVisX += visF[0]*visKernel
-                    finalVisY += visF[1]*visKernel
-                    finalVisZ += visF[2]*visKernel # summation of viscosity force multipled by the viscosity kernel for each particle in each x,y,z direction
+                index = neighbours[i][j] #  finds the index of particle neighbours for each particle in the system.
+                visF = [((velL[index][k] - velL[i][k])/ (massD[index]))*mass for k in range(3)] # variable the viscosity force acting between particles in the system
+                visKernel = (45.0/(m.pi*clusterRadius**6))*(clusterRadius - magnitude[i][j]) # calculating the viscosity kernel acting on each particle in the system
+                finalVisX += visF[0]*visKernel
+                finalVisY += visF[1]*visKernel
+                finalVisZ += visF[2]*visKernel # summation of viscosity force multipled by the viscosity kernel for each particle in each x,y,z direction
             except ZeroDivisionError:
                 pass
         viscosityF.append((viscosity*finalVisX,viscosity*finalVisY,viscosity*finalVisZ))
@@ -1020,27 +1444,27 @@ def findBuoyancy(g, massD, mass, b, initialD, mainRadius, numSpheres):
     # finds the buoyancy force acting on each particle based on the average mass density and gravity acting on the system
     return bForce
     
-def findTractionF(mass,massD,mag,pos,clusterRadius,delta,clusterGroups):
+def findTractionF(mass,massD,mag,positions,clusterRadius,delta,neighbours):
     '''
         finds surface traction forces acting on particles interacting over collision surface.
         
         mass:    average mass of each particle
         massD:    list of mass densities of all particles system
         mag:    the magnitude of the distances between each particle and its neighbours
-        pos:    the position of each particle in the system
+        positions:    the position of each particle in the system
         clusterRadius:    maximum radius for which a neighbouring particle is 
                           contained in that neighbourhood    
         delta:    surface traction constant
-        clusterGroups:    dictionary containing key value pairs of particles and there neighbours
+        neighbours:    list of neighbour indices of each particle in system
         return:    creates a list within a list of traction force vector values
                     acting on each particle in the system
     '''
     tForce = []
-    for i in range(len(clusterGroups.items())):
+    for i in range(len(neighbours)):
         csX, csY, csZ, csLap, tmp = 0, 0, 0, 0, () # temporary values storing amounts to add normal forces by
-        for j in range(len(clusterGroups.items()[i][1])):
-            index = int(clusterGroups.items()[i][1][j][12:]) # finds the index of particle neighbours for each particle in the system. 
-            poly6KernelGrad = [(-945.0/(32*m.pi*clusterRadius**9))*(pos[i][j][0][k]*((clusterRadius**2-mag[i][j]**2)**2)) for k in range(3)] 
+        for j in range(len(neighbours[i])):
+            index = neighbours[i][j] # finds the index of particle neighbours for each particle in the system.
+            poly6KernelGrad = [(-945.0/(32*m.pi*clusterRadius**9))*(positions[index][k]*((clusterRadius**2-mag[i][j]**2)**2)) for k in range(3)]
             #implements the gradient of the poly6 kernel weighting function acting on each particle in system
             poly6KernelLap = (-945.0/(32*m.pi*clusterRadius**9))*((clusterRadius**2)-(mag[i][j]**2))*(3*(clusterRadius**2)-7*(mag[i][j]**2))
             #calculates the laplacian of the poly6 kernel weighting function acting on each particle in system
@@ -1050,13 +1474,13 @@ def findTractionF(mass,massD,mag,pos,clusterRadius,delta,clusterGroups):
             csLap += (mass/(massD[index]))*poly6KernelLap # using temporary normal force values in each dimension, add them to normal forces acting 
             # on each particle in the system
         nMag = m.sqrt(csX**2+csY**2+csZ**2) #  calculate the magnitude of normal forces
-        try:
-            normalized = -delta*csLap
-            tmp += (normalized*(csX/nMag),normalized*(csY/nMag),normalized*(csZ/nMag)) # adds the normal force coordinates to a tuple of all particles in
-            #the system
-            tForce.append(tmp)
-        except ZeroDivisionError:
-            pass # prevents ZeroDivisionErrors within the program
+        if nMag == 0:
+            tForce.append((0.0,0.0,0.0)) # particles without a surface normal, such as unused pool particles, receive no traction force
+            continue
+        normalized = -delta*csLap
+        tmp += (normalized*(csX/nMag),normalized*(csY/nMag),normalized*(csZ/nMag)) # adds the normal force coordinates to a tuple of all particles in
+        #the system. A normal that is not a number is passed on, so the health monitor stops the simulation
+        tForce.append(tmp)
     return tForce
 
 def findForces(pressureF, viscosityF,tractionF,bForce, mass, g):
@@ -1072,11 +1496,11 @@ def findForces(pressureF, viscosityF,tractionF,bForce, mass, g):
     forceA =  [[(mass*g[j]) + viscosityF[i][j] + pressureF[i][j] + tractionF[i][j] + bForce[i][j] for j in range(3)] for i in range(len(viscosityF))] # list of forces of each particle in x,y,z directions
     return forceA    
     
-def updateForce(mass,clusterGroups,clusterRadius,mainRadius,velL,mag,pos,dist,viscosity,g,b,k,delta,numSpheres,density,massD):
+def updateForce(mass,neighbours,clusterRadius,mainRadius,velL,mag,positions,dist,viscosity,g,b,k,delta,numSpheres,density,massD):
     '''
         updates forces based on particles in system and constant physical properties
         
-        pSpheres:    list containing instances of all particles in system
+        neighbours:    list of neighbour indices of each particle in system
         mainRadius:    size of the particle system
         clusterRadius:    radius for which particle will influence its neighbours
         mass:    mass of each particle
@@ -1086,133 +1510,4282 @@ def updateForce(mass,clusterGroups,clusterRadius,mainRadius,velL,mag,pos,dist,vi
         return:    a list of coordinates retaining the force acting on each particle x,y,z coordinates                        
     '''    
     pressure = findPressure(mass,numSpheres,mainRadius,density,massD,k) # pressure field coordinates for each particle in the cluster group
-    pForce = findPressureForce(pressure, massD, mass, clusterGroups, clusterRadius, dist, mag) # finds the pressure force of each particle in the system
-    visForce = findViscosityForce(clusterGroups, velL, massD, mass, viscosity, clusterRadius, mag) # finds viscosity of each particle
-    tractionF = findTractionF(mass,massD,mag,pos,clusterRadius,delta,clusterGroups) # finds the surface traction force for each particle in the system
+    pForce = findPressureForce(pressure, massD, mass, neighbours, clusterRadius, dist, mag) # finds the pressure force of each particle in the system
+    visForce = findViscosityForce(neighbours, velL, massD, mass, viscosity, clusterRadius, mag) # finds viscosity of each particle
+    tractionF = findTractionF(mass,massD,mag,positions,clusterRadius,delta,neighbours) # finds the surface traction force for each particle in the system
     bForce = findBuoyancy(g, massD, mass, b, density, mainRadius, numSpheres) #  finds the buoyancy force of each particle in the system
     allF = findForces(pForce,visForce,tractionF,bForce,mass,g) # calculates the sum of all forces acting on each particle in the system    
     return allF
     
-def calXSPHVel(velL, clusterRadius, mass, massD, mag, clusterGroups): 
+def findXSPHCorrection(clusterRadius, mass, massD, mag, neighbours):
     '''
-        calculate XSPH velocity correction for each particle
-        velL:    the velocity vector of each particle  
+        calculate the XSPH velocity correction for each particle, which is added to every velocity component when
+        particles are moved
         clusterRadius:   radius for which particle will influence its neighbours 
         mass:    average mass of each particle    
         massD:    list of mass densities of all particles system    
         mag:    the magnitude of the distances between each particle and its neighbours
-        clusterGroups:    dictionary containing key value pairs of particles and there neighbours    
-        return:    returns a list within a list of the velocities of each particle in the system
-    '''
-    newVel = []
-    for i in range(len(clusterGroups.items())):
-        XSPH, tmp = 0, [] # temporary veriables to hold updated XSPH velocity positions of each particle
-        for j in range(len(clusterGroups.items()[i][1])):
-            index = int(clusterGroups.items()[i][1][j][12:]) # finds the index of particle neighbours for each particle in the system. 
+        neighbours:    list of neighbour indices of each particle in system
+        return:    returns a list of the XSPH velocity correction of each particle in the system
+    '''
+    corrections = []
+    for i in range(len(neighbours)):
+        XSPH = 0 # temporary veriable to hold the XSPH velocity correction of each particle
+        for j in range(len(neighbours[i])):
+            index = neighbours[i][j] # finds the index of particle neighbours for each particle in the system.
             wKernel =  (315/(64*m.pi*clusterRadius**9))*(clusterRadius**2 - mag[i][j]**2)**3 
             XSPH += 2*mass/(massD[i]+massD[index])*wKernel # summation of XSPH velocities for each particle in the system
-        tmp.append((velL[i][0] + 0.1*XSPH,velL[i][1] + 0.1*XSPH,velL[i][2] + 0.1*XSPH))
-        newVel.append(tmp) #adds the updated velocities from tmp list to a final list of particle velocities
-    return newVel
+        corrections.append(0.1*XSPH)
+    return corrections
                     
-def animateFluid(widgets, pSpheres, numSpheres):
+def findGridCell(pos, cellSize):
     '''
-        animates the fluid based on user entered values
+        finds the integer coordinates of the spatial grid cell containing a particle
         
-        widgets:    dictionary containing user controlled parameter values
-        pSpheres:    list of all particle instances in the system
-        numSpheres:    number of particles in the system.
-    '''  
-    
-    g = widgets['Gravity'][0]
-    clusterRadius = widgets['Cluster Radius']
-    radius = widgets['Particle Radius']
-    mainRadius = widgets['Spawn Radius']
-    tankSize = 0.6
-    mass = widgets['Mass']
-    delta = widgets['Delta']
-    density = widgets['Density']
-    vis = widgets['Viscosity']
-    b = widgets['Buoyancy'] 
-    k = widgets['Stiffness'] 
-    ratioOfLossOfSpeed = widgets['RLOS'] 
-    velC = [widgets['Initial Velocity'][0]for k in range(numSpheres)] #sets the values of each user controlled parameter by passing in values from widgets dictionary
-    initialPos = [[0.65,5.0,0.9] for k in range(numSpheres)]   
-    frameInt = widgets['Time Difference']    
-    amount,pro = 0, 0    
-    cmds.progressWindow(	title='Fluid Simulation',
-    					progress=amount,
-    					status='Simulating: 0%',
-    
-    					isInterruptable=True, maxValue=widgets['No. of Frames']) # creates a progress window to show current frames of the simulation
-				
-    for i in range(1,widgets['No. of Frames']):
-        
-        pDist = findPos(pSpheres) # finds the coordinates of each particle         
-        clusterGroups = findNeighbour(clusterRadius,pDist,pSpheres, radius) # creates a dictionary holding the particle cluster group as key and its associated particle neighbours
-        pos = findNeighbourPos(clusterGroups) # finds the coordinates of each clusterNeighbour particle in the clusterGroup dictionary
-        match = findMatchingPairs(clusterGroups,pSpheres) # compares clusterGroup name and particle names and returns the particle name associated to that cluster Group
-        dist  = findDistanceBetweenP(pos,match) # finds the distance between the particle and its neighbours
-        mag = findMagnitude(dist) # finds the magnitude of the distance between particles and their neighbours
-        massD = massDensity(mass,clusterRadius,mainRadius, mag, density,numSpheres) # mass density of each particle in the clusterGroup        
-        forces = updateForce(mass,clusterGroups,clusterRadius,mainRadius,velC,mag,pos,dist,vis,g,b,k,delta,numSpheres,density, massD) # updates the forces acting on each particle every frame                                         
-        velC = [[velC[j][l] + frameInt*forces[j][l]/mass for l in range(3)] for j in range(numSpheres)] # calculates the forces influencing the velocity of each particle every frame
-        XSPH = calXSPHVel(velC, clusterRadius, mass, massD, mag, clusterGroups)
-        
-        if i==1:
-            posC = [[initialPos[j][l] + (pDist[j][0][l] + frameInt*(XSPH[j][0][l] + frameInt*(forces[j][l]/mass))) for l in range(3)] for j in range(numSpheres)]  # calculates the position of each particle every frame using calculated velocities and initial positions
-        else:
-            posC = [[(pDist[j][0][l] + frameInt*(XSPH[j][0][l] + frameInt*(forces[j][l]/mass))) for l in range(3)] for j in range(numSpheres)] # calculates the position of each particle every frame using calculated velocities         
-        for k in range(len(posC)):
-            
-            if posC[k][0]<-tankSize:
-                posC[k][0] = -tankSize+((-tankSize)-posC[k][0])
-                velC[k][0] = -ratioOfLossOfSpeed*velC[k][0]
-            if posC[k][0]>tankSize:
-                posC[k][0] = -(posC[k][0]-tankSize)+tankSize
-                velC[k][0] = -ratioOfLossOfSpeed*velC[k][0]
-            if posC[k][1]<-tankSize:
-                posC[k][1] = -tankSize+((-tankSize)-posC[k][1])
-                velC[k][1] = -ratioOfLossOfSpeed*velC[k][1]
-            if posC[k][2]<-tankSize:
-                posC[k][2] = -tankSize+((-tankSize)-posC[k][2])
-                velC[k][2] = -ratioOfLossOfSpeed*velC[k][2]
-            if posC[k][2]>tankSize:
-                posC[k][2] = -(posC[k][2]-tankSize  )+ tankSize 
-                velC[k][2] = -ratioOfLossOfSpeed*velC[k][2]       # handles the collision between particle positions and the container                                 
-                
-            cmds.setKeyframe(pSpheres[k][0], attribute="tx", v=posC[k][0], t=[i], inTangentType="linear", outTangentType="linear")
-            cmds.setKeyframe(pSpheres[k][0], attribute="ty", v=posC[k][1], t=[i], inTangentType="linear", outTangentType="linear")
-            cmds.setKeyframe(pSpheres[k][0], attribute="tz", v=posC[k][2], t=[i], inTangentType="linear", outTangentType="linear") #animates the x,y,z positions of each particle every frame
-            cmds.move(posC[k][0],posC[k][1],posC[k][2],pSpheres[k][0])
-            
-        cmds.refresh(f=True)            
+        pos:    x,y,z coordinates of the particle
+        cellSize:    width of each grid cell, this should be at least the width of a particle neighbourhood
+        return:    tuple of the x,y,z cell coordinates
+    '''
+    return (int(m.floor(pos[0]/cellSize)), int(m.floor(pos[1]/cellSize)), int(m.floor(pos[2]/cellSize)))
+
+def spreadBits(n):
+    '''
+        spreads the lower 21 bits of an integer so that two zero bits sit between every bit, ready to be 
+        interleaved with two other spread integers.
+    '''
+    n &= 0x1fffff
+    n = (n | (n << 32)) & 0x1f00000000ffff
+    n = (n | (n << 16)) & 0x1f0000ff0000ff
+    n = (n | (n << 8)) & 0x100f00f00f00f00f
+    n = (n | (n << 4)) & 0x10c30c30c30c30c3
+    n = (n | (n << 2)) & 0x1249249249249249
+    return n
+
+def findMortonCode(cell):
+    '''
+        finds the Z-order (Morton) code of a grid cell by interleaving the bits of its x,y,z coordinates. Cells that
+        are close in space end up with close codes, so sorting by the code keeps neighbours close in memory.
         
-        startTime = time.time()	
+        cell:    tuple of non-negative x,y,z cell coordinates
+        return:    integer Morton code of the cell
+    '''
+    return spreadBits(cell[0]) | (spreadBits(cell[1]) << 1) | (spreadBits(cell[2]) << 2)
+
+def findMortonOrder(positions, cellSize):
+    '''
+        finds the order in which particles should be stored so that they are sorted by the Morton code of their grid cell
         
-        # Check if the dialog has been cancelled
-        if cmds.progressWindow( query=True, isCancelled=True ) :
-            print 'Simulation terminated.'
-            break
-    
-        # Check if end condition has been reached
-        if cmds.progressWindow( query=True, progress=True ) >= widgets['No. of Frames'] :
-            print 'Simulation successfully executed.'
-            break
-    
-        amount += 1
+        positions:    list of x,y,z coordinates of every particle in system
+        cellSize:    width of each grid cell
+        return:    list of current particle indices in their new order, i.e order[newIndex] = oldIndex
+    '''
+    cells = [findGridCell(pos, cellSize) for pos in positions]
+    if len(cells)==0:
+        return []
+    minCell = [min([c[l] for c in cells]) for l in range(3)] # offsets the cells so that all cell coordinates are positive before interleaving
+    codes = [findMortonCode([c[l] - minCell[l] for l in range(3)]) for c in cells]
+    return sorted(range(len(codes)), key=lambda i: codes[i]) # sorted is stable so particles within the same cell keep their relative order
 
-        newTime = time.time() - startTime
-        cmds.progressWindow( edit=True, progress=amount, status=('Frame: ' + `amount` ) )
-        cmds.pause( seconds=newTime )
-    
-    cmds.progressWindow(endProgress=1)        
-                
-if __name__=='__main__':
-    import maya.cmds as cmds
-    import math as m
-    import random as rd
-    import sys
-    import re
-    import time
-    createUI()      
\ No newline at end of file
+def reorderParticles(order, *particleLists):
+    '''
+        permutes every per-particle list by the same order so that all lists stay consistent with each other
+        
+        order:    list of current particle indices in their new order
+        particleLists:    any number of lists holding one entry per particle, e.g instance names, positions and velocities
+        return:    a list of the reordered lists in the order they were given
+    '''
+    return [[pList[i] for i in order] for pList in particleLists]
+
+SOLVER_STAGES = ['findNeighbours', 'findDensity', 'findForces', 'findXSPH', 'solveViscosity', 'integrate', 'collide']
+# stages run by every backend for each frame, in order. Each stage reads and updates the solver state dictionary
+BACKEND_PREFERENCE = ['Numba', 'NumPy', 'Python'] # backends from fastest to slowest, the first one that can run is chosen automatically
+VISCOSITY_SOLVERS = ['Auto', 'Explicit', 'Implicit'] # Auto solves the viscosity implicitly for liquids at least as viscous as IMPLICIT_VISCOSITY
+IMPLICIT_VISCOSITY = 5.0 # viscosity above which the explicit viscosity force needs smaller time steps than water, e.g the coffee preset
+VISCOSITY_TOLERANCE = 1e-6 # residual of the implicit viscosity solve, relative to the largest velocity, at which conjugate gradient stops
+VISCOSITY_ITERATIONS = 100 # most conjugate gradient iterations of one implicit viscosity solve
+DEFAULT_PARAMS = {'Density': 998.2, 'Mass': 0.1, 'Viscosity': 3.5, 'Viscosity Solver': 'Auto', 'Stiffness': 3.0, 'Delta': 0.0728, 'Buoyancy': 0.0, 'RLOS': 0.1,
+                  'Particle Radius': 0.08, 'Cluster Radius': 0.35, 'Spawn Radius': 1.5, 'Gravity': [(0.0, -9.8, 0.0)],
+                  'Initial Velocity': [(0.0, 0.1, 0.0)], 'Time Difference': 0.01} # the default values of the UI, used by the command line tools
+
+def findSolverSettings(params):
+    '''
+        gathers the constant values used by the solver stages
+
+        params:    dictionary containing values for each user specified parameter
+        return:    dictionary of the solver constants. With an implicit viscosity solve the viscosity of the force stage is 0
+                   and implicitViscosity holds the viscosity instead
+    '''
+    solver = params.get('Viscosity Solver', 'Explicit')
+    implicit = solver == 'Implicit' or (solver == 'Auto' and params['Viscosity'] >= IMPLICIT_VISCOSITY)
+    return {'clusterRadius': params['Cluster Radius'], 'particleRadius': params['Particle Radius'], 'spawnRadius': params['Spawn Radius'],
+            'mass': params['Mass'], 'density': params['Density'], 'viscosity': 0.0 if implicit else params['Viscosity'],
+            'implicitViscosity': params['Viscosity'] if implicit else 0.0, 'stiffness': params['Stiffness'],
+            'delta': params['Delta'], 'buoyancy': params['Buoyancy'], 'gravity': list(params['Gravity'][0]), 'rlos': params['RLOS'],
+            'tankSize': 0.6, 'timeStep': params['Time Difference'], 'halfPairs': params.get('Half Pairs', True),
+            'maxNeighbours': params.get('Max Neighbours', 0)}
+
+def createSolverState(backend, positions, velocities, active=None):
+    '''
+        creates the state which is passed through the solver stages, holding every per-particle value in the format
+        of the backend
+
+        backend:    dictionary from BACKENDS
+        positions:    list of x,y,z coordinates of every particle
+        velocities:    list of x,y,z velocities of every particle
+        active:    optional list of booleans marking which particles of a particle pool are in use
+        return:    dictionary of the solver state. The level of every particle is None unless particles of adaptive
+                   resolution are split, see adaptResolution
+    '''
+    return {'position': backend['fromVectors'](positions), 'velocity': backend['fromVectors'](velocities),
+            'active': None if active is None else backend['fromMask'](active), 'offset': None, 'level': None}
+
+def permuteSolverState(backend, state, order):
+    '''
+        reorders the per-particle values of the solver state along with the other per-particle lists
+
+        backend:    dictionary from BACKENDS
+        state:    dictionary from createSolverState
+        order:    list of current particle indices in their new order
+    '''
+    for name in ['position', 'velocity', 'active', 'level']:
+        if state.get(name) is not None:
+            state[name] = backend['permute'](state[name], order)
+
+def stepFluid(backend, state, settings, stages=SOLVER_STAGES):
+    '''
+        advances the solver state by one frame
+
+        backend:    dictionary from BACKENDS
+        state:    dictionary from createSolverState, the offset entry is added to the positions of particles during
+                  this step only
+        settings:    dictionary from findSolverSettings
+        stages:    optional list of the stages to run, so a step can be paused between stages
+    '''
+    implementations = backend['halfStages' if settings.get('halfPairs') else 'stages'] # half pair lists visit each pair of neighbours once
+    for stage in stages:
+        implementations[stage](state, settings)
+
+def readFrame(backend, state):
+    '''
+        reads the per-particle values of a frame out of the solver state
+
+        backend:    dictionary from BACKENDS
+        state:    dictionary from createSolverState after a step
+        return:    dictionary of lists of the position, velocity, density and pressure of every particle, and the motion,
+                   which is the velocity plus the XSPH correction the particles are moved with
+    '''
+    frame = {'position': backend['toVectors'](state['position']), 'velocity': backend['toVectors'](state['velocity']),
+             'density': backend['toScalars'](state['density']), 'pressure': backend['toScalars'](state['pressure'])}
+    xsph = backend['toScalars'](state['xsph']) if 'xsph' in state else [0.0]*len(frame['velocity'])
+    frame['motion'] = [[v + x for v in vel] for vel, x in zip(frame['velocity'], xsph)]
+    return frame
+
+def interpolateFrames(start, end, span, duration):
+    '''
+        fills in the frames between two solved frames with cubic Hermite curves through the positions and motion of
+        each particle. The error of each particle is estimated as the distance between the Hermite curve and the
+        quadratic through the start position, start motion and end position halfway along, which is zero for particles
+        under constant acceleration and large for particles that bounced off the container.
+
+        start:    frame dictionary from readFrame at the start of the step
+        end:    frame dictionary from readFrame at the end of the step
+        span:    number of frames the step covers
+        duration:    time the step covers
+        return:    list of the span-1 frame dictionaries in between, and a list of the error estimate of every particle
+    '''
+    frames = []
+    for f in range(1, span):
+        s = float(f)/span
+        h00, h10, h01, h11 = 2*s**3 - 3*s**2 + 1, s**3 - 2*s**2 + s, -2*s**3 + 3*s**2, s**3 - s**2 # Hermite basis functions
+        d00, d10, d01, d11 = 6*s**2 - 6*s, 3*s**2 - 4*s + 1, -6*s**2 + 6*s, 3*s**2 - 2*s # and their derivatives
+        position, velocity = [], []
+        for p0, v0, p1, v1 in zip(start['position'], start['motion'], end['position'], end['motion']):
+            position.append([h00*p0[l] + h10*duration*v0[l] + h01*p1[l] + h11*duration*v1[l] for l in range(3)])
+            velocity.append([(d00*p0[l] + d01*p1[l])/duration + d10*v0[l] + d11*v1[l] for l in range(3)])
+        frames.append({'position': position, 'velocity': velocity, 'motion': velocity,
+                       'density': [a + s*(b - a) for a, b in zip(start['density'], end['density'])],
+                       'pressure': [a + s*(b - a) for a, b in zip(start['pressure'], end['pressure'])]})
+    errors = [0.25*duration*max([abs((p1[l] - p0[l])/duration - 0.5*(v0[l] + v1[l])) for l in range(3)])
+              for p0, v0, p1, v1 in zip(start['position'], start['motion'], end['position'], end['motion'])]
+    return frames, errors
+
+def solveFrames(backend, state, settings, span=1, tolerance=0.01, monitor=None):
+    '''
+        advances the solver state by a number of frames. Several frames are solved as one coarse step and the frames
+        in between are interpolated, unless the interpolation error of any particle is above the tolerance, in which
+        case the step is thrown away and every frame is solved. The particles interact, so one inaccurate particle
+        means solving every particle again.
+
+        backend:    dictionary from BACKENDS
+        state:    dictionary from createSolverState
+        settings:    dictionary from findSolverSettings
+        span:    number of frames to advance
+        tolerance:    largest interpolation error allowed for any particle
+        monitor:    optional dictionary from createHealthMonitor checking every step, a coarse step breaking a health limit
+                    is solved frame by frame
+        return:    list of frame dictionaries from readFrame, one for each frame, and whether the coarse step was kept
+    '''
+    if span == 1:
+        stepMonitored(backend, state, settings, monitor)
+        return [readFrame(backend, state)], True
+    if 'density' not in state:
+        stepFluid(backend, state, settings, SOLVER_STAGES[:4]) # a state resumed from the cache has no densities or XSPH correction yet
+    start, saved = readFrame(backend, state), (state['position'], state['velocity'])
+    state['position'], state['velocity'] = [backend['fromVectors'](backend['toVectors'](state[name])) for name in ['position', 'velocity']]
+    coarse = dict(settings, timeStep=span*settings['timeStep'])
+    stepFluid(backend, state, coarse)
+    end = readFrame(backend, state)
+    between, errors = interpolateFrames(start, end, span, span*settings['timeStep'])
+    kept = max(errors or [0.0]) <= tolerance
+    if kept and monitor and monitor['action'] != 'Off':
+        kept = checkHealth(backend, state, coarse, monitor) is None
+    if kept:
+        return between + [end], True
+    state['position'], state['velocity'] = saved
+    frames = []
+    for step in range(span):
+        stepMonitored(backend, state, settings, monitor)
+        frames.append(readFrame(backend, state))
+    return frames, False
+
+HEALTH_ACTIONS = ['Rollback', 'Abort', 'Off'] # what the health monitor does when a step breaks one of the health limits
+HEALTH_CFL = 1.0 # furthest a particle may move in one step, in cluster radii, before it skips over whole neighbourhoods
+HEALTH_COMPRESSION = 4.0 # most the densest particle may be compressed in one step, or beyond particles packed touching each other
+HEALTH_ENERGY_GROWTH = 4.0 # most the kinetic energy may grow in one step, relative to what gravity alone could have added
+HEALTH_QUIET_SPEED = 0.1 # fraction of the CFL speed limit below which a growing kinetic energy is not a concern
+HEALTH_SUBSTEPS = 8 # most substeps a step is split into before the simulation is aborted
+
+def createHealthMonitor(action='Rollback', substeps=1):
+    '''
+        creates the health monitor which checks the fluid after every step of the solver
+
+        action:    one of HEALTH_ACTIONS
+        substeps:    number of substeps every step is split into to begin with, e.g from the snapshot a simulation carries
+                     on from
+        return:    dictionary of the monitor, holding the measure after the last healthy step, the number of substeps
+                   every step is split into, the number of steps rolled back and the frame being solved
+    '''
+    return {'action': action, 'health': None, 'substeps': substeps, 'rollbacks': 0, 'frame': None, 'packed': (None, None)}
+
+def findHealthProblem(health, previous, settings, packedDensity):
+    '''
+        compares the measure of the fluid after a step against the health limits. Values which are no longer numbers,
+        particles moving more than a cluster radius per step, particles crushed together in one step far beyond close
+        packing, and kinetic energy growing faster than gravity can explain all mean the solver is diverging.
+
+        health:    dictionary from the measureHealth function of the backend
+        previous:    the measure after the last healthy step, or None on the first step
+        settings:    dictionary from findSolverSettings, holding the time step of the step measured
+        packedDensity:    density of a particle among neighbours packed touching each other
+        return:    message describing the first limit broken, or None if the fluid is healthy
+    '''
+    dt, h, mass = settings['timeStep'], settings['clusterRadius'], settings['mass']
+    if not health['finite']:
+        return 'a position, velocity or density is no longer a number'
+    if health['speed']*dt > HEALTH_CFL*h:
+        return 'the fastest particle moves %.2f cluster radii in one step, the limit is %.2f' % (health['speed']*dt/h, HEALTH_CFL)
+    if previous and health['density'] > HEALTH_COMPRESSION*max(packedDensity, previous['density']): # particles may be spawned closer than packed
+        return 'the densest particle is %.1f times as dense as after the step before, the limit is %.1f' % (health['density']/previous['density'], HEALTH_COMPRESSION)
+    if previous and previous['count'] and health['count']:
+        gain = m.sqrt(sum([g*g for g in settings['gravity']]))*dt # most speed gravity alone adds to a particle in one step
+        count = float(previous['count'])
+        before = 0.5*mass*previous['speedSquares']/count # kinetic energies per particle, so emitted particles do not count as growth
+        allowed = 0.5*mass*(previous['speedSquares'] + 2*gain*previous['speedSum'])/count + 0.5*mass*gain*gain
+        energy = 0.5*mass*health['speedSquares']/health['count']
+        if energy > HEALTH_ENERGY_GROWTH*allowed + 0.5*mass*(HEALTH_QUIET_SPEED*HEALTH_CFL*h/dt)**2:
+            return 'the kinetic energy per particle grew from %.3g to %.3g in one step' % (before, energy)
+    return None
+
+def checkHealth(backend, state, settings, monitor):
+    '''
+        measures the fluid after a step and compares it against the health limits, keeping the measure as the
+        reference of the next step when the fluid is healthy
+
+        backend:    dictionary from BACKENDS
+        state:    dictionary from createSolverState after a step
+        settings:    dictionary from findSolverSettings, holding the time step of the step measured
+        monitor:    dictionary from createHealthMonitor
+        return:    message describing the first limit broken, or None if the fluid is healthy
+    '''
+    if monitor['packed'][0] != settings['clusterRadius']: # the cluster radius may be chosen again as the fluid settles
+        monitor['packed'] = (settings['clusterRadius'], settings['density']*findSettledNeighbours(settings))
+    health = backend['measureHealth'](state, settings)
+    problem = findHealthProblem(health, monitor['health'], settings, monitor['packed'][1])
+    if problem is None:
+        monitor['health'] = health
+    return problem
+
+def stepMonitored(backend, state, settings, monitor=None):
+    '''
+        advances the solver state by one step like stepFluid and checks the health of the fluid afterwards. A step
+        breaking a health limit is thrown away and solved again split into twice as many substeps, which later steps
+        keep. Once a step still breaks a limit split into HEALTH_SUBSTEPS substeps, or straight away with the Abort
+        action, the simulation is aborted, so a diverging simulation stops within seconds instead of solving every
+        frame.
+
+        backend:    dictionary from BACKENDS
+        state:    dictionary from createSolverState
+        settings:    dictionary from findSolverSettings
+        monitor:    dictionary from createHealthMonitor, or None to step without checking
+        return:    raises a FloatingPointError describing the broken limit when the simulation is aborted
+    '''
+    if monitor is None or monitor['action'] == 'Off':
+        stepFluid(backend, state, settings)
+        return
+    saved, offset, health = [backend['copy'](state[name]) for name in ['position', 'velocity']], state['offset'], monitor['health']
+    while True:
+        substeps = monitor['substeps']
+        subSettings = dict(settings, timeStep=settings['timeStep']/substeps)
+        for step in range(substeps):
+            stepFluid(backend, state, subSettings)
+            state['offset'] = None # the offset only moves the particles in the first substep
+            problem = checkHealth(backend, state, subSettings, monitor)
+            if problem:
+                break
+        state['offset'] = offset
+        if problem is None:
+            return
+        if monitor['action'] == 'Abort' or substeps >= HEALTH_SUBSTEPS:
+            raise FloatingPointError('The simulation diverged%s: %s%s.' % (' on frame %d' % monitor['frame'] if monitor['frame'] else '', problem,
+                                                                          ' even split into %d substeps' % substeps if substeps > 1 else ''))
+        state['position'], state['velocity'] = [backend['copy'](values) for values in saved] # the step starts again from where the particles were before it
+        monitor['health'], monitor['substeps'], monitor['rollbacks'] = health, 2*substeps, monitor['rollbacks'] + 1
+
+def pythonNeighbours(state, settings):
+    state['neighbourScale'] = None
+    if settings.get('maxNeighbours'):
+        nearest, found = findNearestNeighbours(settings['clusterRadius'], state['position'], settings['particleRadius'], settings['maxNeighbours'], state['active'])
+        state['neighbours'], state['neighbourScale'], state['neighbourCap'] = capNeighbours(nearest, found, settings['maxNeighbours'])
+    else:
+        state['neighbours'] = findNeighbour(settings['clusterRadius'], state['position'], settings['particleRadius'], state['active'])
+    state['distance'] = findDistanceBetweenP(state['position'], state['neighbours']) # finds the distance between the particle and its neighbours
+    state['magnitude'] = findMagnitude(state['distance']) # finds the magnitude of the distance between particles and their neighbours
+
+def pythonDensity(state, settings):
+    s = settings
+    state['density'] = massDensity(s['mass'], s['clusterRadius'], s['spawnRadius'], state['magnitude'], s['density'], len(state['position']))
+    if state.get('neighbourScale') is not None:
+        state['density'] = [d*scale for d, scale in zip(state['density'], state['neighbourScale'])]
+    state['pressure'] = findPressure(s['mass'], len(state['position']), s['spawnRadius'], s['density'], state['density'], s['stiffness'])
+
+def pythonForces(state, settings):
+    s = settings
+    state['forces'] = updateForce(s['mass'], state['neighbours'], s['clusterRadius'], s['spawnRadius'], state['velocity'], state['magnitude'],
+                                  state['position'], state['distance'], s['viscosity'], s['gravity'], s['buoyancy'], s['stiffness'], s['delta'],
+                                  len(state['position']), s['density'], state['density'])
+
+def pythonXSPH(state, settings):
+    state['xsph'] = findXSPHCorrection(settings['clusterRadius'], settings['mass'], state['density'], state['magnitude'], state['neighbours'])
+
+def findViscosityPairs(state, settings):
+    '''
+        finds the pairs of neighbouring particles of the python backend for the implicit viscosity solve, once each
+
+        state:    dictionary from createSolverState, after the neighbour and density stages
+        settings:    dictionary from findSolverSettings
+        return:    lists of the first particle, second particle and velocity coupling of every pair, where the coupling
+                   times the time step and viscosity is how much of their velocity difference the pair evens out
+    '''
+    h, rho = settings['clusterRadius'], state['density']
+    if settings.get('halfPairs'):
+        I, J, D, mag = state['halfPairs']
+        pairs = [(i, j, r) for i, j, r in zip(I, J, mag) if i != j]
+    else:
+        pairs = [(i, j, r) for i in range(len(state['neighbours'])) for j, r in zip(state['neighbours'][i], state['magnitude'][i]) if i < j]
+    spikyC = 45.0/(m.pi*h**6)
+    return [i for i, j, r in pairs], [j for i, j, r in pairs], [spikyC*max(h - r, 0.0)*2/(rho[i] + rho[j]) for i, j, r in pairs]
+    # the viscosity kernel divided by the mean density of the pair, so the coupling is the same from both sides
+
+def pythonSolveViscosity(state, settings):
+    '''
+        applies the viscosity implicitly by solving for the velocities at the end of the step, which stays stable at
+        time steps where the explicit viscosity force blows up. Each particle's new velocity minus the viscous
+        exchange with its neighbours at the new velocities must equal its velocity after the other forces. The system
+        is solved for each axis by conjugate gradient without building the matrix, starting from the velocities after
+        the other forces so a step only depends on the state it starts from, and snapshots re-simulate exactly. The
+        change in velocity is added to the forces as the viscosity force.
+    '''
+    nu = settings['implicitViscosity']
+    if not nu:
+        return
+    dt, mass, n = settings['timeStep'], settings['mass'], len(state['position'])
+    I, J, coupling = findViscosityPairs(state, settings)
+    coupling = [dt*nu*c for c in coupling]
+    change, iterations = [], 0
+    target = [[state['velocity'][j][l] + dt*state['forces'][j][l]/mass for j in range(n)] for l in range(3)] # velocity after every force but viscosity
+    limit = (VISCOSITY_TOLERANCE*max([abs(v) for b in target for v in b] + [1e-12]))**2*n
+    def apply(x):
+        y = list(x)
+        for i, j, c in zip(I, J, coupling):
+            exchange = c*(x[i] - x[j])
+            y[i] += exchange
+            y[j] -= exchange
+        return y
+    for b in target:
+        x = list(b)
+        r = [bj - yj for bj, yj in zip(b, apply(x))]
+        p, rr = list(r), sum([v*v for v in r])
+        for iteration in range(VISCOSITY_ITERATIONS):
+            if rr <= limit:
+                break
+            Ap = apply(p)
+            alpha = rr/sum([pj*aj for pj, aj in zip(p, Ap)])
+            x = [xj + alpha*pj for xj, pj in zip(x, p)]
+            r = [rj - alpha*aj for rj, aj in zip(r, Ap)]
+            rrNew = sum([v*v for v in r])
+            p = [rj + (rrNew/rr)*pj for rj, pj in zip(r, p)]
+            rr = rrNew
+        iterations = max(iterations, iteration)
+        change.append([xj - bj for xj, bj in zip(x, b)])
+    state['forces'] = [[state['forces'][j][l] + mass*change[l][j]/dt for l in range(3)] for j in range(n)]
+    state['viscosityIterations'] = iterations
+
+def pythonIntegrate(state, settings):
+    dt, mass, forces, active = settings['timeStep'], settings['mass'], state['forces'], state['active']
+    offset = state['offset'] or [0.0, 0.0, 0.0]
+    for j in range(len(state['position'])):
+        if active is not None and not active[j]:
+            continue # unused pool particles stay where they are
+        acceleration = [dt*forces[j][l]/mass for l in range(3)]
+        state['velocity'][j] = [state['velocity'][j][l] + acceleration[l] for l in range(3)] # calculates the forces influencing the velocity of each particle every frame
+        state['position'][j] = [offset[l] + state['position'][j][l] + dt*(state['velocity'][j][l] + state['xsph'][j] + acceleration[l]) for l in range(3)]
+        # calculates the position of each particle every frame using the XSPH corrected velocities
+
+def pythonCollide(state, settings):
+    tankSize, rlos, active = settings['tankSize'], settings['rlos'], state['active']
+    for k in range(len(state['position'])):
+        pos, vel = state['position'][k], state['velocity'][k]
+        if active is not None and not active[k]:
+            state['velocity'][k] = [0.0, 0.0, 0.0]
+            continue
+        for l, upper in [(0, True), (1, False), (2, True)]: # the container is open at the top
+            if pos[l] < -tankSize:
+                pos[l] = -tankSize+((-tankSize)-pos[l])
+                vel[l] = -rlos*vel[l]
+            if upper and pos[l] > tankSize:
+                pos[l] = -(pos[l]-tankSize)+tankSize
+                vel[l] = -rlos*vel[l] # handles the collision between particle positions and the container
+
+def pythonHealth(state, settings):
+    '''
+        measures the particles in use for the health monitor
+
+        state:    dictionary from createSolverState after a step
+        settings:    dictionary from findSolverSettings
+        return:    dictionary of whether every position, velocity and density is a number, the number of particles, the
+                   largest speed, the sum of the speeds and of their squares, and the largest density
+    '''
+    active = state['active']
+    used = [j for j in range(len(state['position'])) if active is None or active[j]]
+    values = [value for j in used for value in state['position'][j] + state['velocity'][j] + [state['density'][j]]]
+    speeds = [m.sqrt(sum([v*v for v in state['velocity'][j]])) for j in used]
+    return {'finite': not any([m.isinf(value) or m.isnan(value) for value in values]), 'count': len(used), 'speed': max(speeds or [0.0]),
+            'speedSum': sum(speeds), 'speedSquares': sum([speed*speed for speed in speeds]), 'density': max([state['density'][j] for j in used] or [0.0])}
+
+def findHalfPairs(clusterRadius, positions, particleRadius, active=None):
+    '''
+        finds every pair of neighbouring particles once, rather than once from each side like findNeighbour, using the
+        same grid cells and neighbour test
+
+        clusterRadius:    the cluster radius of each particle
+        positions:    list of x,y,z coordinates of every particle in the system
+        particleRadius:    the radius of each particle within the system
+        active:    optional list of booleans marking which particles of a particle pool are in use
+        return:    lists of the first particle index, second particle index, x,y,z distance from the first to the second
+                   particle and magnitude of every pair. The second index is never below the first, and each particle
+                   is paired with itself once.
+    '''
+    cellSize = clusterRadius + 2*particleRadius
+    grid = buildSpatialGrid(positions, cellSize, active)
+    I, J, D, mag = [], [], [], []
+    for p in range(len(positions)):
+        if active is not None and not active[p]:
+            continue
+        pos = positions[p]
+        nearby = sorted(findNearbyParticles(pos, grid, cellSize))
+        for j in nearby[bisect.bisect_left(nearby, p):]:
+            dist = [positions[j][0] - pos[0], positions[j][1] - pos[1], positions[j][2] - pos[2]]
+            r = m.sqrt(dist[0]**2 + dist[1]**2 + dist[2]**2)
+            if r - 2*particleRadius <= clusterRadius:
+                I.append(p)
+                J.append(j)
+                D.append(dist)
+                mag.append(r)
+    return I, J, D, mag
+
+def findNearestNeighbours(clusterRadius, positions, particleRadius, maxNeighbours, active=None):
+    '''
+        finds the nearest maxNeighbours neighbours of every particle with the grid cells and neighbour test of
+        findNeighbour. The neighbours are ranked while the surrounding cells are searched, so a particle in a dense
+        clump only ever holds maxNeighbours of them. Particles at the same distance are ranked by index, after the
+        particle itself.
+
+        clusterRadius:    the cluster radius of each particle
+        positions:    list of x,y,z coordinates of every particle in the system
+        particleRadius:    the radius of each particle within the system
+        maxNeighbours:    most neighbours kept for each particle, counting the particle itself
+        active:    optional list of booleans marking which particles of a particle pool are in use
+        return:    list of the indices of the nearest neighbours of every particle, and list of the number of
+                   neighbours every particle had within its cluster radius
+    '''
+    cellSize = clusterRadius + 2*particleRadius
+    grid = buildSpatialGrid(positions, cellSize, active)
+    nearest, found = [], []
+    for p in range(len(positions)):
+        nearby = findNearbyParticles(positions[p], grid, cellSize) if active is None or active[p] else []
+        within = [0]
+        def candidates():
+            for j in nearby:
+                r = m.sqrt(sum([(positions[j][l] - positions[p][l])**2 for l in range(3)]))
+                if r - 2*particleRadius <= clusterRadius:
+                    within[0] += 1
+                    yield r, j
+        nearest.append([j for r, j in heapq.nsmallest(maxNeighbours, candidates(), key=lambda c: (c[0], c[1] != p, c[1]))])
+        found.append(within[0])
+    return nearest, found
+
+def capNeighbours(nearest, found, maxNeighbours):
+    '''
+        keeps at most maxNeighbours neighbours of every particle, so a particle in a dense clump costs no more than
+        one in the rest of the fluid. A pair is kept when each particle is among the nearest maxNeighbours of the
+        other, so both particles of a pair still see each other and pressure stays equal and opposite. The density
+        of a capped particle is scaled up by the neighbours it lost, which sums the kept neighbours as a sample of
+        the whole neighbourhood.
+
+        nearest:    list of the indices of the nearest neighbours of every particle from findNearestNeighbours
+        found:    list of the number of neighbours every particle had before the cap
+        maxNeighbours:    most neighbours kept for each particle, counting the particle itself
+        return:    list of the kept neighbour indices of every particle, in the order of findNeighbour, list of the
+                   density scale of every particle, and the number of particles which had more neighbours than the
+                   cap and the most neighbours any particle had
+    '''
+    nearestSets = [set(n) for n in nearest]
+    neighbours, scale = [], []
+    for i in range(len(nearest)):
+        mutual = sorted([j for j in nearest[i] if i in nearestSets[j]])
+        split = bisect.bisect_left(mutual, i)
+        neighbours.append(mutual[split:] + mutual[:split])
+        scale.append(float(found[i])/len(mutual) if mutual else 1.0)
+    return neighbours, scale, (len([c for c in found if c > maxNeighbours]), max(found or [0]))
+
+def pythonHalfNeighbours(state, settings):
+    state['neighbourScale'] = None
+    if not settings.get('maxNeighbours'):
+        state['halfPairs'] = findHalfPairs(settings['clusterRadius'], state['position'], settings['particleRadius'], state['active'])
+        return
+    positions = state['position']
+    nearest, found = findNearestNeighbours(settings['clusterRadius'], positions, settings['particleRadius'], settings['maxNeighbours'], state['active'])
+    neighbours, state['neighbourScale'], state['neighbourCap'] = capNeighbours(nearest, found, settings['maxNeighbours'])
+    I, J, D, mag = [], [], [], []
+    for p in range(len(neighbours)):
+        for j in neighbours[p]:
+            if j < p:
+                break # the neighbours below the particle come last, and each of those pairs is kept by the other particle
+            dist = [positions[j][0] - positions[p][0], positions[j][1] - positions[p][1], positions[j][2] - positions[p][2]]
+            I.append(p)
+            J.append(j)
+            D.append(dist)
+            mag.append(m.sqrt(dist[0]**2 + dist[1]**2 + dist[2]**2))
+    state['halfPairs'] = (I, J, D, mag)
+
+def pythonHalfDensity(state, settings):
+    I, J, D, mag = state['halfPairs']
+    h, mass, initialD, n = settings['clusterRadius'], settings['mass'], settings['density'], len(state['position'])
+    poly6C = 315/(64*m.pi*h**9)
+    kernel, density = [], [0.0]*n
+    for k in range(len(I)):
+        w = poly6C*(h**2 - mag[k]**2)**3
+        kernel.append(w)
+        density[I[k]] += initialD + mass*w
+        if J[k] != I[k]:
+            density[J[k]] += initialD + mass*w # both particles of a pair see the same kernel value
+    if state.get('neighbourScale') is not None:
+        density = [d*scale for d, scale in zip(density, state['neighbourScale'])]
+    state['kernel'], state['density'] = kernel, density
+    state['pressure'] = findPressure(mass, n, settings['spawnRadius'], initialD, density, settings['stiffness'])
+
+def pythonHalfForces(state, settings):
+    '''
+        sums the pressure, viscosity, surface traction and XSPH terms of every pair in one pass, adding each term to
+        both particles of the pair. Pressure is equal and opposite on the two particles, while the other terms share
+        the kernel value and are weighted by the density of the other particle.
+    '''
+    I, J, D, mag = state['halfPairs']
+    s, n = settings, len(state['position'])
+    h, mass, rho, p = s['clusterRadius'], s['mass'], state['density'], state['pressure']
+    positions, velocity, kernel = state['position'], state['velocity'], state['kernel']
+    spikyC, gradC = 45.0/(m.pi*h**6), -945.0/(32*m.pi*h**9)
+    pForce, visForce, normal = [[0.0, 0.0, 0.0] for j in range(n)], [[0.0, 0.0, 0.0] for j in range(n)], [[0.0, 0.0, 0.0] for j in range(n)]
+    laplacian, xsph = [0.0]*n, [0.0]*n
+    for k in range(len(I)):
+        i, j, r = I[k], J[k], mag[k]
+        q, visK = h*h - r*r, spikyC*(h - r)
+        gradK, lapK = gradC*q*q, gradC*q*(3*h*h - 7*r*r)
+        weightI, weightJ = mass/rho[i], mass/rho[j]
+        correction = 2*mass/(rho[i] + rho[j])*kernel[k]
+        xsph[i] += correction
+        laplacian[i] += weightJ*lapK
+        for l in range(3):
+            visForce[i][l] += (velocity[j][l] - velocity[i][l])*weightJ*visK
+            normal[i][l] += positions[j][l]*weightJ*gradK
+        if i == j:
+            continue # a particle paired with itself is only counted once and has no pressure direction
+        xsph[j] += correction
+        laplacian[j] += weightI*lapK
+        pressureF = 0.0
+        if r > 0:
+            pressureF = mass*(p[i]/rho[i]**2 + p[j]/rho[j]**2)*spikyC*(h - r)**2/r
+        for l in range(3):
+            pForce[i][l] += pressureF*D[k][l]
+            pForce[j][l] -= pressureF*D[k][l]
+            visForce[j][l] += (velocity[i][l] - velocity[j][l])*weightI*visK
+            normal[j][l] += positions[i][l]*weightI*gradK
+    g, forces = s['gravity'], []
+    for i in range(n):
+        nMag = m.sqrt(normal[i][0]**2 + normal[i][1]**2 + normal[i][2]**2)
+        scale = -s['delta']*laplacian[i]/nMag if nMag != 0 else 0.0 # particles without a surface normal receive no traction force
+        forces.append([mass*g[l] + s['viscosity']*visForce[i][l] - mass*pForce[i][l] + scale*normal[i][l] + s['buoyancy']*(rho[i] - s['density'])*g[l]
+                       for l in range(3)])
+    state['forces'], state['xsph'] = forces, [0.1*x for x in xsph]
+
+def fusedXSPH(state, settings):
+    pass # the XSPH correction is summed in the same pass over the pairs as the forces
+
+def sortIntoCells(positions, cellSize, groups=None):
+    '''
+        sorts particles into the grid cells of findPairs, numbered so that the 26 cells surrounding a cell are found by
+        adding a fixed offset to its number
+
+        positions:    numpy array of the x,y,z coordinates of the particles to sort
+        cellSize:    width of each grid cell
+        groups:    optional numpy array of the group of every particle, each group getting a grid of its own
+        return:    numpy array of the cell number of every particle, numpy array of the particles sorted by cell number,
+                   the sorted cell numbers, and list of the offsets to the cell itself and the 26 cells around it
+    '''
+    cells = np.floor(positions/cellSize).astype(np.int64)
+    cells -= cells.min(axis=0) - 1 # a border of empty cells keeps the surrounding cells of every particle inside the grid
+    dims = cells.max(axis=0) + 2
+    keys = (cells[:,0]*dims[1] + cells[:,1])*dims[2] + cells[:,2]
+    if groups is not None:
+        keys += groups.astype(np.int64)*dims[0]*dims[1]*dims[2] # each group has a grid of its own, which the border keeps apart
+    order = np.argsort(keys, kind='mergesort')
+    offsets = [(dx*dims[1] + dy)*dims[2] + dz for dx in (-1, 0, 1) for dy in (-1, 0, 1) for dz in (-1, 0, 1)]
+    return keys, order, keys[order], offsets
+
+def findPairs(positions, clusterRadius, particleRadius, active=None, half=False, groups=None):
+    '''
+        finds every pair of neighbouring particles by sorting the particles into grid cells as wide as a particle
+        neighbourhood, so only particles in the 27 surrounding cells are compared. Uses the same neighbour test as
+        findNeighbour.
+
+        positions:    numpy array of the x,y,z coordinates of every particle
+        clusterRadius:    the cluster radius of each particle, or numpy array of the cluster radius of every particle
+                          when particles differ in size, in which case a pair uses the average of its two particles
+        particleRadius:    the radius of each particle within the system, or numpy array of the radius of every particle
+        active:    optional numpy array of booleans marking which particles of a particle pool are in use
+        half:    keeps each pair once, with the neighbour index never below the particle index, like findHalfPairs
+        groups:    optional numpy array of the group of every particle, particles of different groups are never
+                   neighbours, e.g the variants of an ensemble sharing the same space
+        return:    numpy arrays of the particle index, neighbour index, x,y,z distance and magnitude of every pair.
+                   Each particle is paired with itself.
+    '''
+    sized = np.ndim(clusterRadius) > 0 # particles of adaptive resolution have a cluster and particle radius of their own
+    cellSize = (np.max(clusterRadius + 2*particleRadius) if sized else clusterRadius + 2*particleRadius) or 1.0
+    live = np.arange(len(positions)) if active is None else np.nonzero(active)[0]
+    I, J = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+    if len(live):
+        keys, order, sortedKeys, offsets = sortIntoCells(positions[live], cellSize, None if groups is None else groups[live])
+        for offset in offsets:
+            target = keys + offset
+            start, end = np.searchsorted(sortedKeys, target, 'left'), np.searchsorted(sortedKeys, target, 'right')
+            counts = end - start # number of particles in the surrounding cell of each particle
+            total = counts.sum()
+            if total == 0:
+                continue
+            I.append(np.repeat(np.arange(len(live)), counts))
+            J.append(order[np.repeat(start, counts) + np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)])
+    I, J = live[np.concatenate(I)], live[np.concatenate(J)]
+    if half:
+        I, J = I[I <= J], J[I <= J] # the other half are the same pairs seen from the neighbour
+    D = positions[J] - positions[I]
+    mag = np.sqrt(D[:,0]**2 + D[:,1]**2 + D[:,2]**2)
+    if sized:
+        near = mag - (particleRadius[I] + particleRadius[J]) <= 0.5*(clusterRadius[I] + clusterRadius[J])
+    else:
+        near = mag - 2*particleRadius <= clusterRadius
+    return I[near], J[near], D[near], mag[near]
+
+def particleSetting(settings, name, n):
+    '''
+        a solver setting as a numpy array with a value for every particle. The settings of an ensemble hold a value
+        for every particle where the variants differ, any other simulation holds one value for all particles.
+
+        settings:    dictionary from findSolverSettings or findEnsembleSettings
+        name:    key of the setting
+        n:    number of particles
+        return:    numpy array of the setting of every particle
+    '''
+    return np.broadcast_to(np.asarray(settings[name], dtype=np.float64), (n,))
+
+def setLevelScales(state):
+    '''
+        finds the mass and smoothing length of every particle of adaptive resolution from its level. A particle split
+        once has half the mass of a spawned particle and a smoothing length smaller by the cube root of 2, so it holds
+        the same number of neighbours.
+
+        state:    dictionary from createSolverState, holding the level of every particle or None
+    '''
+    if state.get('level') is None:
+        state['massScale'], state['lengthScale'] = None, None
+        return
+    state['massScale'] = 0.5**state['level'].astype(np.float64)
+    state['lengthScale'] = state['massScale']**(1.0/3)
+
+def levelScale(state, name, index=None):
+    '''
+        state:    dictionary from createSolverState after setLevelScales
+        name:    'massScale' or 'lengthScale'
+        index:    optional numpy array of the particles to pick, e.g the neighbour of every pair
+        return:    1.0 when every particle has the spawn size, otherwise numpy array of the scale of every particle
+                   relative to a spawned particle, or of the picked particles
+    '''
+    scale = state.get(name)
+    if scale is None:
+        return 1.0
+    return scale if index is None else scale[index]
+
+def pairScale(state, I, J):
+    '''
+        the smoothing length of every pair relative to the cluster radius, the average of its two particles so both
+        see the same kernel
+
+        state:    dictionary from createSolverState after setLevelScales
+        I:    numpy array of the particle index of every pair
+        J:    numpy array of the neighbour index of every pair
+        return:    1.0 when every particle has the spawn size, otherwise numpy array of the scale of every pair
+    '''
+    return 0.5*(levelScale(state, 'lengthScale', I) + levelScale(state, 'lengthScale', J))
+
+def selectPairs(value, keep):
+    '''
+        value:    a value shared by every pair, or numpy array of its value for every pair
+        keep:    numpy array of booleans marking the pairs to keep
+        return:    the shared value, or the values of the kept pairs
+    '''
+    return value if np.ndim(value) == 0 else value[keep]
+
+NEAREST_BLOCK = 2**18 # most distances measured at once while ranking the neighbours of the particles in one grid cell
+
+def findNearestPairs(positions, clusterRadius, particleRadius, maxNeighbours, active=None, groups=None):
+    '''
+        finds the pairs of every particle with its nearest maxNeighbours neighbours, using the grid cells and
+        neighbour test of findPairs. The particles of one grid cell share the same surrounding cells, so they are
+        measured against them in blocks of at most NEAREST_BLOCK distances, and only the nearest of each are picked
+        with a partial sort before the next block. No particle holds more than maxNeighbours pairs, however dense the
+        clump it sits in. Particles at the same distance are ranked by index, after the particle itself, like
+        findNearestNeighbours.
+
+        positions:    numpy array of the x,y,z coordinates of every particle
+        clusterRadius:    the cluster radius of each particle, or numpy array of the cluster radius of every particle
+        particleRadius:    the radius of each particle within the system, or numpy array of the radius of every particle
+        maxNeighbours:    most neighbours kept for each particle, counting the particle itself
+        active:    optional numpy array of booleans marking which particles of a particle pool are in use
+        groups:    optional numpy array of the group of every particle, particles of different groups are never neighbours
+        return:    numpy arrays of the particle index, neighbour index, x,y,z distance and magnitude of every pair from
+                   the side of the particle, and numpy array of the number of neighbours every particle had within its
+                   cluster radius
+    '''
+    sized = np.ndim(clusterRadius) > 0
+    cellSize = (np.max(clusterRadius + 2*particleRadius) if sized else clusterRadius + 2*particleRadius) or 1.0
+    live = np.arange(len(positions)) if active is None else np.nonzero(active)[0]
+    found = np.zeros(len(positions), dtype=np.int64)
+    I, J = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+    if len(live):
+        keys, order, sortedKeys, offsets = sortIntoCells(positions[live], cellSize, None if groups is None else groups[live])
+        cellKeys, starts = np.unique(sortedKeys, return_index=True)
+        ends = np.append(starts[1:], len(sortedKeys))
+        targets = cellKeys[:,np.newaxis] + np.array(offsets)
+        around = np.minimum(np.searchsorted(cellKeys, targets), len(cellKeys) - 1)
+        occupied = cellKeys[around] == targets # the surrounding cells which hold particles
+        for cell in range(len(cellKeys)):
+            nearby = np.sort(live[np.concatenate([order[starts[a]:ends[a]] for a in around[cell][occupied[cell]]])])
+            block = max(NEAREST_BLOCK//len(nearby), 1) # particles of a dense cell are measured a few at a time
+            for first in range(starts[cell], ends[cell], block):
+                members = live[order[first:min(first + block, ends[cell])]]
+                D = positions[nearby][np.newaxis,:,:] - positions[members][:,np.newaxis,:]
+                mag = np.sqrt(D[:,:,0]**2 + D[:,:,1]**2 + D[:,:,2]**2)
+                if sized:
+                    near = mag - (particleRadius[members][:,np.newaxis] + particleRadius[nearby]) <= 0.5*(clusterRadius[members][:,np.newaxis] + clusterRadius[nearby])
+                else:
+                    near = mag - 2*particleRadius <= clusterRadius
+                rank = np.where(near, mag, np.inf)
+                rank[members[:,np.newaxis] == nearby] = -1.0 # the particle itself comes before any other at no distance
+                found[members] = near.sum(axis=1)
+                if len(nearby) > maxNeighbours:
+                    kth = np.partition(rank, maxNeighbours - 1, axis=1)[:,maxNeighbours - 1:maxNeighbours]
+                    below = rank < kth
+                    tied = rank == kth
+                    near &= below | (tied & (np.cumsum(tied, axis=1) <= maxNeighbours - below.sum(axis=1)[:,np.newaxis])) # ties at the cut go to the lowest indices
+                rows, columns = np.nonzero(near)
+                I.append(members[rows])
+                J.append(nearby[columns])
+    I, J = np.concatenate(I), np.concatenate(J)
+    D = positions[J] - positions[I]
+    return (I, J, D, np.sqrt(D[:,0]**2 + D[:,1]**2 + D[:,2]**2)), found
+
+def capPairs(pairs, found, maxNeighbours, n, half=False):
+    '''
+        the neighbour cap of capNeighbours for the pair arrays of findNearestPairs
+
+        pairs:    numpy arrays of the particle index, neighbour index, x,y,z distance and magnitude of the pairs of every
+                  particle with its nearest neighbours, from findNearestPairs
+        found:    numpy array of the number of neighbours every particle had before the cap
+        maxNeighbours:    most neighbours kept for each particle, counting the particle itself
+        n:    number of particles
+        half:    keeps each pair once, with the neighbour index never below the particle index
+        return:    the kept pair arrays, numpy array of the density scale of every particle, and the number of
+                   particles which had more neighbours than the cap and the most neighbours any particle had
+    '''
+    I, J, D, mag = pairs
+    keep = np.in1d(J*n + I, I*n + J) # the pair seen from the neighbour is among its nearest too
+    kept = np.bincount(I[keep], minlength=n)
+    scale = np.where(kept > 0, found/np.maximum(kept, 1).astype(np.float64), 1.0) # unused particles keep no pairs and a scale of 1 like capNeighbours
+    if half:
+        keep &= I <= J
+    return (I[keep], J[keep], D[keep], mag[keep]), scale, (int((found > maxNeighbours).sum()), int(found.max()) if n else 0)
+
+def sumPairs(I, values, n):
+    '''
+        sums a value of every pair into the particle of the pair
+
+        I:    numpy array of the particle index of every pair
+        values:    numpy array of one value or one x,y,z vector per pair
+        n:    number of particles
+        return:    numpy array of the summed values of every particle
+    '''
+    if values.ndim == 1:
+        return np.bincount(I, weights=values, minlength=n)
+    return np.column_stack([np.bincount(I, weights=values[:,l], minlength=n) for l in range(values.shape[1])])
+
+def sumHalfPairs(I, J, first, second, n):
+    '''
+        sums a value of every pair into both particles of a half pair list, where a particle paired with itself only
+        counts once
+
+        I, J:    numpy arrays of the first and second particle index of every pair
+        first:    numpy array of the value added to the first particle of each pair
+        second:    numpy array of the value added to the second particle of each pair
+        n:    number of particles
+        return:    numpy array of the summed values of every particle
+    '''
+    other = I != J
+    return sumPairs(I, first, n) + sumPairs(J[other], second[other], n)
+
+def numpyNeighbours(state, settings):
+    setLevelScales(state)
+    scale = levelScale(state, 'lengthScale')
+    state['neighbourScale'] = None
+    if settings.get('maxNeighbours'):
+        pairs, found = findNearestPairs(state['position'], settings['clusterRadius']*scale, settings['particleRadius']*scale, settings['maxNeighbours'], state['active'], state.get('variant'))
+        state['pairs'], state['neighbourScale'], state['neighbourCap'] = capPairs(pairs, found, settings['maxNeighbours'], len(state['position']))
+        return
+    state['pairs'] = findPairs(state['position'], settings['clusterRadius']*scale, settings['particleRadius']*scale, state['active'], groups=state.get('variant'))
+
+def numpyDensity(state, settings):
+    I, J, D, mag = state['pairs']
+    h, initialD = settings['clusterRadius']*pairScale(state, I, J), settings['density']
+    state['kernel'] = (315/(64*m.pi*h**9))*(h**2 - mag**2)**3
+    state['density'] = sumPairs(I, initialD + settings['mass']*levelScale(state, 'massScale', J)*state['kernel'], len(state['position']))
+    if state.get('neighbourScale') is not None:
+        state['density'] = state['density']*state['neighbourScale']
+    state['pressure'] = settings['stiffness']*(state['density'] - initialD)
+
+def numpyForces(state, settings):
+    I, J, D, mag = state['pairs']
+    h, mass, n = settings['clusterRadius']*pairScale(state, I, J), settings['mass'], len(state['position'])
+    massJ = mass*levelScale(state, 'massScale', J) # forces stay per spawned particle mass, so only the neighbour mass changes with its level
+    rho, p = state['density'], state['pressure']
+    spikyC, gradC = 45.0/(m.pi*h**6), -945.0/(32*m.pi*h**9)
+    apart = mag > 0 # a particle paired with itself has no direction, so it adds no pressure force
+    Ia, Ja, magA, hA = I[apart], J[apart], mag[apart], selectPairs(h, apart)
+    pressureF = selectPairs(massJ, apart)*(p[Ia]/rho[Ia]**2 + p[Ja]/rho[Ja]**2)*selectPairs(spikyC, apart)*(hA - magA)**2/magA
+    pForce = -mass*sumPairs(Ia, D[apart]*pressureF[:,None], n)
+    weight = massJ/rho[J]
+    visForce = particleSetting(settings, 'viscosity', n)[:,None]*sumPairs(I, (state['velocity'][J] - state['velocity'][I])*(weight*spikyC*(h - mag))[:,None], n)
+    normal = sumPairs(I, state['position'][J]*(weight*gradC*(h**2 - mag**2)**2)[:,None], n)
+    laplacian = sumPairs(I, weight*gradC*(h**2 - mag**2)*(3*h**2 - 7*mag**2), n)
+    state['forces'] = addSurfaceAndBodyForces(state, settings, visForce + pForce, normal, laplacian)
+
+def addSurfaceAndBodyForces(state, settings, forces, normal, laplacian):
+    '''
+        adds the surface traction, gravity and buoyancy to the summed pair forces
+
+        state:    dictionary from createSolverState
+        settings:    dictionary from findSolverSettings
+        forces:    numpy array of the pressure and viscosity force of every particle
+        normal:    numpy array of the summed surface normal of every particle
+        laplacian:    numpy array of the summed laplacian of the colour field of every particle
+        return:    numpy array of the total force of every particle
+    '''
+    mass, rho, g, n = settings['mass'], state['density'], np.array(settings['gravity'], dtype=np.float64), len(state['position'])
+    nMag = np.sqrt((normal**2).sum(axis=1))
+    scale = np.zeros(n)
+    curved = nMag != 0 # particles without a surface normal receive no traction force, a normal that is not a number is passed on
+    scale[curved] = -particleSetting(settings, 'delta', n)[curved]*laplacian[curved]/nMag[curved]
+    bForce = particleSetting(settings, 'buoyancy', n)[:,None]*(rho - settings['density'])[:,None]*g
+    return mass*g + forces + normal*scale[:,None] + bForce
+
+def numpyXSPH(state, settings):
+    I, J, D, mag = state['pairs']
+    rho = state['density']
+    state['xsph'] = 0.1*sumPairs(I, 2*settings['mass']*levelScale(state, 'massScale', J)/(rho[I] + rho[J])*state['kernel'], len(state['position']))
+
+def numpySolveViscosity(state, settings):
+    '''
+        the implicit viscosity solve of pythonSolveViscosity, solving the three axes at once
+    '''
+    if not np.any(settings['implicitViscosity']):
+        return
+    I, J, D, mag = state['halfPairs' if settings.get('halfPairs') else 'pairs']
+    once = I < J # full pair lists hold every pair from both sides
+    I, J, mag = I[once], J[once], mag[once]
+    h, dt, mass, rho, n = settings['clusterRadius']*pairScale(state, I, J), settings['timeStep'], settings['mass'], state['density'], len(state['position'])
+    nu = particleSetting(settings, 'implicitViscosity', n)[I] # both particles of a pair belong to the same variant of an ensemble
+    coupling = (dt*nu*45.0/(m.pi*h**6)*np.maximum(h - mag, 0.0)*2/(rho[I] + rho[J]))[:,None]
+    def apply(x):
+        exchange = coupling*(x[I] - x[J])
+        return x + sumPairs(I, exchange, n) - sumPairs(J, exchange, n)
+    b = state['velocity'] + dt*state['forces']/mass # velocity after every force but viscosity
+    x = b.copy()
+    r = b - apply(x)
+    p, rr = r.copy(), (r*r).sum(axis=0)
+    limit = (VISCOSITY_TOLERANCE*max(np.abs(b).max() if n else 0.0, 1e-12))**2*n
+    for iteration in range(VISCOSITY_ITERATIONS):
+        if (rr <= limit).all():
+            break
+        Ap = apply(p)
+        alpha = rr/np.maximum((p*Ap).sum(axis=0), 1e-300) # an axis that has converged keeps a step of 0
+        x += alpha*p
+        r -= alpha*Ap
+        rrNew = (r*r).sum(axis=0)
+        p = r + rrNew/np.maximum(rr, 1e-300)*p
+        rr = rrNew
+    state['forces'] = state['forces'] + mass*(x - b)/dt
+    state['viscosityIterations'] = iteration
+
+def numpyHealth(state, settings):
+    position, velocity, density = state['position'], state['velocity'], state['density']
+    if state['active'] is not None:
+        position, velocity, density = position[state['active']], velocity[state['active']], density[state['active']]
+    speed = np.sqrt((velocity**2).sum(axis=1))
+    finite = np.isfinite(position).all() and np.isfinite(speed).all() and np.isfinite(density).all()
+    return {'finite': bool(finite), 'count': len(speed), 'speed': float(speed.max()) if len(speed) else 0.0, 'speedSum': float(speed.sum()),
+            'speedSquares': float((speed**2).sum()), 'density': float(density.max()) if len(density) else 0.0}
+
+def numpyHalfNeighbours(state, settings):
+    setLevelScales(state)
+    h, radius = settings['clusterRadius']*levelScale(state, 'lengthScale'), settings['particleRadius']*levelScale(state, 'lengthScale')
+    state['neighbourScale'] = None
+    if settings.get('maxNeighbours'): # the nearest neighbours of a particle are ranked from both sides of every pair
+        pairs, found = findNearestPairs(state['position'], h, radius, settings['maxNeighbours'], state['active'], state.get('variant'))
+        state['halfPairs'], state['neighbourScale'], state['neighbourCap'] = capPairs(pairs, found, settings['maxNeighbours'], len(state['position']), half=True)
+        return
+    state['halfPairs'] = findPairs(state['position'], h, radius, state['active'], half=True, groups=state.get('variant'))
+
+def numpyHalfDensity(state, settings):
+    I, J, D, mag = state['halfPairs']
+    h, initialD = settings['clusterRadius']*pairScale(state, I, J), settings['density']
+    state['kernel'] = (315/(64*m.pi*h**9))*(h**2 - mag**2)**3
+    massI, massJ = settings['mass']*levelScale(state, 'massScale', I), settings['mass']*levelScale(state, 'massScale', J)
+    state['density'] = sumHalfPairs(I, J, initialD + massJ*state['kernel'], initialD + massI*state['kernel'], len(state['position']))
+    if state.get('neighbourScale') is not None:
+        state['density'] = state['density']*state['neighbourScale']
+    state['pressure'] = settings['stiffness']*(state['density'] - initialD)
+
+def numpyHalfForces(state, settings):
+    I, J, D, mag = state['halfPairs']
+    h, mass, n = settings['clusterRadius']*pairScale(state, I, J), settings['mass'], len(state['position'])
+    massI, massJ = mass*levelScale(state, 'massScale', I), mass*levelScale(state, 'massScale', J)
+    rho, p, velocity, positions = state['density'], state['pressure'], state['velocity'], state['position']
+    spikyC, gradC = 45.0/(m.pi*h**6), -945.0/(32*m.pi*h**9)
+    apart = mag > 0 # a particle paired with itself has no direction, so it adds no pressure force
+    Ia, Ja, magA, hA = I[apart], J[apart], mag[apart], selectPairs(h, apart)
+    pressureF = D[apart]*(selectPairs(massJ, apart)*(p[Ia]/rho[Ia]**2 + p[Ja]/rho[Ja]**2)*selectPairs(spikyC, apart)*(hA - magA)**2/magA)[:,None]
+    reaction = pressureF if np.ndim(massI) == 0 else pressureF*(massI/massJ)[apart][:,None] # split particles push back with the mass of the other side
+    pForce = -mass*sumHalfPairs(Ia, Ja, pressureF, -reaction, n) # equal and opposite on the two particles
+    weightI, weightJ = massI/rho[I], massJ/rho[J]
+    visK, gradK, lapK = spikyC*(h - mag), gradC*(h**2 - mag**2)**2, gradC*(h**2 - mag**2)*(3*h**2 - 7*mag**2)
+    change = (velocity[J] - velocity[I])*visK[:,None]
+    visForce = particleSetting(settings, 'viscosity', n)[:,None]*sumHalfPairs(I, J, change*weightJ[:,None], -change*weightI[:,None], n)
+    normal = sumHalfPairs(I, J, positions[J]*(weightJ*gradK)[:,None], positions[I]*(weightI*gradK)[:,None], n)
+    laplacian = sumHalfPairs(I, J, weightJ*lapK, weightI*lapK, n)
+    state['forces'] = addSurfaceAndBodyForces(state, settings, visForce + pForce, normal, laplacian)
+
+def numpyHalfXSPH(state, settings):
+    I, J, D, mag = state['halfPairs']
+    rho = state['density']
+    massI, massJ = settings['mass']*levelScale(state, 'massScale', I), settings['mass']*levelScale(state, 'massScale', J)
+    state['xsph'] = 0.1*sumHalfPairs(I, J, 2*massJ/(rho[I] + rho[J])*state['kernel'], 2*massI/(rho[I] + rho[J])*state['kernel'], len(state['position']))
+
+def numpyIntegrate(state, settings):
+    dt, active = settings['timeStep'], state['active']
+    acceleration = dt*state['forces']/settings['mass']
+    state['velocity'] += acceleration
+    step = dt*(state['velocity'] + state['xsph'][:,None] + acceleration)
+    if state['offset']:
+        step += np.array(state['offset'], dtype=np.float64)
+    if active is None:
+        state['position'] += step
+    else:
+        state['position'][active] += step[active] # unused pool particles stay where they are
+
+def numpyCollide(state, settings):
+    tankSize, active = settings['tankSize'], state['active']
+    pos, vel = state['position'], state['velocity']
+    rlos = particleSetting(settings, 'rlos', len(pos))
+    for l, upper in [(0, True), (1, False), (2, True)]: # the container is open at the top
+        hit = pos[:,l] < -tankSize
+        if active is not None:
+            hit &= active
+        pos[hit,l] = -tankSize+((-tankSize)-pos[hit,l])
+        vel[hit,l] *= -rlos[hit]
+        if upper:
+            hit = pos[:,l] > tankSize
+            if active is not None:
+                hit &= active
+            pos[hit,l] = -(pos[hit,l]-tankSize)+tankSize
+            vel[hit,l] *= -rlos[hit]
+    if active is not None:
+        vel[~active] = 0.0
+
+def pairForceLoop(I, J, D, mag, positions, velocity, density, pressure, gravity, mass, h, viscosity, delta, buoyancy, initialD, forces):
+    '''
+        sums the pressure, viscosity and surface traction forces of every pair in a single pass and adds gravity and
+        buoyancy. Written as plain loops over numpy arrays so that it can be compiled by numba.
+    '''
+    n = len(density)
+    spikyC, gradC = 45.0/(m.pi*h**6), -945.0/(32*m.pi*h**9)
+    pForce, visForce, normal, laplacian = np.zeros((n, 3)), np.zeros((n, 3)), np.zeros((n, 3)), np.zeros(n)
+    for k in range(len(I)):
+        i, j, r = I[k], J[k], mag[k]
+        weight, q = mass/density[j], h*h - r*r
+        if r > 0:
+            pressureF = mass*(pressure[i]/density[i]**2 + pressure[j]/density[j]**2)*spikyC*(h - r)**2/r
+            for l in range(3):
+                pForce[i,l] += pressureF*D[k,l]
+        for l in range(3):
+            visForce[i,l] += (velocity[j,l] - velocity[i,l])*weight*spikyC*(h - r)
+            normal[i,l] += positions[j,l]*weight*gradC*q*q
+        laplacian[i] += weight*gradC*q*(3*h*h - 7*r*r)
+    for i in range(n):
+        nMag = m.sqrt(normal[i,0]**2 + normal[i,1]**2 + normal[i,2]**2)
+        scale = 0.0
+        if nMag != 0:
+            scale = -delta*laplacian[i]/nMag
+        for l in range(3):
+            forces[i,l] = mass*gravity[l] + viscosity*visForce[i,l] - mass*pForce[i,l] + scale*normal[i,l] + buoyancy*(density[i] - initialD)*gravity[l]
+
+def pairXSPHLoop(I, J, kernel, density, mass, xsph):
+    '''
+        sums the XSPH velocity correction of every pair, written as a plain loop so that it can be compiled by numba
+    '''
+    for k in range(len(I)):
+        xsph[I[k]] += 0.1*2*mass/(density[I[k]] + density[J[k]])*kernel[k]
+
+def halfPairLoop(I, J, D, mag, kernel, positions, velocity, density, pressure, gravity, mass, h, viscosity, delta, buoyancy, initialD, forces, xsph):
+    '''
+        sums the pressure, viscosity, surface traction and XSPH terms of a half pair list in a single pass, adding
+        each term to both particles of the pair like pythonHalfForces. Written as plain loops over numpy arrays so that
+        it can be compiled by numba.
+    '''
+    n = len(density)
+    spikyC, gradC = 45.0/(m.pi*h**6), -945.0/(32*m.pi*h**9)
+    pForce, visForce, normal, laplacian = np.zeros((n, 3)), np.zeros((n, 3)), np.zeros((n, 3)), np.zeros(n)
+    for k in range(len(I)):
+        i, j, r = I[k], J[k], mag[k]
+        q, visK = h*h - r*r, spikyC*(h - r)
+        gradK, lapK = gradC*q*q, gradC*q*(3*h*h - 7*r*r)
+        weightI, weightJ = mass/density[i], mass/density[j]
+        correction = 0.1*2*mass/(density[i] + density[j])*kernel[k]
+        xsph[i] += correction
+        laplacian[i] += weightJ*lapK
+        for l in range(3):
+            visForce[i,l] += (velocity[j,l] - velocity[i,l])*weightJ*visK
+            normal[i,l] += positions[j,l]*weightJ*gradK
+        if i == j:
+            continue
+        xsph[j] += correction
+        laplacian[j] += weightI*lapK
+        pressureF = 0.0
+        if r > 0:
+            pressureF = mass*(pressure[i]/density[i]**2 + pressure[j]/density[j]**2)*spikyC*(h - r)**2/r
+        for l in range(3):
+            pForce[i,l] += pressureF*D[k,l]
+            pForce[j,l] -= pressureF*D[k,l]
+            visForce[j,l] += (velocity[i,l] - velocity[j,l])*weightI*visK
+            normal[j,l] += positions[i,l]*weightI*gradK
+    for i in range(n):
+        nMag = m.sqrt(normal[i,0]**2 + normal[i,1]**2 + normal[i,2]**2)
+        scale = 0.0
+        if nMag != 0:
+            scale = -delta*laplacian[i]/nMag
+        for l in range(3):
+            forces[i,l] = mass*gravity[l] + viscosity*visForce[i,l] - mass*pForce[i,l] + scale*normal[i,l] + buoyancy*(density[i] - initialD)*gravity[l]
+
+COMPILED_LOOPS = {} # pair loops compiled by numba, filled when the numba backend is loaded
+
+def loadNumba():
+    '''
+        compiles the pair loops with numba and runs them once on two particles, so that compiling happens when the
+        backend is chosen rather than on the first frame
+    '''
+    import numba
+    for loop in [pairForceLoop, pairXSPHLoop, halfPairLoop]:
+        COMPILED_LOOPS[loop.__name__] = numba.njit(loop)
+    for halfPairs in [False, True]:
+        state = createSolverState(BACKENDS['Numba'], [[0.0, 0.0, 0.0], [0.1, 0.0, 0.0]], [[0.0, 0.0, 0.0]]*2)
+        stepFluid(BACKENDS['Numba'], state, dict(findSolverSettings(DEFAULT_PARAMS), halfPairs=halfPairs))
+
+def numbaForces(state, settings):
+    I, J, D, mag = state['pairs']
+    s = settings
+    state['forces'] = np.zeros((len(state['position']), 3))
+    COMPILED_LOOPS['pairForceLoop'](I, J, D, mag, state['position'], state['velocity'], state['density'], state['pressure'],
+                                    np.array(s['gravity'], dtype=np.float64), float(s['mass']), float(s['clusterRadius']), float(s['viscosity']),
+                                    float(s['delta']), float(s['buoyancy']), float(s['density']), state['forces'])
+
+def numbaXSPH(state, settings):
+    I, J, D, mag = state['pairs']
+    state['xsph'] = np.zeros(len(state['position']))
+    COMPILED_LOOPS['pairXSPHLoop'](I, J, state['kernel'], state['density'], float(settings['mass']), state['xsph'])
+
+def numbaHalfForces(state, settings):
+    I, J, D, mag = state['halfPairs']
+    s = settings
+    state['forces'], state['xsph'] = np.zeros((len(state['position']), 3)), np.zeros(len(state['position']))
+    COMPILED_LOOPS['halfPairLoop'](I, J, D, mag, state['kernel'], state['position'], state['velocity'], state['density'], state['pressure'],
+                                   np.array(s['gravity'], dtype=np.float64), float(s['mass']), float(s['clusterRadius']), float(s['viscosity']),
+                                   float(s['delta']), float(s['buoyancy']), float(s['density']), state['forces'], state['xsph'])
+
+def loadNumPy():
+    if np is None:
+        raise ImportError('numpy is not installed')
+
+BACKENDS = {
+    'Python': {'name': 'Python', 'load': lambda: None, 'loaded': None,
+               'fromVectors': lambda values: [[float(v) for v in value] for value in values], 'fromMask': lambda mask: [bool(a) for a in mask],
+               'toVectors': lambda values: [list(value) for value in values], 'toScalars': lambda values: list(values),
+               'fromScalars': lambda values: [float(v) for v in values],
+               'permute': lambda values, order: [values[i] for i in order], 'copy': lambda values: [list(value) for value in values],
+               'measureHealth': pythonHealth,
+               'stages': {'findNeighbours': pythonNeighbours, 'findDensity': pythonDensity, 'findForces': pythonForces,
+                          'findXSPH': pythonXSPH, 'solveViscosity': pythonSolveViscosity, 'integrate': pythonIntegrate, 'collide': pythonCollide},
+               'halfStages': {'findNeighbours': pythonHalfNeighbours, 'findDensity': pythonHalfDensity, 'findForces': pythonHalfForces,
+                              'findXSPH': fusedXSPH, 'solveViscosity': pythonSolveViscosity, 'integrate': pythonIntegrate, 'collide': pythonCollide}},
+    'NumPy': {'name': 'NumPy', 'load': loadNumPy, 'loaded': None,
+              'fromVectors': lambda values: np.array(values, dtype=np.float64).reshape(-1, 3), 'fromMask': lambda mask: np.array(mask, dtype=bool),
+              'toVectors': lambda values: values.tolist(), 'toScalars': lambda values: values.tolist(),
+              'fromScalars': lambda values: np.array(values, dtype=np.float64),
+              'permute': lambda values, order: values[np.array(order, dtype=np.int64)], 'copy': lambda values: values.copy(),
+              'measureHealth': numpyHealth,
+              'stages': {'findNeighbours': numpyNeighbours, 'findDensity': numpyDensity, 'findForces': numpyForces,
+                         'findXSPH': numpyXSPH, 'solveViscosity': numpySolveViscosity, 'integrate': numpyIntegrate, 'collide': numpyCollide},
+              'halfStages': {'findNeighbours': numpyHalfNeighbours, 'findDensity': numpyHalfDensity, 'findForces': numpyHalfForces,
+                             'findXSPH': numpyHalfXSPH, 'solveViscosity': numpySolveViscosity, 'integrate': numpyIntegrate, 'collide': numpyCollide}}}
+BACKENDS['Numba'] = dict(BACKENDS['NumPy'], name='Numba', load=lambda: (loadNumPy(), loadNumba()),
+                         stages=dict(BACKENDS['NumPy']['stages'], findForces=numbaForces, findXSPH=numbaXSPH),
+                         halfStages=dict(BACKENDS['NumPy']['halfStages'], findForces=numbaHalfForces, findXSPH=fusedXSPH))
+# the numba backend shares the numpy neighbour search, integration and collision, and compiles the pair loops of the force and XSPH stages.
+# Each backend has a second set of stages working on half pair lists, which visit every pair of neighbours once
+
+def loadBackend(backend):
+    '''
+        prepares a backend the first time it is used
+
+        backend:    dictionary from BACKENDS
+        return:    True if the backend can run in this environment
+    '''
+    if backend['loaded'] is None:
+        try:
+            backend['load']()
+            backend['loaded'] = True
+        except Exception as e: # missing packages or a failed compile only mean the backend cannot be used
+            print 'The %s backend cannot run here: %s' % (backend['name'], e)
+            backend['loaded'] = False
+    return backend['loaded']
+
+def findAvailableBackends():
+    '''
+        return:    list of the names of the backends which can run in this environment, from fastest to slowest
+    '''
+    return [name for name in BACKEND_PREFERENCE if loadBackend(BACKENDS[name])]
+
+def selectBackend(name='Auto'):
+    '''
+        chooses the backend which runs the solver. Auto picks the fastest backend which can run here, and an explicitly
+        chosen backend which cannot run falls back to the automatic choice.
+
+        name:    'Auto' or a key of BACKENDS
+        return:    the chosen backend dictionary
+    '''
+    if name != 'Auto':
+        if name in BACKENDS and loadBackend(BACKENDS[name]):
+            return BACKENDS[name]
+        print 'The %s backend is not available, choosing one automatically.' % name
+    backend = BACKENDS[findAvailableBackends()[0]] # the pure python backend can always run
+    print 'Solving with the %s backend.' % backend['name']
+    return backend
+
+def findNeighbourStats(state):
+    '''
+        finds how many neighbours the particles had in the last step of the solver
+
+        state:    dictionary from createSolverState after a step
+        return:    the average, least and most neighbours of the particles in use, counting the particle itself
+    '''
+    if 'halfPairs' in state:
+        counts = [0]*len(state['position'])
+        for i, j in zip(state['halfPairs'][0], state['halfPairs'][1]):
+            counts[i] += 1
+            if j != i:
+                counts[j] += 1 # each pair is listed once but both particles are neighbours of each other
+    elif 'pairs' in state:
+        counts = np.bincount(state['pairs'][0], minlength=len(state['position'])).tolist()
+    else:
+        counts = [len(neighbours) for neighbours in state['neighbours']]
+    if state['active'] is not None:
+        counts = [counts[j] for j in range(len(counts)) if state['active'][j]]
+    if not counts:
+        return 0.0, 0, 0
+    return float(sum(counts))/len(counts), min(counts), max(counts)
+
+def checkBackends(positions, velocities, settings, steps=3):
+    '''
+        runs the same particles through every available backend, with full and half pair lists, and compares the
+        results with the pure python backend using full pair lists
+
+        positions:    list of x,y,z coordinates of every particle
+        velocities:    list of x,y,z velocities of every particle
+        settings:    dictionary from findSolverSettings
+        steps:    number of frames to solve
+        return:    dictionary of (backend name, 'Full' or 'Half') to a tuple of the largest difference from the pure python
+                   backend, relative to the size of the compared values, and the time in seconds each frame took
+    '''
+    results, reference = {}, None
+    for name, pairList in [(n, p) for n in ['Python'] + [n for n in findAvailableBackends() if n != 'Python'] for p in ['Full', 'Half']]:
+        backend, runSettings = BACKENDS[name], dict(settings, halfPairs=pairList == 'Half')
+        state = createSolverState(backend, positions, velocities)
+        startTime = time.time()
+        for step in range(steps):
+            stepFluid(backend, state, runSettings)
+        seconds = (time.time() - startTime)/steps
+        values = [[v for value in backend['toVectors'](state['position']) for v in value],
+                  [v for value in backend['toVectors'](state['velocity']) for v in value], backend['toScalars'](state['density'])]
+        if reference is None:
+            reference = values
+        difference = max([max([abs(a - b) for a, b in zip(field, expected)] or [0.0])/max([1.0] + [abs(b) for b in expected])
+                          for field, expected in zip(values, reference)])
+        results[(name, pairList)] = (difference, seconds)
+    return results
+
+CALIBRATION_FILE = os.path.join(os.path.expanduser('~'), 'fluidCalibration.json') # per machine timings written by the calibrate command
+DEFAULT_CALIBRATION = {'Python': {'particleSeconds': 1e-5, 'pairSeconds': 1.5e-5, 'particleBytes': 965.0, 'pairBytes': 250.0},
+                       'NumPy': {'particleSeconds': 7e-6, 'pairSeconds': 5e-7, 'particleBytes': 100.0, 'pairBytes': 55.0},
+                       'Numba': {'particleSeconds': 5e-6, 'pairSeconds': 4.5e-7, 'particleBytes': 100.0, 'pairBytes': 55.0},
+                       'keySeconds': 1e-4}
+# cost of one frame on a reference machine, used until the calibrate command has measured this one. keySeconds is
+# the time maya takes to set one keyframe, which cannot be measured outside of maya
+DEFAULT_BUDGET = {'Time Budget': 30.0, 'Memory Budget': 4096.0} # minutes and megabytes a simulation may use before the user is warned
+MIN_CLUSTER_RADIUS = 0.01 # smallest cluster radius chosen automatically, the kernels divide by high powers of the cluster radius
+AUTO_RADIUS_CFL = 0.45 # share of the health monitor's CFL limit a landing particle may reach with an automatic cluster radius
+SPAWN_LAYOUTS = {'uniform-box': ('Bounding_Box', 1), 'random-box': ('Bounding_Box', 2), 'uniform-cylinder': ('Cylindrical', 1),
+                 'random-cylinder': ('Cylindrical', 2), 'emitter': ('Emitter', 1)} # command line names of the spawn layouts of the Orientation tab
+
+def findSpawnPositions(params, rand):
+    '''
+        finds where the particle generators will spawn particles, without creating them
+
+        params:    dictionary containing values for each user specified parameter
+        rand:    random number generator seeded with the Random Seed, so the random layouts match the generators
+        return:    list of x,y,z coordinates of every particle, or None for the emitter, which has no spawn layout
+    '''
+    shape, distribution = params['Spawn Layout']
+    n, positions = params['No. of Particles'], []
+    if shape == 'Bounding_Box' and distribution == 1: # follows uniformBoxGenerator
+        x = int(n**1/100)
+        spacing = params['Spawn Radius']/x
+        for k in range(x):
+            for j in range(x):
+                for i in range(x):
+                    positions.append([(j+1)*spacing, (k+1)*spacing, i*spacing])
+    elif params.get('Poisson Disk') and distribution == 2: # follows the random generators with Poisson Disk Spacing
+        positions = findPoissonLayout(params, shape, rand)
+    elif shape == 'Bounding_Box': # follows randomBoxGenerator
+        positions = [[rand.uniform(-params['Spawn Radius'], params['Spawn Radius']) for j in range(3)] for i in range(n)]
+    elif shape == 'Cylindrical': # follows uniformCylinderGenerator and randomCylinderGenerator
+        distBetweenS, randomNess = [0.25, 0.2][distribution-1], 1.2
+        for k in range(int(n**1/100)):
+            for j in range(int(n**1/100)/2):
+                numberOfCx = int(2.0*m.pi*j*0.25/distBetweenS)
+                for i in range(numberOfCx):
+                    theta = m.radians(i*360.0/numberOfCx)
+                    pos = [j*0.25*m.cos(theta), (k+1)*0.25, j*0.25*m.sin(theta)]
+                    if distribution == 2:
+                        pos[0] *= rand.uniform(-randomNess, randomNess)
+                        pos[2] *= rand.uniform(-randomNess, randomNess)
+                        pos[1] *= rand.uniform(-randomNess, randomNess)
+                    positions.append(pos)
+    else:
+        return None
+    return positions
+
+POISSON_ATTEMPTS = 30 # candidates tried around a sample before it stops growing the Poisson disk layout
+POISSON_PACKING = 0.6 # points of a full Poisson disk layout per spacing cubed of volume
+POISSON_OFFSETS = [(a, b, c) for a in range(-2, 3) for b in range(-2, 3) for c in range(-2, 3) if abs(a)+abs(b)+abs(c) < 6]
+# grid cells around a candidate that can hold a point closer than the spacing, the far corners of the 5x5x5 block cannot
+RELAX_STEP = 0.25 # furthest a particle moves in one relaxation step, as a fraction of the particle radius
+
+def createBoxVolume(lower, upper):
+    '''
+        creates a volume particles can be spawned in, for an axis aligned box
+
+        lower:    smallest x,y,z coordinates of the box
+        upper:    largest x,y,z coordinates of the box
+        return:    dictionary holding the bounds and size of the volume, a test of whether a point is inside it and a
+                   function moving a point back inside it
+    '''
+    lower, upper = list(lower), list(upper)
+    return {'lower': lower, 'upper': upper, 'volume': (upper[0]-lower[0])*(upper[1]-lower[1])*(upper[2]-lower[2]),
+            'inside': lambda p: all([lower[l] <= p[l] <= upper[l] for l in range(3)]),
+            'clamp': lambda p: [min(max(p[l], lower[l]), upper[l]) for l in range(3)]}
+
+def createCylinderVolume(radius, bottom, top):
+    '''
+        creates a volume particles can be spawned in, for an upright cylinder around the y axis
+
+        radius:    radius of the cylinder
+        bottom:    y coordinate of the bottom of the cylinder
+        top:    y coordinate of the top of the cylinder
+        return:    dictionary of the volume, as from createBoxVolume
+    '''
+    def clamp(p):
+        d = m.sqrt(p[0]**2 + p[2]**2)
+        scale = radius/d if d > radius else 1.0
+        return [p[0]*scale, min(max(p[1], bottom), top), p[2]*scale]
+    return {'lower': [-radius, bottom, -radius], 'upper': [radius, top, radius], 'volume': m.pi*radius**2*(top-bottom),
+            'inside': lambda p: p[0]**2 + p[2]**2 <= radius**2 and bottom <= p[1] <= top, 'clamp': clamp}
+
+def findVolumeSize(volume, rand, samples=2000):
+    '''
+        return:    the size of a volume, estimated from the share of random points in its bounds inside it when the
+                   volume does not give its size
+    '''
+    if 'volume' in volume:
+        return volume['volume']
+    lower, upper = volume['lower'], volume['upper']
+    hits = sum([volume['inside']([rand.uniform(lower[l], upper[l]) for l in range(3)]) for i in range(samples)])
+    return (upper[0]-lower[0])*(upper[1]-lower[1])*(upper[2]-lower[2])*hits/float(samples)
+
+def isFarFromSamples(pos, cell, grid, samples, spacing2):
+    '''
+        return:    whether no point in the grid cells around a cell is closer to pos than the spacing, given squared
+    '''
+    for a, b, c in POISSON_OFFSETS:
+        other = grid.get((cell[0]+a, cell[1]+b, cell[2]+c))
+        if other is not None:
+            q = samples[other]
+            if (q[0]-pos[0])**2 + (q[1]-pos[1])**2 + (q[2]-pos[2])**2 < spacing2:
+                return False
+    return True
+
+def poissonDiskSample(volume, spacing, rand, count=None):
+    '''
+        fills a volume with points no closer than the spacing to each other by growing the layout outwards from a
+        random point. A background grid with cells one spacing across diagonally holds at most one point per cell, so
+        checking a candidate only visits the cells around it and the whole layout takes O(N).
+
+        volume:    dictionary from createBoxVolume, createCylinderVolume or any dictionary with the same entries
+        spacing:    smallest distance between two points
+        rand:    random number generator
+        count:    optional number of points to stop at
+        return:    list of x,y,z coordinates, in the order they were placed
+    '''
+    lower, upper = volume['lower'], volume['upper']
+    cellSize = spacing/m.sqrt(3)
+    grid, samples, growing = {}, [], []
+    for attempt in range(1000): # the first point is placed anywhere inside the volume
+        pos = [rand.uniform(lower[l], upper[l]) for l in range(3)]
+        if volume['inside'](pos):
+            samples.append(pos)
+            growing.append(0)
+            grid[tuple([int((pos[l]-lower[l])//cellSize) for l in range(3)])] = 0
+            break
+    while growing and (count is None or len(samples) < count):
+        k = rand.randrange(len(growing))
+        centre = samples[growing[k]]
+        for attempt in range(POISSON_ATTEMPTS):
+            direction = [rand.gauss(0.0, 1.0) for l in range(3)]
+            length = m.sqrt(sum([d*d for d in direction])) or 1.0
+            distance = spacing*(1.0 + rand.random()) # candidates lie between one and two spacings from the centre
+            pos = [centre[l] + distance*direction[l]/length for l in range(3)]
+            if not volume['inside'](pos):
+                continue
+            cell = tuple([int((pos[l]-lower[l])//cellSize) for l in range(3)])
+            if not isFarFromSamples(pos, cell, grid, samples, spacing*spacing):
+                continue
+            grid[cell] = len(samples)
+            growing.append(len(samples))
+            samples.append(pos)
+            break
+        else:
+            growing[k] = growing[-1] # nothing fits around this point any more
+            growing.pop()
+    return samples
+
+def fillVolume(volume, count, rand, spacing=0.0):
+    '''
+        spawns particles in a volume with Poisson disk spacing. The volume is filled completely and surplus points are
+        removed at random, which leaves the spacing intact and spreads the particles through the whole volume.
+
+        volume:    dictionary from createBoxVolume or createCylinderVolume
+        count:    number of particles to spawn
+        rand:    random number generator
+        spacing:    smallest distance between particles, 0 chooses a spacing that just fits every particle
+        return:    list of x,y,z coordinates, fewer than count if they do not fit at the given spacing
+    '''
+    if count <= 0:
+        return []
+    fitted = spacing <= 0
+    if fitted:
+        spacing = 0.97*(POISSON_PACKING*findVolumeSize(volume, rand)/count)**(1.0/3)
+    for attempt in range(5):
+        positions = poissonDiskSample(volume, spacing, rand)
+        if len(positions) >= count or not fitted:
+            break
+        spacing *= 0.98*(float(len(positions))/count)**(1.0/3) # the volume edges hold fewer points than the packing suggests
+    if len(positions) < count:
+        print 'Only %d of %d particles fit the spawn volume %.4f apart.' % (len(positions), count, spacing)
+        return positions
+    return [positions[i] for i in sorted(rand.sample(range(len(positions)), count))]
+
+def findPoissonLayout(params, shape, rand):
+    '''
+        spawns particles with Poisson disk spacing in the box or cylinder the random layouts spawn in
+
+        params:    dictionary containing values for each user specified parameter
+        shape:    'Bounding_Box' or 'Cylindrical'
+        rand:    random number generator seeded with the Random Seed
+        return:    list of x,y,z coordinates of every particle
+    '''
+    n = params['No. of Particles']
+    if shape == 'Bounding_Box':
+        volume, count = createBoxVolume([-params['Spawn Radius']]*3, [params['Spawn Radius']]*3), n
+    else:
+        rings, tiers = int(n**1/100)/2, int(n**1/100)
+        volume = createCylinderVolume(max(rings-1, 1)*0.25, 0.25, max(tiers, 1)*0.25) # the extent of the uniform cylinder
+        count = tiers*sum([int(2.0*m.pi*j*0.25/0.2) for j in range(rings)]) # as many particles as the random cylinder
+    return fillVolume(volume, count, rand, params.get('Spawn Spacing', 0.0))
+
+def findLayoutVolume(shape, positions):
+    '''
+        return:    the box or cylinder around spawned particles, which relaxation keeps them in
+    '''
+    if shape == 'Cylindrical':
+        heights = [p[1] for p in positions]
+        return createCylinderVolume(max([m.sqrt(p[0]**2 + p[2]**2) for p in positions]), min(heights), max(heights))
+    return createBoxVolume([min([p[l] for p in positions]) for l in range(3)], [max([p[l] for p in positions]) for l in range(3)])
+
+def relaxPositions(positions, params, volume, steps):
+    '''
+        evens out the density of spawned particles, so overlapping particles do not start with huge pressure forces.
+        Each step finds the density and pressure forces without gravity and moves every particle along its force,
+        the particle with the largest force by RELAX_STEP particle radii. No velocity is kept between steps.
+
+        positions:    list of x,y,z coordinates of every particle
+        params:    dictionary containing values for each user specified parameter
+        volume:    dictionary of the volume the particles are kept in
+        steps:    number of relaxation steps
+        return:    list of relaxed coordinates, and the largest pressure force before and after
+    '''
+    settings = findSolverSettings(params)
+    settings['gravity'], settings['buoyancy'], settings['delta'] = [0.0, 0.0, 0.0], 0.0, 0.0 # only pressure moves the particles
+    backend = selectBackend(params.get('Backend', 'Auto'))
+    state = createSolverState(backend, positions, [[0.0, 0.0, 0.0]]*len(positions))
+    stages = ['findNeighbours', 'findDensity', 'findForces']
+    stepFluid(backend, state, settings, stages)
+    forces = backend['toVectors'](state['forces'])
+    before = largest = max([m.sqrt(sum([f*f for f in force])) for force in forces])
+    for step in range(steps):
+        if largest == 0:
+            break
+        scale = RELAX_STEP*settings['particleRadius']*(1.0 - float(step)/steps)/largest # shorter steps settle the particles instead of letting them swap places
+        positions = [volume['clamp']([pos[l] + scale*force[l] for l in range(3)]) for pos, force in zip(backend['toVectors'](state['position']), forces)]
+        state = createSolverState(backend, positions, [[0.0, 0.0, 0.0]]*len(positions))
+        stepFluid(backend, state, settings, stages)
+        forces = backend['toVectors'](state['forces'])
+        largest = max([m.sqrt(sum([f*f for f in force])) for force in forces])
+    return backend['toVectors'](state['position']), before, largest
+
+def findRelaxedLayout(params, shape, positions):
+    '''
+        relaxes spawned particles for the Relax Steps of the parameters. Relaxed layouts are kept in the Relax
+        Directory keyed by the spawned positions and solver settings, so spawning the same layout again reuses them.
+
+        params:    dictionary containing values for each user specified parameter
+        shape:    'Bounding_Box' or 'Cylindrical'
+        positions:    list of x,y,z coordinates of every spawned particle
+        return:    list of relaxed coordinates, or the positions unchanged when relaxation is off
+    '''
+    steps = params.get('Relax Steps', 0)
+    if steps <= 0 or len(positions) < 2:
+        return positions
+    positions = [[float(v) for v in pos] for pos in positions]
+    key = hashlib.sha1(json.dumps({'positions': positions, 'settings': findSolverSettings(params), 'steps': steps, 'shape': shape,
+                                   'version': SOLVER_VERSION}, sort_keys=True)).hexdigest()
+    relaxDir = params.get('Relax Directory')
+    path = os.path.join(relaxDir, key + '.json') if relaxDir else None
+    if path and os.path.isfile(path):
+        with open(path) as relaxFile:
+            print 'Loaded a relaxed spawn layout.'
+            return json.load(relaxFile)
+    startTime = time.time()
+    relaxed, before, after = relaxPositions(positions, params, findLayoutVolume(shape, positions), steps)
+    print 'Relaxed the spawn layout in %.1f seconds, the largest pressure force went from %.3g to %.3g.' % (time.time() - startTime, before, after)
+    if path:
+        if not os.path.isdir(relaxDir):
+            os.makedirs(relaxDir)
+        with open(path, 'w') as relaxFile:
+            json.dump(relaxed, relaxFile)
+    return relaxed
+
+def estimateNeighbours(positions, settings, rand, samples=500):
+    '''
+        estimates the average number of neighbours of a particle by counting the neighbours of a sample of particles
+
+        positions:    list of x,y,z coordinates of every particle
+        settings:    dictionary from findSolverSettings
+        rand:    random number generator used to pick the sample
+        samples:    most particles to count the neighbours of
+        return:    average number of neighbours, counting the particle itself like the solver does
+    '''
+    if not positions:
+        return 0.0
+    cutoff = settings['clusterRadius'] + 2*settings['particleRadius']
+    grid = buildSpatialGrid(positions, cutoff)
+    picks = positions if len(positions) <= samples else rand.sample(positions, samples)
+    counts = [len([j for j in findNearbyParticles(p, grid, cutoff) if m.sqrt(sum([(positions[j][l]-p[l])**2 for l in range(3)])) - 2*settings['particleRadius'] <= settings['clusterRadius']])
+              for p in picks]
+    return float(sum(counts))/len(counts)
+
+def tuneClusterRadius(positions, particleRadius, target, rand, samples=200):
+    '''
+        finds the cluster radius which gives particles a target number of neighbours on average. The sorted distances
+        from a sample of particles to every particle are searched for the neighbourhood size at which the average
+        count reaches the target.
+
+        positions:    list of x,y,z coordinates of every particle
+        particleRadius:    the radius of each particle within the system
+        target:    number of neighbours wanted for each particle, counting the particle itself
+        rand:    random number generator used to pick the sample
+        samples:    most particles to measure the distances from
+        return:    the cluster radius, never less than MIN_CLUSTER_RADIUS
+    '''
+    if not positions:
+        return MIN_CLUSTER_RADIUS
+    picks = positions if len(positions) <= samples else rand.sample(positions, samples)
+    if np is not None:
+        points = np.array(positions, dtype=np.float64)
+        distances = [np.sort(np.sqrt(((points - p)**2).sum(axis=1))).tolist() for p in picks]
+    else:
+        distances = [sorted([m.sqrt(sum([(q[l]-p[l])**2 for l in range(3)])) for q in positions]) for p in picks]
+    target = min(target, len(positions))
+    low, high = 0.0, max([d[-1] for d in distances])
+    for step in range(50): # halves the range of possible neighbourhood sizes each step
+        reach = (low + high)/2
+        if float(sum([bisect.bisect_right(d, reach) for d in distances]))/len(distances) >= target:
+            high = reach
+        else:
+            low = reach
+    return max(high - 2*particleRadius, MIN_CLUSTER_RADIUS) # particles are neighbours when their distance less both radii is within the cluster radius
+
+def findStableClusterRadius(positions, velocities, settings, offset=None):
+    '''
+        finds the smallest cluster radius the automatic cluster radius may choose. The highest particle falling onto
+        the floor of the container may move no more than AUTO_RADIUS_CFL of the health monitor's CFL limit in one
+        step, so a radius chosen for a target neighbour count never shrinks below what the fluid moves in a step.
+
+        positions:    list of x,y,z coordinates of the particles in use
+        velocities:    list of x,y,z velocities of those particles
+        settings:    dictionary from findSolverSettings
+        offset:    optional x,y,z offset the particles are moved by on the first frame
+        return:    the smallest stable cluster radius
+    '''
+    if not positions:
+        return MIN_CLUSTER_RADIUS
+    fall = max(max([pos[1] for pos in positions]) + (offset[1] if offset else 0.0) + settings['tankSize'], 0.0) # the floor of the container is at -tankSize
+    gravity = m.sqrt(sum([g*g for g in settings['gravity']]))
+    speed = max([m.sqrt(sum([v*v for v in vel])) for vel in velocities] or [0.0])
+    landing = m.sqrt(speed**2 + 2*gravity*fall) # the speed the highest particle lands with if it keeps all of its energy
+    return max(landing*settings['timeStep']/(AUTO_RADIUS_CFL*HEALTH_CFL), MIN_CLUSTER_RADIUS)
+
+def findSettledNeighbours(settings):
+    '''
+        estimates the number of neighbours of a particle once the fluid has settled in the cup, taking particles to be
+        packed in a grid with touching spheres
+
+        settings:    dictionary from findSolverSettings
+        return:    number of neighbours, counting the particle itself
+    '''
+    spacing = 2*settings['particleRadius']
+    reach = int((settings['clusterRadius'] + spacing)/spacing)
+    return sum([1 for a in range(-reach, reach+1) for b in range(-reach, reach+1) for c in range(-reach, reach+1)
+                if m.sqrt(a*a + b*b + c*c)*spacing - spacing <= settings['clusterRadius']])
+
+def loadCalibration(path=CALIBRATION_FILE):
+    '''
+        loads the per machine timings written by calibrateBackends, falling back to the reference machine
+
+        path:    calibration file
+        return:    dictionary of backend names to their cost coefficients
+    '''
+    calibration = json.loads(json.dumps(DEFAULT_CALIBRATION))
+    if os.path.exists(path):
+        with open(path) as calibrationFile:
+            calibration.update(json.load(calibrationFile))
+    return calibration
+
+def findStateSize(value):
+    '''
+        finds the memory held by a solver state, including every list, number and numpy array inside it
+
+        value:    solver state or any value inside it
+        return:    size in bytes
+    '''
+    if np is not None and isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum([findStateSize(v) for v in value.values()])
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum([findStateSize(v) for v in value])
+    return sys.getsizeof(value)
+
+def fitCost(samples):
+    '''
+        fits a cost of the form a*particles + b*pairs to measured samples by least squares
+
+        samples:    list of (particles, pairs, cost) tuples
+        return:    the coefficients a and b, neither of which is negative
+    '''
+    nn = sum([n*n for n, p, c in samples])
+    npr = sum([n*p for n, p, c in samples])
+    pp = sum([p*p for n, p, c in samples])
+    nc = sum([n*c for n, p, c in samples])
+    pc = sum([p*c for n, p, c in samples])
+    det = nn*pp - npr*npr
+    if det == 0:
+        return 0.0, (pc/pp if pp else 0.0)
+    a, b = (nc*pp - pc*npr)/det, (pc*nn - nc*npr)/det
+    if a < 0:
+        a, b = 0.0, pc/pp
+    if b < 0:
+        a, b = nc/nn, 0.0
+    return a, b
+
+def calibrateBackends(path=CALIBRATION_FILE, sizes=((150, 0.5), (300, 0.5), (300, 1.0), (600, 1.0)), steps=2):
+    '''
+        times every available backend on random boxes of particles of different sizes and densities and stores how
+        long a frame takes and how much memory the solver holds per particle and per neighbour pair
+
+        path:    calibration file to write
+        sizes:    list of (number of particles, spawn radius) to benchmark
+        steps:    frames timed for each size
+        return:    dictionary of the calibration written
+    '''
+    calibration = loadCalibration(path)
+    settings = findSolverSettings(DEFAULT_PARAMS)
+    rand = rd.Random(0)
+    for name in findAvailableBackends():
+        backend, times, sizesUsed = BACKENDS[name], [], []
+        for n, spawnRadius in sizes:
+            positions = [[rand.uniform(-spawnRadius, spawnRadius) for l in range(3)] for j in range(n)]
+            state = createSolverState(backend, positions, [list(DEFAULT_PARAMS['Initial Velocity'][0])]*n)
+            stepFluid(backend, state, settings) # the first frame also warms up caches and compiled code
+            startTime = time.time()
+            for step in range(steps):
+                stepFluid(backend, state, settings)
+            pairs = findNeighbourStats(state)[0]*n # the cost is fitted to the neighbours of every particle, whichever pair list the solver used
+            times.append((n, pairs, (time.time() - startTime)/steps))
+            sizesUsed.append((n, pairs, findStateSize(state)))
+        particleSeconds, pairSeconds = fitCost(times)
+        particleBytes, pairBytes = fitCost(sizesUsed)
+        calibration[name] = {'particleSeconds': particleSeconds, 'pairSeconds': pairSeconds, 'particleBytes': particleBytes, 'pairBytes': pairBytes}
+        print '%-8s %.3g s per particle, %.3g s per pair, %.0f bytes per particle, %.0f bytes per pair' % (name, particleSeconds, pairSeconds, particleBytes, pairBytes)
+    with open(path, 'w') as calibrationFile:
+        json.dump(calibration, calibrationFile, indent=1, sort_keys=True)
+    return calibration
+
+def planSimulation(params, calibration=None, keyframes=True):
+    '''
+        predicts the time and memory a simulation will take before anything is spawned. Neighbour counts are sampled
+        from the spawn layout and from a settled fluid, and the larger is used since particles usually pack closer
+        once they land in the cup.
+
+        params:    dictionary containing values for each user specified parameter
+        calibration:    dictionary from loadCalibration, loaded from the calibration file by default
+        keyframes:    whether maya keyframes every particle on every frame
+        return:    dictionary of the plan, holding the backend, number of particles, neighbours, seconds per frame,
+                   total seconds and peak memory in bytes
+    '''
+    calibration = calibration or loadCalibration()
+    settings = findSolverSettings(params)
+    backend = params.get('Backend', 'Auto')
+    if backend not in BACKENDS or not loadBackend(BACKENDS[backend]):
+        backend = findAvailableBackends()[0]
+    rand = rd.Random(params.get('Random Seed', 0))
+    positions = findSpawnPositions(params, rand)
+    if params.get('Auto Cluster Radius') and positions:
+        settings['clusterRadius'] = max(tuneClusterRadius(positions, settings['particleRadius'], params['Target Neighbours'], rand),
+                                        findStableClusterRadius(positions, params['Initial Velocity']*len(positions), settings, SPAWN_OFFSET))
+    settled = findSettledNeighbours(settings)
+    if params.get('Auto Cluster Radius') and params.get('Adapt Interval', 0) > 0:
+        settled = params['Target Neighbours'] # the radius shrinks as the fluid packs together, keeping the neighbour count near the target
+    if positions is None:
+        numParticles, spawned = params['Pool Size'], settled
+    else:
+        numParticles, spawned = len(positions), estimateNeighbours(positions, settings, rand)
+    neighbours = max(spawned, min(settled, numParticles))
+    solvedPairs = numParticles*min(neighbours, params.get('Max Neighbours') or neighbours) # the neighbour search measures every neighbour but only keeps the nearest
+    cost = calibration.get(backend, DEFAULT_CALIBRATION[backend])
+    frameSeconds = cost['particleSeconds']*numParticles + cost['pairSeconds']*solvedPairs
+    if positions is not None:
+        frameSeconds /= max(params.get('Frames Per Step', 1), 1) # frames in between coarse steps are interpolated, assuming none fall back to solving
+    if keyframes:
+        frameSeconds += 3*numParticles*calibration['keySeconds']
+    return {'backend': backend, 'particles': numParticles, 'spawnNeighbours': spawned, 'settledNeighbours': settled,
+            'clusterRadius': settings['clusterRadius'], 'frameSeconds': frameSeconds, 'totalSeconds': frameSeconds*max(params['No. of Frames']-1, 0),
+            'memoryBytes': cost['particleBytes']*numParticles + cost['pairBytes']*solvedPairs}
+
+def checkBudget(plan, budget):
+    '''
+        compares a plan against a budget
+
+        plan:    dictionary from planSimulation
+        budget:    dictionary of 'Time Budget' in minutes and 'Memory Budget' in megabytes
+        return:    list of messages describing each budget the plan goes over, empty if it fits
+    '''
+    problems = []
+    if plan['totalSeconds'] > 60*budget['Time Budget']:
+        problems.append('The simulation is expected to take %.0f minutes, over the budget of %.0f minutes.' % (plan['totalSeconds']/60, budget['Time Budget']))
+    if plan['memoryBytes'] > 1024**2*budget['Memory Budget']:
+        problems.append('The solver is expected to need %.0f MB, over the budget of %.0f MB.' % (plan['memoryBytes']/1024.0**2, budget['Memory Budget']))
+    return problems
+
+def formatPlan(plan):
+    '''
+        plan:    dictionary from planSimulation
+        return:    the plan as readable text
+    '''
+    return ('%d particles on the %s backend with a cluster radius of %.3f\n' % (plan['particles'], plan['backend'], plan.get('clusterRadius', 0.0)) +
+            'about %.0f neighbours per particle at the start and %.0f once settled\n' % (plan['spawnNeighbours'], plan['settledNeighbours']) +
+            '%.2f seconds per frame, %.1f minutes in total, %.0f MB of solver memory' % (plan['frameSeconds'], plan['totalSeconds']/60, plan['memoryBytes']/1024.0**2))
+
+CACHE_FIELDS = [('id', 'i', 1), ('position', 'f', 3), ('velocity', 'f', 3), ('density', 'f', 1), ('pressure', 'f', 1), ('phase', 'i', 1), ('age', 'i', 1), ('level', 'i', 1)]
+# fields stored for every particle in each frame of the particle cache as (name, array typecode, values per particle), age is only stored for poured particles
+SNAPSHOT_FIELDS = [('id', 'i', 1), ('position', 'd', 3), ('velocity', 'd', 3), ('age', 'i', 1), ('level', 'i', 1)]
+# fields of the solver snapshots, written like the particle cache but at full precision so a simulation can be resumed from any frame
+
+def findCacheFile(cacheDir, frame):
+    '''
+        finds the path of the particle cache file holding a given frame
+        
+        cacheDir:    directory containing the particle cache
+        frame:    frame number of the simulation
+        return:    path of the cache file for that frame
+    '''
+    return os.path.join(cacheDir, 'particles.%04d.pc' % frame)
+
+def listCacheFrames(cacheDir):
+    '''
+        lists the frames that have been written to a particle cache
+        
+        cacheDir:    directory containing the particle cache
+        return:    sorted list of frame numbers found in the cache
+    '''
+    frames = []
+    for f in glob.glob(os.path.join(cacheDir, 'particles.*.pc')):
+        frames.append(int(os.path.basename(f).split('.')[1])) # the frame number sits between the two dots of the file name
+    return sorted(frames)
+
+def clearParticleCache(cacheDir, fromFrame=1):
+    '''
+        creates the cache directory if it does not exist and removes frames left by a previous simulation
+        
+        cacheDir:    directory containing the particle cache
+        fromFrame:    first frame to remove, earlier frames are kept
+    '''
+    if not os.path.isdir(cacheDir):
+        os.makedirs(cacheDir)
+    for frame in listCacheFrames(cacheDir):
+        if frame >= fromFrame:
+            os.remove(findCacheFile(cacheDir, frame))
+
+def sortFrameById(frameData):
+    '''
+        copies the per-particle values of a frame into lists sorted by the stable id of each particle. The copy 
+        no longer shares any lists with the solver, so it can safely be handed to another thread.
+        
+        frameData:    dictionary of field names in CACHE_FIELDS to a list containing the value of that field for every particle
+        return:    dictionary of the same fields, with every list in order of particle id
+    '''
+    order = sorted(range(len(frameData['id'])), key=lambda i: frameData['id'][i])
+    sortedData = {}
+    for name, typecode, width in CACHE_FIELDS:
+        if name in frameData:
+            values = frameData[name]
+            if width == 1:
+                sortedData[name] = [values[i] for i in order]
+            else:
+                sortedData[name] = [tuple(values[i]) for i in order]
+    return sortedData
+
+def writeParticleCache(cacheDir, frame, frameData, attributes, fields=CACHE_FIELDS, encoder=None):
+    '''
+        writes the state of every particle for one frame to the particle cache. Each file starts with a single line 
+        json header describing the fields, followed by the raw binary values of each field. Particles are written 
+        in order of their id, so every frame of the cache lists the particles in the same order regardless of how
+        the solver has reordered them in memory.
+        
+        cacheDir:    directory containing the particle cache
+        frame:    frame number of the simulation
+        frameData:    dictionary of field names in CACHE_FIELDS to a list containing the value of that field for every particle
+        attributes:    dictionary of simulation values stored alongside the frame, i.e particle radius and time step
+        fields:    list of (name, array typecode, values per particle) of the fields that may be written
+        encoder:    optional dictionary from createCacheEncoder, which writes the frame compressed
+    '''
+    frameData = sortFrameById(frameData) # writes the particles sorted by their stable id
+    count = len(frameData['id'])
+    fields = [f for f in fields if f[0] in frameData]
+    header = {'frame': frame, 'count': count, 'byteorder': sys.byteorder, 'attributes': attributes,
+              'fields': [list(f) for f in fields]}
+    blocks = encodeCacheFrame(encoder, frame, frameData, attributes, fields, header) if encoder else None
+    path = findCacheFile(cacheDir, frame)
+    tmpPath = path + '.tmp' # the frame is written to a temporary file first, so readers never see a half written frame
+    cacheFile = open(tmpPath, 'wb')
+    cacheFile.write(json.dumps(header) + '\n')
+    if blocks is not None:
+        cacheFile.write(''.join(blocks))
+    else:
+        for name, typecode, width in fields:
+            values = frameData[name]
+            if width == 1:
+                flat = values
+            else:
+                flat = [v[l] for v in values for l in range(width)]
+            array.array(typecode, flat).tofile(cacheFile)
+    cacheFile.close()
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(tmpPath, path)
+
+def readParticleCache(path):
+    '''
+        reads a single frame of the particle cache
+        
+        path:    path of the cache file
+        return:    dictionary containing the frame number, the count of particles, the stored attributes and a list 
+                   of values for every field, i.e data['position'] = [(x,y,z), (x,y,z) ...]
+    '''
+    cacheFile = open(path, 'rb')
+    header = json.loads(cacheFile.readline())
+    if 'encoding' in header:
+        body = cacheFile.read()
+        cacheFile.close()
+        return decodeCacheFrame(path, header, body)
+    count = header['count']
+    data = {'frame': header['frame'], 'count': count, 'attributes': header['attributes']}
+    for name, typecode, width in header['fields']:
+        values = array.array(str(typecode))
+        values.fromfile(cacheFile, count*width)
+        if header['byteorder'] != sys.byteorder:
+            values.byteswap() # the cache was written on a machine with a different byte order
+        if width == 1:
+            data[name] = values.tolist()
+        else:
+            data[name] = [tuple(values[i*width:(i+1)*width]) for i in range(count)]
+    cacheFile.close()
+    return data
+
+CACHE_PRECISION = 1e-5 # default step positions are rounded to in a compressed cache, relative to the width of the tank
+CACHE_KEYFRAME_INTERVAL = 10 # frames between the frames of a compressed cache which can be read without reading the frames before them
+LAST_DECODED = {} # the last compressed frame read, so frames read in order are each decoded from the frame before
+
+def createCacheEncoder(precision=CACHE_PRECISION, keyframeInterval=CACHE_KEYFRAME_INTERVAL):
+    '''
+        creates the state of a compressed particle cache, which is handed to writeParticleCache for every frame in
+        order. Positions are rounded to a fixed step and stored as the difference from where the previous frame and
+        its velocity predicted them to be. Every keyframeInterval frames a keyframe is stored without a prediction,
+        so reading a frame never needs more than keyframeInterval earlier frames.
+
+        precision:    step positions are rounded to, relative to the width of the tank
+        keyframeInterval:    number of frames between keyframes
+        return:    dictionary of the encoder
+    '''
+    return {'precision': precision, 'keyframeInterval': keyframeInterval, 'previous': None, 'previousFrame': None, 'keyframe': None}
+
+def zigzag(values):
+    return [v + v if v >= 0 else -v - v - 1 for v in values] # interleaves positive and negative integers, so small values of either sign stay small
+
+def unzigzag(values):
+    return [v >> 1 if not v & 1 else -((v + 1) >> 1) for v in values]
+
+def packBlock(values, typecode):
+    '''
+        compresses a list of values. The first bytes of every value are grouped together, then the second bytes and
+        so on, which leaves long runs of equal bytes for zlib when the values are of a similar size.
+    '''
+    values = array.array(typecode, values)
+    raw = values.tostring()
+    return zlib.compress(''.join([raw[k::values.itemsize] for k in range(values.itemsize)]), 6)
+
+def unpackBlock(block, typecode, byteorder):
+    '''
+        reverses packBlock
+
+        return:    array of the values
+    '''
+    values = array.array(str(typecode))
+    shuffled = zlib.decompress(block)
+    count = len(shuffled)//values.itemsize
+    raw = bytearray(len(shuffled))
+    for k in range(values.itemsize):
+        raw[k::values.itemsize] = shuffled[k*count:(k+1)*count]
+    values.fromstring(str(raw))
+    if byteorder != sys.byteorder:
+        values.byteswap() # the cache was written on a machine with a different byte order
+    return values
+
+def findCacheQuanta(precision, attributes):
+    '''
+        return:    the step positions are rounded to, and the step velocities are rounded to. A velocity step times the
+                   time step is one position step, so a position predicted from a velocity stays a whole number of steps.
+    '''
+    quantum = precision*2*attributes.get('tankSize', 1.0)
+    return quantum, (quantum/attributes['timeStep'] if attributes.get('timeStep') else quantum)
+
+def encodeCacheFrame(encoder, frame, frameData, attributes, fields, header):
+    '''
+        compresses a frame of the particle cache, adding the encoding to its header
+
+        encoder:    dictionary from createCacheEncoder
+        frame:    frame number of the simulation
+        frameData:    dictionary of field names to lists of values sorted by particle id
+        attributes:    dictionary of simulation values stored alongside the frame
+        fields:    list of (name, array typecode, values per particle) of the fields written
+        header:    header of the frame
+        return:    list of compressed blocks, one for each field, or None if the frame cannot be compressed, in which
+                   case it is written raw and the next frame becomes a keyframe
+    '''
+    if 'position' not in frameData or 'velocity' not in frameData:
+        return None
+    quantum, velocityQuantum = findCacheQuanta(encoder['precision'], attributes)
+    keyframe = encoder['previous'] is None or frame - encoder['keyframe'] >= encoder['keyframeInterval']
+    previous = {} if keyframe else encoder['previous']
+    ids = frameData['id']
+    positions = [[int(round(v/quantum)) for v in pos] for pos in frameData['position']]
+    velocities = [[int(round(v/velocityQuantum)) for v in vel] for vel in frameData['velocity']]
+    residuals = {'id': [ids[k] - (ids[k-1] if k else -1) for k in range(len(ids))], 'position': [], 'velocity': []}
+    for pId, pos, vel in zip(ids, positions, velocities):
+        lastPos, lastVel = previous.get(pId, ((0, 0, 0), (0, 0, 0))) # particles poured since the previous frame have no prediction
+        residuals['position'].extend([pos[l] - lastPos[l] - lastVel[l] for l in range(3)]) # predicted to carry on at the velocity of the previous frame
+        residuals['velocity'].extend([vel[l] - lastVel[l] for l in range(3)])
+    if max([abs(v) for v in residuals['position'] + residuals['velocity']] + [0]) >= 2**31:
+        encoder['previous'] = None # too far from the prediction for 32 bits, e.g when the simulation has blown up
+        return None
+    blocks = []
+    for name, typecode, width in fields:
+        if name == 'id':
+            blocks.append(packBlock(residuals['id'], 'I')) # ids are sorted, so every gap is positive
+        elif name in residuals:
+            blocks.append(packBlock(zigzag(residuals[name]), 'I'))
+        else:
+            values = frameData[name]
+            blocks.append(packBlock(values if width == 1 else [v[l] for v in values for l in range(width)], typecode))
+    header['encoding'] = {'quantum': quantum, 'velocityQuantum': velocityQuantum, 'blocks': [len(b) for b in blocks],
+                          'previous': None if keyframe else encoder['previousFrame']}
+    encoder['previous'] = dict([(pId, (tuple(pos), tuple(vel))) for pId, pos, vel in zip(ids, positions, velocities)])
+    encoder['previousFrame'] = frame
+    if keyframe:
+        encoder['keyframe'] = frame
+    return blocks
+
+def decodeCacheFrame(path, header, body):
+    '''
+        reads a compressed frame of the particle cache. Frames which are predicted from the frame before need that
+        frame decoded first, which is kept from the last read when frames are read in order.
+
+        path:    path of the cache file
+        header:    header of the frame
+        body:    the compressed blocks following the header
+        return:    dictionary of the frame, as from readParticleCache
+    '''
+    encoding, count = header['encoding'], header['count']
+    previous = {}
+    if encoding['previous'] is not None:
+        previousPath = os.path.normpath(findCacheFile(os.path.dirname(path), encoding['previous']))
+        if LAST_DECODED.get('path') != previousPath or LAST_DECODED.get('modified') != os.path.getmtime(previousPath):
+            readParticleCache(previousPath) # decodes the frames back to the last keyframe
+        previous = LAST_DECODED['state']
+    data = {'frame': header['frame'], 'count': count, 'attributes': header['attributes']}
+    offset, ids = 0, []
+    for (name, typecode, width), size in zip(header['fields'], encoding['blocks']):
+        block = body[offset:offset+size]
+        offset += size
+        if name == 'id':
+            ids = [] # ids are stored as the gap from the previous id
+            for gap in unpackBlock(block, 'I', header['byteorder']).tolist():
+                ids.append((ids[-1] if ids else -1) + gap)
+            data['id'] = ids
+        elif name == 'position' or name == 'velocity':
+            data[name] = unzigzag(unpackBlock(block, 'I', header['byteorder']).tolist())
+        else:
+            values = unpackBlock(block, typecode, header['byteorder'])
+            data[name] = values.tolist() if width == 1 else [tuple(values[i*width:(i+1)*width]) for i in range(count)]
+    state = {}
+    positions, velocities = [], []
+    for k in range(count):
+        lastPos, lastVel = previous.get(ids[k], ((0, 0, 0), (0, 0, 0)))
+        vel = tuple([data['velocity'][3*k+l] + lastVel[l] for l in range(3)])
+        pos = tuple([data['position'][3*k+l] + lastPos[l] + lastVel[l] for l in range(3)])
+        state[ids[k]] = (pos, vel)
+        positions.append(tuple([v*encoding['quantum'] for v in pos]))
+        velocities.append(tuple([v*encoding['velocityQuantum'] for v in vel]))
+    data['position'], data['velocity'] = positions, velocities
+    LAST_DECODED.update({'path': os.path.normpath(path), 'modified': os.path.getmtime(path), 'state': state})
+    return data
+
+def compressParticleCache(cacheDir, outDir, precision=CACHE_PRECISION, keyframeInterval=CACHE_KEYFRAME_INTERVAL):
+    '''
+        writes a compressed copy of a particle cache, printing how much smaller it is, how long encoding and decoding
+        took and the largest position error
+
+        cacheDir:    directory containing the particle cache
+        outDir:    directory the compressed cache is written to
+        precision:    step positions are rounded to, relative to the width of the tank
+        keyframeInterval:    number of frames between keyframes
+        return:    the size of the cache and of the compressed copy in bytes
+    '''
+    if not os.path.isdir(outDir):
+        os.makedirs(outDir)
+    encoder, rawSize, packedSize, encodeTime, decodeTime, largestError = createCacheEncoder(precision, keyframeInterval), 0, 0, 0.0, 0.0, 0.0
+    for frame in listCacheFrames(cacheDir):
+        data = readParticleCache(findCacheFile(cacheDir, frame))
+        fields = [f for f in CACHE_FIELDS if f[0] in data]
+        startTime = time.time()
+        writeParticleCache(outDir, frame, data, data['attributes'], fields, encoder)
+        encodeTime += time.time() - startTime
+        startTime = time.time()
+        decoded = readParticleCache(findCacheFile(outDir, frame))
+        decodeTime += time.time() - startTime
+        largestError = max([largestError] + [abs(a - b) for p, q in zip(data['position'], decoded['position']) for a, b in zip(p, q)])
+        rawSize += os.path.getsize(findCacheFile(cacheDir, frame))
+        packedSize += os.path.getsize(findCacheFile(outDir, frame))
+    frames = max(len(listCacheFrames(cacheDir)), 1)
+    print '%.1f MB compressed to %.1f MB (%.1fx), %.1f ms to encode and %.1f ms to decode a frame, largest position error %.2g' % (
+        rawSize/1024.0**2, packedSize/1024.0**2, float(rawSize)/max(packedSize, 1), 1000*encodeTime/frames, 1000*decodeTime/frames, largestError)
+    return rawSize, packedSize
+
+OUTPUT_MODES = ['Inline', 'Thread', 'Process'] # ways an output can take the frames yielded by the solver
+OUTPUT_LAG = 4 # default number of frames an output in a thread or process may fall behind before the solver waits for it
+OUTPUT_POLL = 0.5 # seconds between checking that a thread or process is still alive while waiting on its queue
+
+def writePlyFrame(path, frameData):
+    '''
+        writes the point data of a frame to a binary little endian .ply file
+        
+        path:    file path of the .ply
+        frameData:    dictionary of field names to per-particle values, sorted by particle id
+    '''
+    count = len(frameData['id'])
+    header = ['ply', 'format binary_little_endian 1.0', 'element vertex %d' % count, 'property int id']
+    header += ['property float %s' % p for p in ('x', 'y', 'z', 'vx', 'vy', 'vz', 'density', 'pressure')]
+    header += ['property int phase', 'end_header']
+    flat = []
+    for i in range(count):
+        flat.append(frameData['id'][i])
+        flat.extend(frameData['position'][i])
+        flat.extend(frameData['velocity'][i])
+        flat.extend((frameData['density'][i], frameData['pressure'][i], frameData['phase'][i]))
+    plyFile = open(path, 'wb')
+    plyFile.write('\n'.join(header) + '\n')
+    plyFile.write(struct.pack('<' + 'i8fi'*count, *flat)) # every vertex is stored as an interleaved record
+    plyFile.close()
+
+def writeBigEndian(vtkFile, typecode, values):
+    '''
+        writes values as raw big endian binary, which is the byte order legacy .vtk files expect
+    '''
+    data = array.array(typecode, values)
+    if sys.byteorder == 'little':
+        data.byteswap()
+    data.tofile(vtkFile)
+    vtkFile.write('\n')
+
+def writeVtkFrame(path, frameData):
+    '''
+        writes the point data of a frame to a binary legacy .vtk polydata file
+        
+        path:    file path of the .vtk
+        frameData:    dictionary of field names to per-particle values, sorted by particle id
+    '''
+    count = len(frameData['id'])
+    vtkFile = open(path, 'wb')
+    vtkFile.write('# vtk DataFile Version 3.0\nCoffee Works particles\nBINARY\nDATASET POLYDATA\n')
+    vtkFile.write('POINTS %d float\n' % count)
+    writeBigEndian(vtkFile, 'f', [v for p in frameData['position'] for v in p])
+    vtkFile.write('VERTICES %d %d\n' % (count, 2*count))
+    writeBigEndian(vtkFile, 'i', [v for i in range(count) for v in (1, i)]) # every particle is its own single point cell
+    vtkFile.write('POINT_DATA %d\n' % count)
+    vtkFile.write('SCALARS id int 1\nLOOKUP_TABLE default\n')
+    writeBigEndian(vtkFile, 'i', frameData['id'])
+    vtkFile.write('VECTORS velocity float\n')
+    writeBigEndian(vtkFile, 'f', [v for p in frameData['velocity'] for v in p])
+    for name, typecode in (('density', 'f'), ('pressure', 'f'), ('phase', 'i')):
+        vtkFile.write('SCALARS %s %s 1\nLOOKUP_TABLE default\n' % (name, 'float' if typecode == 'f' else 'int'))
+        writeBigEndian(vtkFile, typecode, frameData[name])
+    vtkFile.close()
+
+def writeCsvFrame(path, frameData):
+    '''
+        writes the point data of a frame to a .csv file with one row per particle
+        
+        path:    file path of the .csv
+        frameData:    dictionary of field names to per-particle values, sorted by particle id
+    '''
+    rows = ['id,x,y,z,vx,vy,vz,density,pressure,phase']
+    for i in range(len(frameData['id'])):
+        p, v = frameData['position'][i], frameData['velocity'][i]
+        rows.append('%d,%r,%r,%r,%r,%r,%r,%r,%r,%d' % (frameData['id'][i], p[0], p[1], p[2], v[0], v[1], v[2],
+                    frameData['density'][i], frameData['pressure'][i], frameData['phase'][i]))
+    csvFile = open(path, 'w')
+    csvFile.write('\n'.join(rows) + '\n')
+    csvFile.close()
+
+EXPORTERS = {'PLY': ('ply', writePlyFrame), 'VTK': ('vtk', writeVtkFrame), 'CSV': ('csv', writeCsvFrame)}
+# export formats to their file extension and the function writing a single frame
+
+def createFrameView(frame, frameData, details):
+    '''
+        creates the view of a frame handed to every output. The values are copied into tuples sorted by particle id,
+        so the view shares nothing with the solver and outputs in other threads or processes can read it while the
+        solver carries on.
+
+        frame:    frame number of the simulation
+        frameData:    dictionary of field names in CACHE_FIELDS to a list containing the value of that field for every particle
+        details:    dictionary of further values describing the frame, e.g the particles emitted and retired on it
+        return:    dictionary of the frame, which outputs must not change
+    '''
+    view = dict([(name, tuple(values)) for name, values in sortFrameById(frameData).items()])
+    view.update(details)
+    view['frame'] = frame
+    return view
+
+def createOutput(name, handler, args=(), finish=None, mode='Inline', lag=OUTPUT_LAG, stored=True):
+    '''
+        describes an output taking every frame of the simulation, e.g the maya baker, the particle cache or an exporter
+
+        name:    name of the output, shown when frames could not be written
+        handler:    function called as handler(view, *args) for every frame view
+        args:    further arguments of the handler and finish
+        finish:    optional function called as finish(*args) once the last frame has been handled
+        mode:    one of OUTPUT_MODES. Inline calls the handler from the solver loop, Thread from a thread and Process
+                 from a separate process, which gets its own copy of the arguments. Outputs using maya run inline.
+        lag:    most frames waiting for a thread or process before the solver is held back
+        stored:    whether the output also takes the frames loaded from the result store
+        return:    dictionary of the output, to be passed to startOutput, sendToOutput and stopOutput
+    '''
+    return {'name': name, 'handler': handler, 'args': tuple(args), 'finish': finish, 'mode': mode, 'lag': max(lag, 1),
+            'stored': stored, 'errors': [], 'dead': False}
+
+def drainOutput(handler, args, finish, frames, errors):
+    '''
+        hands the frames taken from a queue to the handler of an output until the end of the simulation is signalled
+        with None. A frame that fails to be written, for whatever reason, is recorded and the queue keeps being
+        drained, so the solver is never left waiting on it. A finish that fails is recorded with the frame None.
+    '''
+    while True:
+        view = frames.get()
+        if view is None:
+            break
+        try:
+            handler(view, *args)
+        except Exception as e:
+            errors.append((view['frame'], '%s: %s' % (type(e).__name__, e)))
+    if finish:
+        try:
+            finish(*args)
+        except Exception as e:
+            errors.append((None, '%s: %s' % (type(e).__name__, e)))
+
+def runOutputProcess(handler, args, finish, frames, results):
+    '''
+        drains the frames of an output running in its own process, then sends the frames that failed back
+    '''
+    errors = []
+    try:
+        drainOutput(handler, args, finish, frames, errors)
+    finally:
+        results.put(errors)
+
+def putOutputFrame(output, view):
+    '''
+        puts a frame, or None to end it, on the queue of an output running in a thread or process, waiting while the
+        queue is full for as long as the thread or process is alive
+
+        output:    dictionary from startOutput
+        view:    dictionary from createFrameView, or None
+        return:    whether the frame was queued, False once the output has died, which then takes no more frames
+    '''
+    while not output['dead']:
+        try:
+            output['frames'].put(view, timeout=OUTPUT_POLL)
+            return True
+        except queue.Full:
+            if not output['worker'].is_alive():
+                output['dead'] = True
+                output['errors'].append((None, 'the %s stopped, later frames were not written' % output['mode'].lower()))
+    return False
+
+def startOutput(output):
+    '''
+        starts the thread or process of an output
+
+        output:    dictionary from createOutput
+        return:    the output
+    '''
+    if output['mode'] == 'Thread':
+        output['frames'] = queue.Queue(output['lag'])
+        output['worker'] = threading.Thread(target=drainOutput, args=(output['handler'], output['args'], output['finish'], output['frames'], output['errors']))
+    elif output['mode'] == 'Process':
+        output['frames'], output['results'] = multiprocessing.Queue(output['lag']), multiprocessing.Queue()
+        output['worker'] = multiprocessing.Process(target=runOutputProcess, args=(output['handler'], output['args'], output['finish'], output['frames'], output['results']))
+    if output['mode'] != 'Inline':
+        output['worker'].daemon = True # a stuck disk will not keep maya from closing
+        output['worker'].start()
+    return output
+
+def sendToOutput(output, view):
+    '''
+        hands a frame to an output. When a thread or process has fallen lag frames behind, this waits until it has
+        handled a frame, so a slow output holds the solver back rather than letting frames pile up in memory.
+
+        output:    dictionary from createOutput
+        view:    dictionary from createFrameView
+    '''
+    if output['mode'] == 'Inline':
+        try:
+            output['handler'](view, *output['args'])
+        except (IOError, OSError) as e:
+            output['errors'].append((view['frame'], str(e)))
+    else:
+        putOutputFrame(output, view) # a thread or process that has died is skipped instead of blocking the solver
+
+def stopOutput(output):
+    '''
+        waits for an output to handle all remaining frames, finishes it and reports any frames that failed
+
+        output:    dictionary from createOutput
+        return:    list of (frame, error) tuples for frames that could not be written
+    '''
+    if output['mode'] == 'Inline':
+        if output['finish']:
+            output['finish'](*output['args'])
+    else:
+        putOutputFrame(output, None)
+        while output['mode'] == 'Process':
+            try:
+                output['errors'][:0] = [tuple(e) for e in output['results'].get(timeout=OUTPUT_POLL)] # read before joining, a process does not end while its queue holds data
+                break
+            except queue.Empty:
+                if not output['worker'].is_alive():
+                    break
+        output['worker'].join()
+    for frame, error in output['errors']:
+        if frame is None:
+            print 'The %s output failed: %s' % (output['name'], error)
+        else:
+            print 'Frame %d could not be written by the %s output: %s' % (frame, output['name'], error)
+    return output['errors']
+
+def exportView(view, exportDir, exportFormat):
+    '''
+        writes the point data of a frame in one of the export formats
+
+        view:    dictionary from createFrameView
+        exportDir:    directory the exported frames are written to
+        exportFormat:    one of the keys of EXPORTERS, i.e 'PLY', 'VTK' or 'CSV'
+    '''
+    extension, writeFrame = EXPORTERS[exportFormat]
+    frameData = dict(view)
+    if 'pressure' not in frameData:
+        frameData['pressure'] = [0.0]*len(view['id']) # caches written before pressure was stored
+    if 'phase' not in frameData:
+        frameData['phase'] = [0]*len(view['id'])
+    writeFrame(os.path.join(exportDir, 'particles.%04d.%s' % (view['frame'], extension)), frameData)
+
+def writeCacheView(view, cacheDir, attributes, encoder=None):
+    '''
+        writes a frame to the particle cache
+
+        view:    dictionary from createFrameView
+        cacheDir:    directory containing the particle cache
+        attributes:    dictionary of simulation values stored alongside every frame
+        encoder:    optional dictionary from createCacheEncoder, which writes the frames compressed
+    '''
+    attributes = dict(attributes)
+    attributes['clusterRadius'] = view.get('clusterRadius', attributes['clusterRadius']) # the radius changes when it is chosen automatically
+    writeParticleCache(cacheDir, view['frame'], view, attributes, encoder=encoder)
+
+SNAPSHOT_NAMES = 'particles.json' # file next to the snapshots listing the instance name of every particle id
+
+def writeParticleNames(snapshotDir, pSpheres):
+    '''
+        records which instance every particle id of a simulation was keyed on, so that it can be solved again from a
+        snapshot. The generators leave maya to rename clashing instances, so names cannot be rebuilt from the ids.
+
+        snapshotDir:    directory the snapshots are written to
+        pSpheres:    list containing instance names for each particle in system, in spawn order
+    '''
+    with open(os.path.join(snapshotDir, SNAPSHOT_NAMES), 'w') as namesFile:
+        json.dump([p[0] for p in pSpheres], namesFile)
+
+def readParticleNames(snapshotDir):
+    '''
+        snapshotDir:    directory the snapshots are written to
+        return:    list of the instance name of every particle id written by writeParticleNames, or None if there is none
+    '''
+    path = os.path.join(snapshotDir, SNAPSHOT_NAMES)
+    if not os.path.exists(path):
+        return None
+    with open(path) as namesFile:
+        return json.load(namesFile)
+
+def writeSnapshotView(view, snapshotDir):
+    '''
+        writes the full precision solver state of a frame, which the simulation can be solved again from
+
+        view:    dictionary from createFrameView
+        snapshotDir:    directory the snapshots are written to
+    '''
+    writeParticleCache(snapshotDir, view['frame'], view, view['snapshot'], SNAPSHOT_FIELDS)
+
+def exportParticleCache(cacheDir, exportDir, exportFormat):
+    '''
+        exports every frame of an existing particle cache, reading the next frame while the previous one is written
+        
+        cacheDir:    directory containing the particle cache
+        exportDir:    directory the exported frames are written to
+        exportFormat:    one of the keys of EXPORTERS
+        return:    list of (frame, error) tuples for frames that could not be written
+    '''
+    if not os.path.isdir(exportDir):
+        os.makedirs(exportDir)
+    exporter = startOutput(createOutput('export', exportView, (exportDir, exportFormat), mode='Thread'))
+    for frame in listCacheFrames(cacheDir):
+        data = readParticleCache(findCacheFile(cacheDir, frame))
+        sendToOutput(exporter, createFrameView(frame, data, {}))
+    return stopOutput(exporter)
+
+SOLVER_VERSION = 3 # increase whenever a change to the solver alters simulated results, so results stored by older versions are not reused
+STORE_SIZE_LIMIT = 2*1024**3 # maximum size in bytes of all stored simulations before the least recently used ones are removed
+RUN_KEY_EXCLUDED = ['No. of Frames', 'Particle Colour', 'Cache Directory', 'Export Directory', 'Export Format', 'Store Directory', 'Backend', 'Bake Mode', 'Key Tolerance', 'Time Budget', 'Memory Budget',
+                    'Half Pairs', 'Snapshot Directory', 'Writer Mode', 'Writer Lag', 'Relax Directory']
+# parameters which do not change the simulated particle motion. The number of frames is left out so that a longer run can continue a shorter one.
+
+def findContainerHash(containerName):
+    '''
+        finds a hash of the world space vertex positions of the container within the scene
+        
+        containerName:    name of the container object in the scene
+        return:    hex digest of the container vertices, or 'none' if there is no container
+    '''
+    if not cmds.objExists(containerName):
+        return 'none'
+    points = cmds.xform(containerName + '.vtx[*]', q=True, ws=True, t=True) or []
+    return hashlib.sha1(','.join(['%.5f' % p for p in points])).hexdigest() # rounds the vertices so float noise does not change the hash
+
+def findRunKey(params):
+    '''
+        finds a stable key for a simulation from everything that affects its result: the user parameters, spawn 
+        layout, random seed, container and solver version
+        
+        params:    dictionary containing values for each user specified parameter
+        return:    hex digest identifying the simulation
+    '''
+    inputs = dict([(key, val) for key, val in params.items() if key not in RUN_KEY_EXCLUDED])
+    inputs['Solver Version'] = SOLVER_VERSION
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True)).hexdigest()
+
+def findStoredFrames(storeDir, runKey):
+    '''
+        finds the frames of a simulation held in the result store
+        
+        storeDir:    directory of the result store
+        runKey:    key of the simulation from findRunKey
+        return:    the unbroken run of stored frames starting at frame 1, which is empty if nothing was stored
+    '''
+    runDir = os.path.join(storeDir, runKey)
+    if not os.path.isfile(os.path.join(runDir, 'run.json')):
+        return []
+    frames, stored = [], set(listCacheFrames(runDir))
+    while len(frames)+1 in stored:
+        frames.append(len(frames)+1) # a frame is only usable if every frame before it is stored as well
+    return frames
+
+def touchStoredRun(storeDir, runKey):
+    '''
+        marks a stored simulation as used, so that it is the last to be removed when the store is trimmed
+    '''
+    runPath = os.path.join(storeDir, runKey, 'run.json')
+    run = json.load(open(runPath))
+    run['lastUsed'] = time.time()
+    json.dump(run, open(runPath, 'w'))
+
+def findStoredSnapshot(storeDir, runKey, frame):
+    '''
+        finds the path of the solver snapshot kept with a stored simulation, which a longer simulation carries on from
+
+        storeDir:    directory of the result store
+        runKey:    key of the simulation from findRunKey
+        frame:    last stored frame the longer simulation uses
+        return:    path of the snapshot of that frame, or None if the simulation was stored without one
+    '''
+    path = os.path.join(storeDir, runKey, 'snapshot.%04d.pc' % frame) # named apart from the cache frames so listCacheFrames skips it
+    return path if os.path.exists(path) else None
+
+def storeSimulation(storeDir, runKey, cacheDir, params, snapshotDir=None, sizeLimit=STORE_SIZE_LIMIT):
+    '''
+        copies the frames of a simulation from the particle cache into the result store and trims the store back
+        to its size limit. Runs that were cancelled are stored as well, so they can be continued later.
+        
+        storeDir:    directory of the result store
+        runKey:    key of the simulation from findRunKey
+        cacheDir:    directory containing the particle cache of the simulation
+        params:    dictionary containing values for each user specified parameter, kept for reference
+        snapshotDir:    optional directory of the solver snapshots of the simulation. The snapshot of the last frame
+                        is stored too, as the cache frames are too coarse to continue the simulation from exactly.
+        sizeLimit:    maximum size in bytes of the result store
+    '''
+    runDir = os.path.join(storeDir, runKey)
+    if not os.path.isdir(runDir):
+        os.makedirs(runDir)
+    frames = listCacheFrames(cacheDir)
+    for frame in frames:
+        shutil.copyfile(findCacheFile(cacheDir, frame), findCacheFile(runDir, frame))
+    if frames and snapshotDir and os.path.exists(findCacheFile(snapshotDir, frames[-1])):
+        for path in glob.glob(os.path.join(runDir, 'snapshot.*.pc')):
+            os.remove(path) # only the snapshot of the last frame is worth keeping
+        shutil.copyfile(findCacheFile(snapshotDir, frames[-1]), os.path.join(runDir, 'snapshot.%04d.pc' % frames[-1]))
+    run = {'params': dict([(key, val) for key, val in params.items() if key not in RUN_KEY_EXCLUDED]), 
+           'solverVersion': SOLVER_VERSION, 'lastUsed': time.time()}
+    json.dump(run, open(os.path.join(runDir, 'run.json'), 'w'))
+    trimResultStore(storeDir, sizeLimit, runKey)
+
+def trimResultStore(storeDir, sizeLimit, keepKey=None):
+    '''
+        removes the least recently used simulations until the result store fits within its size limit
+        
+        storeDir:    directory of the result store
+        sizeLimit:    maximum size in bytes of the result store
+        keepKey:    key of a simulation which is never removed, i.e the one that was just stored
+    '''
+    runs, total = [], 0
+    for runKey in os.listdir(storeDir):
+        runDir = os.path.join(storeDir, runKey)
+        runPath = os.path.join(runDir, 'run.json')
+        if not os.path.isfile(runPath):
+            continue
+        size = sum([os.path.getsize(os.path.join(runDir, f)) for f in os.listdir(runDir)])
+        runs.append((json.load(open(runPath))['lastUsed'], runKey, size))
+        total += size
+    for lastUsed, runKey, size in sorted(runs):
+        if total <= sizeLimit:
+            break
+        if runKey != keepKey:
+            shutil.rmtree(os.path.join(storeDir, runKey))
+            total -= size
+
+def keyPosition(name, pos, frame):
+    '''
+        sets linear keyframes on the x,y,z translation of a particle
+
+        name:    instance name of the particle
+        pos:    x,y,z coordinates of the particle
+        frame:    frame to key
+    '''
+    cmds.setKeyframe(name, attribute="tx", v=pos[0], t=[frame], inTangentType="linear", outTangentType="linear")
+    cmds.setKeyframe(name, attribute="ty", v=pos[1], t=[frame], inTangentType="linear", outTangentType="linear")
+    cmds.setKeyframe(name, attribute="tz", v=pos[2], t=[frame], inTangentType="linear", outTangentType="linear")
+
+def keyView(view, pSpheres):
+    '''
+        keyframes every particle of a frame at its position
+
+        view:    dictionary from createFrameView
+        pSpheres:    list containing instance names for each particle in system, in spawn order so that the list
+                     index matches the particle id
+    '''
+    for pId, pos in zip(view['id'], view['position']):
+        keyPosition(pSpheres[pId][0], pos, view['frame'])
+
+def keyVisibility(view, pSpheres):
+    '''
+        shows the particles poured on a frame and hides the particles retired on it
+
+        view:    dictionary from createFrameView
+        pSpheres:    list containing instance names for each particle in system, in spawn order
+    '''
+    for pId in view['emitted']:
+        cmds.setKeyframe(pSpheres[pId][0], attribute="visibility", v=1, t=[view['frame']], outTangentType="step")
+    for pId in view['retired']:
+        cmds.setKeyframe(pSpheres[pId][0], attribute="visibility", v=0, t=[view['frame']], outTangentType="step")
+
+def keyScale(view, pSpheres):
+    '''
+        scales the particles split or merged on a frame to the size of their level, a particle split once holding
+        half the volume
+
+        view:    dictionary from createFrameView
+        pSpheres:    list containing instance names for each particle in system, in spawn order
+    '''
+    for pId, level in view['resized']:
+        for attribute in ['sx', 'sy', 'sz']:
+            cmds.setKeyframe(pSpheres[pId][0], attribute=attribute, v=0.5**(level/3.0), t=[view['frame']], outTangentType="step")
+
+def previewView(view, pSpheres):
+    '''
+        moves the particles in the viewport to a frame and redraws it, so the simulation can be watched as it solves
+
+        view:    dictionary from createFrameView
+        pSpheres:    list containing instance names for each particle in system, in spawn order
+    '''
+    for pId, pos in zip(view['id'], view['position']):
+        cmds.move(pos[0],pos[1],pos[2],pSpheres[pId][0])
+    cmds.refresh(f=True)
+
+def reportView(view, counts):
+    '''
+        prints the cluster radius whenever it is chosen and counts the coarse steps of the solver, the iterations of
+        the implicit viscosity solve, how often the neighbour cap was hit and the steps rolled back by the health monitor
+
+        view:    dictionary from createFrameView
+        counts:    dictionary of the number of coarse steps, of those solved frame by frame instead, of the implicit
+                   viscosity solves and their iterations, of the particles solved with and over the neighbour cap, and of
+                   the rolled back steps and the most substeps a step was split into
+    '''
+    if view.get('step'):
+        span, kept = view['step']
+        counts['coarse'], counts['fallbacks'] = counts['coarse'] + (span > 1), counts['fallbacks'] + (not kept)
+    if view.get('viscosityIterations') is not None:
+        counts['solves'], counts['iterations'] = counts['solves'] + 1, counts['iterations'] + view['viscosityIterations']
+    if view.get('neighbourCap') is not None:
+        capped, most = view['neighbourCap']
+        counts['solved'], counts['capped'], counts['most'] = counts['solved'] + len(view['id']), counts['capped'] + capped, max(counts['most'], most)
+    if view.get('health'):
+        substeps, rollbacks = view['health']
+        counts['rollbacks'], counts['substeps'] = counts['rollbacks'] + rollbacks, max(counts['substeps'], substeps)
+        if rollbacks:
+            print 'Frame %d: rolled back a step which broke a health limit, solving in %d substeps from now on.' % (view['frame'], substeps)
+    if view.get('neighbourStats'):
+        print 'Frame %d: cluster radius %.4f, grid cell %.4f, %.1f neighbours on average (%d to %d)' % ((view['frame'],) + view['neighbourStats'])
+
+def reportSummary(counts):
+    if counts['coarse']:
+        print 'Solved %d coarse steps, %d of which were too inaccurate to interpolate and were solved frame by frame.' % (counts['coarse'], counts['fallbacks'])
+    if counts['solves']:
+        print 'Solved the viscosity implicitly on %d steps, taking %.1f iterations on average.' % (counts['solves'], float(counts['iterations'])/counts['solves'])
+    if counts['solved']:
+        print 'Particles had more neighbours than the cap on %.1f%% of their steps, the most neighbours found was %d.' % (100.0*counts['capped']/counts['solved'], counts['most'])
+    if counts['rollbacks']:
+        print 'Rolled back %d steps which broke a health limit, the last steps were split into %d substeps.' % (counts['rollbacks'], counts['substeps'])
+
+def createKeyRecorder(numParticles, pSpheres=None, tolerance=0.001):
+    '''
+        creates a recorder which collects the trajectory of every particle so that the keyframes can be decimated once
+        the simulation has finished
+
+        numParticles:    number of particles in the system
+        pSpheres:    list containing instance names for each particle in system, in spawn order, keyed by finishKeyRecorder
+        tolerance:    largest distance allowed between the keyed curve and the simulated position
+        return:    dictionary holding the recorded frames, the position of every particle on each frame and whether
+                   the particle was in use on that frame, along with the particles and tolerance to bake them with
+    '''
+    return {'numParticles': numParticles, 'frames': [], 'positions': [], 'active': [], 'pSpheres': pSpheres, 'tolerance': tolerance}
+
+def recordView(view, recorder):
+    '''
+        records a frame for the decimated bake
+        
+        view:    dictionary from createFrameView
+        recorder:    dictionary from createKeyRecorder
+    '''
+    recordKeyFrame(recorder, view['frame'], view['id'], view['position'])
+
+def finishKeyRecorder(recorder):
+    '''
+        keys the recorded trajectories once the simulation has ended, see recordView
+    '''
+    keys, fullKeys, maxError = bakeDecimatedKeys(recorder, recorder['pSpheres'], recorder['tolerance'])
+    print 'Baked %d of %d keyframes (%.1f%%), largest position error %.5f.' % (keys, fullKeys, 100.0*keys/max(fullKeys, 1), maxError)
+
+def recordKeyFrame(recorder, frame, ids, positions):
+    '''
+        records the positions of the particles in use on a frame
+
+        recorder:    dictionary from createKeyRecorder
+        frame:    the frame being recorded
+        ids:    list of the stable id of each recorded particle
+        positions:    list of x,y,z coordinates of each recorded particle
+    '''
+    framePos, frameActive = [[0.0,0.0,0.0]]*recorder['numParticles'], [False]*recorder['numParticles']
+    for pId, pos in zip(ids, positions):
+        framePos[pId], frameActive[pId] = list(pos), True
+    recorder['frames'].append(frame)
+    recorder['positions'].append(framePos)
+    recorder['active'].append(frameActive)
+
+def recordKeySeams(recorder, snapshotDir, resumeFrame):
+    '''
+        records the frames between the last key of every particle before the resumed frame and that frame, read from
+        the snapshots, so the keyed segment joining the kept keys to the frames solved again is decimated like any
+        other. Each particle is only recorded from its own last key on, so its earlier keys stay as they are.
+
+        recorder:    dictionary from createKeyRecorder
+        snapshotDir:    directory holding the snapshots of the simulation being solved again
+        resumeFrame:    frame the simulation is solved again from, the keys from it on have been cut
+    '''
+    lastKeys = [max(cmds.keyframe(p[0], attribute='tx', q=True, time=(0, resumeFrame-1)) or [resumeFrame]) for p in recorder['pSpheres']]
+    for f in range(int(min(lastKeys + [resumeFrame])), resumeFrame):
+        path = findCacheFile(snapshotDir, f)
+        if not os.path.isfile(path):
+            continue
+        data = readParticleCache(path)
+        pIds = [n for n in range(data['count']) if lastKeys[data['id'][n]] <= f]
+        recordKeyFrame(recorder, f, [data['id'][n] for n in pIds], [data['position'][n] for n in pIds])
+
+def decimateTrajectory(points, active, tolerance):
+    '''
+        finds the frames of one trajectory that have to be keyed so that linear interpolation between the keys stays
+        within the tolerance of every frame. The first and last frame a particle is in use are always kept, then
+        the frame furthest from the interpolated curve is kept and both halves are searched again.
+
+        points:    list of the x,y,z coordinates of the particle on every frame
+        active:    list of booleans marking the frames the particle is in use
+        tolerance:    largest distance allowed between the keyed curve and the simulated position
+        return:    list of booleans marking the kept frames and the largest remaining distance
+    '''
+    keep = [active[f] and (f==0 or not active[f-1] or f==len(active)-1 or not active[f+1]) for f in range(len(active))]
+    kept = [f for f in range(len(keep)) if keep[f]]
+    segments = [(kept[n], kept[n+1]) for n in range(len(kept)-1)]
+    maxError = 0.0
+    while segments:
+        a, b = segments.pop()
+        worst, worstError = None, 0.0
+        for f in range(a+1, b):
+            if not active[f]:
+                continue
+            t = float(f-a)/(b-a)
+            error = m.sqrt(sum([(points[f][l] - (points[a][l] + t*(points[b][l]-points[a][l])))**2 for l in range(3)]))
+            if error > worstError:
+                worst, worstError = f, error
+        if worst is not None and worstError > tolerance:
+            keep[worst] = True
+            segments += [(a, worst), (worst, b)]
+        else:
+            maxError = max(maxError, worstError)
+    return keep, maxError
+
+def decimateTrajectories(positions, active, tolerance):
+    '''
+        decimates the trajectories of every particle at once, giving the same keys as decimateTrajectory. Each pass
+        keeps the frame furthest from the interpolated curve within every segment between kept frames.
+
+        positions:    numpy array of the x,y,z coordinates of every particle on every frame, shaped (particles, frames, 3)
+        active:    numpy array of booleans marking the frames each particle is in use, shaped (particles, frames)
+        tolerance:    largest distance allowed between the keyed curve and the simulated position
+        return:    numpy array of booleans marking the kept frames of each particle and the largest remaining distance
+    '''
+    numParticles, numFrames = active.shape
+    frames, rows = np.arange(numFrames), np.arange(numParticles)[:,None]
+    before = np.concatenate([np.zeros((numParticles, 1), dtype=bool), active[:,:-1]], axis=1)
+    after = np.concatenate([active[:,1:], np.zeros((numParticles, 1), dtype=bool)], axis=1)
+    keep = active & ~(before & after) # the first and last frame of every run of frames in use
+    while True:
+        prev = np.maximum.accumulate(np.where(keep, frames, 0), axis=1) # kept frame before each frame
+        nxt = np.minimum.accumulate(np.where(keep, frames, numFrames-1)[:,::-1], axis=1)[:,::-1] # kept frame after each frame
+        t = ((frames - prev)/np.maximum(nxt - prev, 1).astype(np.float64))[:,:,None]
+        curve = positions[rows, prev] + t*(positions[rows, nxt] - positions[rows, prev])
+        error = np.sqrt(((positions - curve)**2).sum(axis=2))
+        error[keep | ~active] = 0.0
+        starts = keep.copy()
+        starts[:,0] = True # every row starts a new segment
+        segment = np.cumsum(starts.ravel()) - 1
+        worst = np.maximum.reduceat(error.ravel(), np.flatnonzero(starts))
+        candidates = np.flatnonzero((error.ravel() == worst[segment]) & (error.ravel() > tolerance))
+        if len(candidates)==0:
+            return keep, float(error.max()) if error.size else 0.0
+        first = np.concatenate([[True], segment[candidates][1:] != segment[candidates][:-1]]) # the first of equally bad frames, like decimateTrajectory
+        keep.flat[candidates[first]] = True
+
+def bakeDecimatedKeys(recorder, pSpheres, tolerance):
+    '''
+        keys every particle only on the frames needed to follow its recorded trajectory within the tolerance. A particle
+        at rest ends up with a key where it settles and one on the last frame.
+
+        recorder:    dictionary from createKeyRecorder
+        pSpheres:    list containing instance names for each particle in system, in spawn order so that the list 
+                     index matches the particle id
+        tolerance:    largest distance allowed between the keyed curve and the simulated position
+        return:    number of keyframes set, the number a full bake would have set and the largest distance between the
+                   keyed curve and the simulated positions
+    '''
+    frames = recorder['frames']
+    if not frames:
+        return 0, 0, 0.0
+    if np is not None:
+        positions = np.array(recorder['positions'], dtype=np.float64).transpose(1, 0, 2)
+        active = np.array(recorder['active'], dtype=bool).T
+        keep, maxError = decimateTrajectories(positions, active, tolerance)
+        keys = [(pId, f) for pId, f in zip(*np.nonzero(keep))]
+        fullKeys = int(active.sum())
+        positions = positions.tolist()
+    else:
+        positions = [[framePos[pId] for framePos in recorder['positions']] for pId in range(recorder['numParticles'])]
+        keys, fullKeys, maxError = [], 0, 0.0
+        for pId in range(recorder['numParticles']):
+            active = [frameActive[pId] for frameActive in recorder['active']]
+            keep, error = decimateTrajectory(positions[pId], active, tolerance)
+            keys += [(pId, f) for f in range(len(frames)) if keep[f]]
+            fullKeys, maxError = fullKeys + sum(active), max(maxError, error)
+    for pId, f in keys:
+        keyPosition(pSpheres[pId][0], positions[pId][f], frames[f])
+    return 3*len(keys), 3*fullKeys, maxError
+
+def createParticlePool(capacity):
+    '''
+        creates a fixed size pool of particle slots. Every per-particle list of the solver keeps one entry per slot,
+        so particles can be emitted and retired without any list being resized.
+        
+        capacity:    the most particles that can be alive at once
+        return:    dictionary holding the active mask, the age in frames of each slot and a stack of free slots
+    '''
+    return {'active': [False]*capacity, 'age': [0]*capacity, 'free': list(range(capacity-1, -1, -1))}
+
+def spawnParticle(pool):
+    '''
+        takes a free slot from the particle pool
+        
+        pool:    dictionary from createParticlePool
+        return:    index of the slot now in use, or None when every slot is taken
+    '''
+    if not pool['free']:
+        return None
+    slot = pool['free'].pop()
+    pool['active'][slot], pool['age'][slot] = True, 0
+    return slot
+
+def retireParticle(pool, slot):
+    '''
+        returns a slot to the particle pool so that it can be emitted again
+        
+        pool:    dictionary from createParticlePool
+        slot:    index of the slot to retire
+    '''
+    pool['active'][slot] = False
+    pool['free'].append(slot)
+
+def reorderParticlePool(pool, order):
+    '''
+        permutes the particle pool along with the other per-particle lists after particles have been reordered
+        
+        pool:    dictionary from createParticlePool
+        order:    list of current particle indices in their new order
+    '''
+    pool['active'], pool['age'] = reorderParticles(order, pool['active'], pool['age'])
+    pool['free'] = [slot for slot in range(len(order)-1, -1, -1) if not pool['active'][slot]]
+
+def createEmitter(params):
+    '''
+        creates an emitter pouring particles from a nozzle
+        
+        params:    dictionary containing values for each user specified parameter
+        return:    dictionary describing the emitter
+    '''
+    direction = params['Emitter Direction'][0]
+    length = m.sqrt(sum([d**2 for d in direction])) or 1.0
+    return {'position': params['Emitter Position'][0], 'direction': [d/length for d in direction], 'rate': params['Emission Rate'],
+            'speed': params['Emission Speed'], 'jitter': params['Emitter Jitter'], 'lifespan': params['Lifespan'], 'carry': 0.0}
+
+def updateEmitter(emitter, pool, velC):
+    '''
+        ages the particles in the pool, retires those past their lifespan and emits new particles at the nozzle. 
+        Fractions of a particle left over from the emission rate are carried into the next frame.
+        
+        emitter:    dictionary from createEmitter
+        pool:    dictionary from createParticlePool
+        velC:    list of velocities of every particle slot, which is set for emitted particles
+        return:    a list of (slot, position) tuples for emitted particles and a list of retired slots
+    '''
+    retired, emitted = [], []
+    for slot in range(len(pool['active'])):
+        if pool['active'][slot]:
+            pool['age'][slot] += 1
+            if emitter['lifespan'] > 0 and pool['age'][slot] > emitter['lifespan']:
+                retireParticle(pool, slot)
+                retired.append(slot)
+    emitter['carry'] += emitter['rate']
+    while emitter['carry'] >= 1.0:
+        emitter['carry'] -= 1.0
+        slot = spawnParticle(pool)
+        if slot is None:
+            emitter['carry'] = 0.0 # the pool is full, so emission waits until particles are retired
+            break
+        jitter = emitter['jitter']
+        emitted.append((slot, [emitter['position'][l] + rd.uniform(-jitter, jitter) for l in range(3)]))
+        velC[slot] = [emitter['direction'][l]*emitter['speed'] for l in range(3)]
+    return emitted, retired
+
+RESOLUTION_INTERVAL = 5 # number of frames between splitting and merging particles of adaptive resolution
+SPLIT_NEIGHBOURS = 0.75 # particles with fewer neighbours than this share of the median are at the free surface and split
+MERGE_NEIGHBOURS = 0.9 # split particles with more neighbours than this share of the median are inside the fluid and merge
+SPLIT_VORTICITY = 5.0 # particles spinning faster than this, in radians per second, split, and merge again below half of it
+SPLIT_DIRECTIONS = [(1.0,0.0,0.0), (0.0,0.0,1.0), (0.0,1.0,0.0)] # the two halves of a split particle are placed apart along one of these
+
+def findResolutionMeasures(state, settings):
+    '''
+        finds what decides the resolution of every particle from the pairs of the NumPy backend
+
+        state:    dictionary from createSolverState after the neighbour stage
+        settings:    dictionary from findSolverSettings
+        return:    numpy arrays of the number of neighbours of every particle, counting the particle itself, and of the
+                   magnitude of the vorticity of the fluid at every particle
+    '''
+    I, J, D, mag = state['halfPairs' if settings.get('halfPairs') else 'pairs']
+    n, velocity = len(state['position']), state['velocity']
+    ones = np.ones(len(I))
+    counts = sumHalfPairs(I, J, ones, ones, n) if settings.get('halfPairs') else sumPairs(I, ones, n)
+    apart = mag > 0
+    I, J, D, mag = I[apart], J[apart], D[apart], mag[apart]
+    weight = np.maximum(settings['clusterRadius']*pairScale(state, I, J) - mag, 0.0)**2 # falls off like the spiky kernel
+    spin = np.cross(D, velocity[J] - velocity[I])*(weight/mag**2)[:,None] # both particles of a pair see the same spin
+    # the neighbours of a particle in fluid turning rigidly spin at 2/3 of its vorticity on average
+    if settings.get('halfPairs'):
+        vorticity = 1.5*sumHalfPairs(I, J, spin, spin, n)/np.maximum(sumHalfPairs(I, J, weight, weight, n), 1e-300)[:,None]
+    else:
+        vorticity = 1.5*sumPairs(I, spin, n)/np.maximum(sumPairs(I, weight, n), 1e-300)[:,None]
+    return counts, np.sqrt((vorticity**2).sum(axis=1))
+
+def adaptResolution(state, settings, pool, maxLevel):
+    '''
+        splits particles at the free surface or in swirling fluid into two particles of half the mass and merges split
+        particles deep inside calm fluid back together, so the detail of the fluid follows what can be seen of it. Both
+        conserve the mass and momentum of the fluid: the halves of a split particle keep its velocity, and a merged
+        particle moves at the average velocity of the pair. Split particles take free slots of the particle pool, and
+        merging returns a slot to it.
+
+        state:    dictionary from createSolverState after the neighbour and density stages of the NumPy backend, holding
+                  the level of every particle, the number of times it was split
+        settings:    dictionary from findSolverSettings
+        pool:    dictionary from createParticlePool
+        maxLevel:    most times a particle may be split
+        return:    a list of (slot, position) tuples for the split off particles, a list of the slots merged away and a
+                   list of the slots whose level changed
+    '''
+    active, level = np.array(pool['active'], dtype=bool), state['level']
+    if not active.any():
+        return [], [], []
+    counts, vorticity = findResolutionMeasures(state, settings)
+    median = np.median(counts[active])
+    split = active & (level < maxLevel) & ((counts < SPLIT_NEIGHBOURS*median) | (vorticity > SPLIT_VORTICITY))
+    calm = active & (level > 0) & (counts >= MERGE_NEIGHBOURS*median) & (vorticity < 0.5*SPLIT_VORTICITY) # never a particle which splits
+    children, resized = [], []
+    for i in np.nonzero(split)[0][np.argsort(counts[split], kind='mergesort')]: # the emptiest surroundings split first when the pool runs short
+        slot = spawnParticle(pool)
+        if slot is None:
+            break
+        level[i] += 1
+        level[slot] = level[i]
+        offset = settings['particleRadius']*0.5**(level[i]/3.0)*np.array(SPLIT_DIRECTIONS[slot % len(SPLIT_DIRECTIONS)])
+        state['position'][slot] = state['position'][i] + offset
+        state['position'][i] -= offset
+        state['velocity'][slot] = state['velocity'][i]
+        pool['age'][slot] = pool['age'][i]
+        children.append((slot, state['position'][slot].tolist()))
+        resized += [i, slot]
+    I, J, D, mag = state['halfPairs' if settings.get('halfPairs') else 'pairs']
+    I, J, mag = np.concatenate([I, J]), np.concatenate([J, I]), np.concatenate([mag, mag]) # both directions of every pair
+    candidate = (I != J) & calm[I] & calm[J] & (level[I] == level[J])
+    I, J, mag = I[candidate], J[candidate], mag[candidate]
+    order = np.lexsort((mag, I)) # the nearest candidate of each particle comes first
+    I, J = I[order], J[order]
+    first = np.ones(len(I), dtype=bool)
+    first[1:] = I[1:] != I[:-1]
+    nearest = -np.ones(len(level), dtype=np.int64)
+    nearest[I[first]] = J[first]
+    merged = []
+    for i in I[first]:
+        j = nearest[i]
+        if i < j and nearest[j] == i: # only pairs that are each other's nearest merge, so no particle merges twice
+            state['position'][i] = 0.5*(state['position'][i] + state['position'][j])
+            state['velocity'][i] = 0.5*(state['velocity'][i] + state['velocity'][j]) # both halves have the same mass
+            level[i] -= 1
+            retireParticle(pool, j) # retired after splitting, so a slot is never merged away and split off on the same frame
+            merged.append(j)
+            resized.append(i)
+    return children, merged, resized
+
+def selectActiveParticles(frameData, active):
+    '''
+        keeps only the particles of a frame whose pool slot is in use
+        
+        frameData:    dictionary of field names to a list containing the value of that field for every particle slot
+        active:    list of booleans marking which slots are in use
+        return:    dictionary of the same fields containing only active particles
+    '''
+    return dict([(name, [values[i] for i in range(len(active)) if active[i]]) for name, values in frameData.items()])
+                    
+SPAWN_OFFSET = [0.65, 5.0, 0.9] # the spawn layouts are moved by this much into the container on the first frame
+
+def simulateFluid(widgets, positions, data=None, startFrame=1):
+    '''
+        solves the fluid and yields a view of every frame. Nothing here touches maya or the disk, the frames are
+        keyframed, cached and exported by the outputs of createOutputs, so outputs are added without changing the
+        solver loop.
+
+        widgets:    dictionary containing user controlled parameter values
+        positions:    list of x,y,z coordinates of every particle in spawn order
+        data:    optional frame of the particle cache or a snapshot to carry on from
+        startFrame:    first frame to solve
+        return:    generator of dictionaries from createFrameView, one for each frame from startFrame on
+    '''
+    clusterRadius = widgets['Cluster Radius']
+    radius = widgets['Particle Radius']
+    numSpheres = len(positions)
+    settings = findSolverSettings(widgets) # constant values used by every stage of the solver
+    adaptive, maxLevel = widgets.get('Adaptive Resolution', False), widgets.get('Resolution Levels', 2)
+    if adaptive and not loadBackend(BACKENDS['NumPy']):
+        print 'Adaptive Resolution needs numpy, every particle keeps its size.'
+        adaptive = False
+    backend = selectBackend('NumPy' if adaptive else widgets.get('Backend', 'Auto')) # the solver stages run on the fastest backend available unless one was chosen
+    # only the NumPy stages take particles of different sizes
+    velC = [widgets['Initial Velocity'][0] for j in range(numSpheres)] #sets the values of each user controlled parameter by passing in values from widgets dictionary
+    initialPos = SPAWN_OFFSET
+    reorderInterval = widgets.get('Reorder Interval', 10) # number of frames between sorting particles by the Morton code of their grid cell, 0 disables the sort
+    cellSize = clusterRadius + 2*radius # grid cells are as wide as a particle neighbourhood
+    autoRadius, tunedFrame = widgets.get('Auto Cluster Radius', False), None # frame the cluster radius was last chosen for the target neighbour count
+    adaptInterval = widgets.get('Adapt Interval', 0) # number of frames between choosing the cluster radius again, 0 keeps the first choice
+    tuneRand = rd.Random(widgets.get('Random Seed', 0)) # kept apart from the random numbers of the emitter
+    particleIds = list(range(numSpheres)) # stable id of each particle in spawn order, used to address particles within the particle cache
+    positions = [list(pos) for pos in positions]
+    pool, emitter = None, None
+    if 'Emission Rate' in widgets:
+        pool = createParticlePool(numSpheres) # particles are poured from a fixed pool rather than all spawning on the first frame
+        emitter = createEmitter(widgets)
+        initialPos = None # poured particles start at the nozzle without an offset
+    elif adaptive:
+        pool = createParticlePool(numSpheres) # the Split Reserve particles after the spawned ones wait in the pool to be split off
+        for j in range(numSpheres - widgets.get('Split Reserve', 0)):
+            spawnParticle(pool)
+    levels = [0]*numSpheres # number of times each particle has been split
+    phase = [widgets.get('Type Of Liquid', 0)]*numSpheres # phase of each particle, 0 for a custom liquid, otherwise 1 milk, 2 coffee and 3 water
+    if data:
+        if emitter and 'emitterCarry' in data['attributes']: # a snapshot also holds the state of the emitter
+            emitter['carry'] = data['attributes']['emitterCarry']
+            random = data['attributes']['random']
+            rd.setstate((random[0], tuple(random[1]), random[2])) # the emitter jitter carries on with the same random numbers
+        if autoRadius:
+            clusterRadius, tunedFrame = data['attributes']['clusterRadius'], data['attributes'].get('tunedFrame', data['frame']) # carries on with the radius the earlier simulation had reached
+            settings['clusterRadius'] = clusterRadius
+            cellSize = clusterRadius + 2*radius
+        for pId, pos in zip(data['id'], data['position']):
+            positions[pId] = list(pos) # particles are still in spawn order here, so their id is their index
+        velC = [list(v) for v in data['velocity']]
+        if pool:
+            velC, pool['active'] = [[0.0,0.0,0.0] for j in range(numSpheres)], [False]*numSpheres
+            for pId, vel, age in zip(data['id'], data['velocity'], data['age']):
+                velC[pId] = list(vel)
+                pool['active'][pId], pool['age'][pId] = True, age
+            pool['free'] = [slot for slot in range(numSpheres-1, -1, -1) if not pool['active'][slot]]
+        for pId, level in zip(data['id'], data.get('level') or []):
+            levels[pId] = level
+    state = createSolverState(backend, positions, velC, pool['active'] if pool else None)
+    if adaptive:
+        state['level'] = np.array(levels, dtype=np.int64)
+    if data and data['attributes'].get('order'):
+        order = data['attributes']['order'] # particles are put back in the memory order of the snapshot, so the solver carries on exactly as it would have
+        particleIds, = reorderParticles(order, particleIds)
+        permuteSolverState(backend, state, order)
+        if pool:
+            reorderParticlePool(pool, order)
+            pool['free'] = data['attributes']['free']
+            state['active'] = backend['fromMask'](pool['active'])
+    framesPerStep = max(widgets.get('Frames Per Step', 1), 1) # output frames covered by each solver step, the frames in between are interpolated
+    tolerance = widgets.get('Interpolation Tolerance', 0.01)
+    monitor = createHealthMonitor(widgets.get('Divergence Action', 'Rollback'), data['attributes'].get('substeps', 1) if data else 1)
+    # checks every step for a diverging solver, carrying on with the substeps the earlier simulation had reached
+    pending = []
+    for i in range(startFrame,widgets['No. of Frames']):
+        details = {'emitted': (), 'retired': (), 'resized': (), 'step': None, 'neighbourStats': None, 'viscosityIterations': None, 'neighbourCap': None, 'health': None}
+        if not pending:
+            span = 1 if (i == 1 or emitter) else min(framesPerStep, widgets['No. of Frames'] - i)
+            # the first frame and poured particles are always solved, since particles jump into the container or appear
+            emitted, retired, resized = [], [], []
+            if emitter:
+                emitted, retired = updateEmitter(emitter, pool, state['velocity']) # emitting and retiring only flips slots of the pool in and out of use
+                for slot, pos in emitted:
+                    state['position'][slot] = pos
+                    if adaptive:
+                        state['level'][slot] = 0 # the slot of a retired split particle is poured again at full size
+                        resized.append(slot)
+            if adaptive and i > 1 and (i-1) % RESOLUTION_INTERVAL < span:
+                stepFluid(backend, state, settings, SOLVER_STAGES[:2]) # the neighbours and densities of where the particles are now
+                children, merged, changed = adaptResolution(state, settings, pool, maxLevel)
+                emitted, retired, resized = emitted + children, retired + merged, resized + changed
+            if pool:
+                details['emitted'] = tuple([particleIds[slot] for slot, pos in emitted])
+                details['retired'] = tuple([particleIds[slot] for slot in retired])
+                details['resized'] = tuple([(particleIds[slot], int(state['level'][slot])) for slot in resized])
+                state['active'] = backend['fromMask'](pool['active'])
+            retuned = False
+            if autoRadius and (tunedFrame is None or (adaptInterval > 0 and i - tunedFrame >= adaptInterval)):
+                positions, velocities = backend['toVectors'](state['position']), backend['toVectors'](state['velocity'])
+                if pool:
+                    positions, velocities = [[values[j] for j in range(len(values)) if pool['active'][j]] for values in (positions, velocities)]
+                if len(positions) >= min(widgets['Target Neighbours'], numSpheres): # an emitter waits until enough particles are poured to measure
+                    tuned = tuneClusterRadius(positions, radius, widgets['Target Neighbours'], tuneRand)
+                    if tunedFrame is not None:
+                        tuned = min(max(tuned, 0.9*clusterRadius), 1.1*clusterRadius) # the radius changes gradually so the kernels do not jolt the fluid
+                    tuned = max(tuned, findStableClusterRadius(positions, velocities, settings, initialPos if i == 1 else None))
+                    clusterRadius, tunedFrame, retuned = tuned, i, True
+                    settings['clusterRadius'] = clusterRadius
+                    cellSize = clusterRadius + 2*radius
+            if reorderInterval > 0 and (i-1) % reorderInterval < span: # a coarse step reorders if any of its frames would have
+                order = findMortonOrder(backend['toVectors'](state['position']), cellSize) # spatially close particles are moved next to each other in every per-particle list
+                particleIds, = reorderParticles(order, particleIds)
+                permuteSolverState(backend, state, order)
+                if pool:
+                    reorderParticlePool(pool, order)
+                    state['active'] = backend['fromMask'](pool['active'])
+            state['offset'] = initialPos if i==1 else None # the particles are offset into the container on the first frame
+            monitor['frame'], rollbacks = i, monitor['rollbacks']
+            pending, kept = solveFrames(backend, state, settings, span, tolerance, monitor) # finds the neighbours, density and forces of each particle and moves the particles
+            details['step'] = (span, kept)
+            details['health'] = (monitor['substeps'], monitor['rollbacks'] - rollbacks)
+            details['viscosityIterations'] = state.get('viscosityIterations') if settings['implicitViscosity'] else None
+            details['neighbourCap'] = state.get('neighbourCap') if settings['maxNeighbours'] else None
+            if retuned:
+                details['neighbourStats'] = (clusterRadius, cellSize) + findNeighbourStats(state)
+        frame = pending.pop(0) # frames of a coarse step are handed out one at a time, so cancelling still stops on the next frame
+        frameData = {'id': particleIds, 'position': frame['position'], 'velocity': frame['velocity'], 'phase': phase,
+                     'density': frame['density'], 'pressure': frame['pressure']}
+        if adaptive:
+            frameData['level'] = state['level'].tolist()
+        if pool:
+            frameData['age'] = pool['age']
+            frameData = selectActiveParticles(frameData, pool['active']) # only particles that have been poured are cached and exported
+        details['clusterRadius'] = clusterRadius
+        details['snapshot'] = {'particles': numSpheres, 'clusterRadius': clusterRadius, 'tunedFrame': tunedFrame,
+                               'emitterCarry': emitter['carry'] if emitter else 0.0, 'random': rd.getstate() if emitter else None,
+                               'order': tuple(particleIds), 'free': tuple(pool['free']) if pool else None, 'substeps': monitor['substeps']}
+        # the memory order of the particles and free pool slots decide which particle is emitted next
+        yield createFrameView(i, frameData, details)
+
+def createOutputs(widgets, pSpheres, numSpheres, resumeFrame=None):
+    '''
+        creates the outputs taking the frames of a simulation in maya. Keyframing, the viewport and the telemetry use
+        maya and run inline, the cache, snapshots and exports are written in the Writer Mode.
+
+        widgets:    dictionary containing user controlled parameter values
+        pSpheres:    list containing instance names for each particle in system, in spawn order
+        numSpheres:    number of particles in the system
+        resumeFrame:    optional frame the simulation is solved again from, the cache and snapshots after it are removed
+        return:    list of dictionaries from createOutput, in the order they take each frame
+    '''
+    mode, lag = widgets.get('Writer Mode', 'Thread'), widgets.get('Writer Lag', OUTPUT_LAG)
+    outputs = [createOutput('viewport', previewView, (pSpheres,), stored=False)]
+    snapshotDir = widgets.get('Snapshot Directory') # the solver state of every frame is kept here, so the simulation can be solved again from any frame
+    if widgets.get('Bake Mode', 'Every Frame') == 'Decimated':
+        recorder = createKeyRecorder(numSpheres, pSpheres, widgets.get('Key Tolerance', 0.001))
+        if resumeFrame and snapshotDir:
+            recordKeySeams(recorder, snapshotDir, resumeFrame) # the kept keys join the frames solved again within the tolerance
+        outputs.append(createOutput('keyframe', recordView, (recorder,), finishKeyRecorder))
+        # trajectories are keyed once the simulation ends, keeping only the keys needed to follow them
+    else:
+        outputs.append(createOutput('keyframe', keyView, (pSpheres,)))
+    if 'Emission Rate' in widgets or widgets.get('Adaptive Resolution'):
+        outputs.append(createOutput('visibility', keyVisibility, (pSpheres,)))
+    if widgets.get('Adaptive Resolution'):
+        outputs.append(createOutput('scale', keyScale, (pSpheres,)))
+    outputs.append(createOutput('telemetry', reportView, ({'coarse': 0, 'fallbacks': 0, 'solves': 0, 'iterations': 0, 'solved': 0, 'capped': 0, 'most': 0, 'rollbacks': 0, 'substeps': 1},), reportSummary, stored=False))
+    cacheDir = widgets.get('Cache Directory')
+    if cacheDir:
+        clearParticleCache(cacheDir, resumeFrame or 1)
+        attributes = {'particleRadius': widgets['Particle Radius'], 'clusterRadius': widgets['Cluster Radius'], 'timeStep': widgets['Time Difference'], 'mass': widgets['Mass'], 'tankSize': 0.6}
+        encoder = createCacheEncoder() if widgets.get('Compress Cache') else None # compressed frames are predicted from the frame before
+        outputs.append(createOutput('cache', writeCacheView, (cacheDir, attributes, encoder), None, mode, lag, stored=False))
+        # stores every frame so that it can be meshed or reviewed without maya, frames loaded from the store are copied instead
+    if snapshotDir:
+        clearParticleCache(snapshotDir, resumeFrame or 1)
+        if not resumeFrame:
+            writeParticleNames(snapshotDir, pSpheres)
+        outputs.append(createOutput('snapshot', writeSnapshotView, (snapshotDir,), None, mode, lag, stored=False))
+    if widgets.get('Export Format', 'None') != 'None' and widgets.get('Export Directory'):
+        if not os.path.isdir(widgets['Export Directory']):
+            os.makedirs(widgets['Export Directory'])
+        outputs.append(createOutput('export', exportView, (widgets['Export Directory'], widgets['Export Format']), None, mode, lag))
+    return outputs
+
+def animateFluid(widgets, pSpheres, numSpheres, resumeFrame=None):
+    '''
+        animates the fluid based on user entered values
+        
+        widgets:    dictionary containing user controlled parameter values
+        pSpheres:    list of all particle instances in the system
+        numSpheres:    number of particles in the system.
+        resumeFrame:    optional frame to solve again from, carrying on from the snapshot of the frame before it. Earlier
+                        frames are kept as they are.
+    '''  
+    pSpheres = list(pSpheres) # particle instance names in spawn order, so the list index matches the particle id
+    if widgets.get('Adaptive Resolution') and not resumeFrame:
+        pSpheres += createReserveParticles(widgets, pSpheres)
+        numSpheres = len(pSpheres)
+    cacheDir, snapshotDir = widgets.get('Cache Directory'), widgets.get('Snapshot Directory')
+    data = None
+    if resumeFrame and snapshotDir:
+        data = readParticleCache(findCacheFile(snapshotDir, resumeFrame-1)) # the snapshot holds the solver state exactly as the earlier simulation left it
+    outputs = [startOutput(output) for output in createOutputs(widgets, pSpheres, numSpheres, resumeFrame)]
+    startFrame, storeDir = 1, widgets.get('Store Directory')
+    inexact = False # set when the solver carries on from a stored cache frame, which does not hold its full state
+    if storeDir and cacheDir and not resumeFrame:
+        runKey = findRunKey(widgets)
+        storedFrames = [f for f in findStoredFrames(storeDir, runKey) if f < widgets['No. of Frames']] # frames of an identical earlier simulation, which do not need to be solved again
+        visible, levels = set(), {}
+        for frame in storedFrames:
+            shutil.copyfile(findCacheFile(os.path.join(storeDir, runKey), frame), findCacheFile(cacheDir, frame))
+            data = readParticleCache(findCacheFile(cacheDir, frame))
+            present = set(data['id']) # only poured particles are cached, so particles appearing or vanishing were emitted or retired
+            resized = tuple([(pId, level) for pId, level in zip(data['id'], data.get('level', [])) if levels.get(pId, 0) != level])
+            view = createFrameView(frame, data, {'emitted': tuple(present - visible), 'retired': tuple(visible - present), 'resized': resized})
+            visible = present
+            levels.update(resized)
+            for output in outputs:
+                if output['stored']:
+                    sendToOutput(output, view)
+        if storedFrames:
+            print 'Loaded %d frames from a stored simulation.' % len(storedFrames)
+            touchStoredRun(storeDir, runKey)
+            startFrame = storedFrames[-1] + 1 # the solver carries on from the last stored frame, if the stored simulation was shorter than this one
+            snapshotPath = findStoredSnapshot(storeDir, runKey, storedFrames[-1])
+            if snapshotPath:
+                data = readParticleCache(snapshotPath) # the snapshot holds the emitter, random state and substeps the cache frame lacks
+                if snapshotDir:
+                    shutil.copyfile(snapshotPath, findCacheFile(snapshotDir, storedFrames[-1])) # so the longer simulation can be solved again from it
+            elif startFrame < widgets['No. of Frames']: # only a shorter stored simulation is carried on from
+                inexact = True
+                print 'The stored simulation has no snapshot, so it is continued from its cache and not stored again.'
+    if resumeFrame:
+        startFrame = resumeFrame
+        print 'Solving again from frame %d.' % resumeFrame
+    frames = simulateFluid(widgets, [p[0] for p in findPos(pSpheres)], data, startFrame)
+    # particle positions are read from maya once, after that the solver state holds them between frames
+    amount,pro = startFrame-1, 0
+    cmds.progressWindow(	title='Fluid Simulation',
+    					progress=amount,
+    					status='Simulating: 0%',
+    
+    					isInterruptable=True, maxValue=widgets['No. of Frames']) # creates a progress window to show current frames of the simulation
+				
+    diverged = False # set when the health monitor aborts the simulation, which is then not stored
+    try:
+        for view in frames:
+        
+            for output in outputs:
+                sendToOutput(output, view) # waits here if an output in a thread or process has fallen too far behind the solver
+        
+            startTime = time.time()
+
+            # Check if the dialog has been cancelled
+            if cmds.progressWindow( query=True, isCancelled=True ) :
+                print 'Simulation terminated.'
+                break
+
+            # Check if end condition has been reached
+            if cmds.progressWindow( query=True, progress=True ) >= widgets['No. of Frames'] :
+                print 'Simulation successfully executed.'
+                break
+
+            amount += 1
+
+            newTime = time.time() - startTime
+            cmds.progressWindow( edit=True, progress=amount, status=('Frame: ' + `amount` ) )
+            cmds.pause( seconds=newTime )
+    except FloatingPointError as error: # the health monitor gave up on a diverging simulation, the frames before it are kept
+        print error
+        diverged = True
+    frames.close()
+    cmds.progressWindow(endProgress=1)
+    if diverged:
+        cmds.confirmDialog(title='Simulation Diverged', message='%s\nA smaller Time Difference or Stiffness keeps the fluid stable.' % error, button=['OK'])
+    for output in outputs:
+        stopOutput(output)
+    if storeDir and cacheDir and startFrame < widgets['No. of Frames'] and not resumeFrame and not diverged and not inexact: # a simulation solved again from a frame mixes two sets of settings
+        storeSimulation(storeDir, runKey, cacheDir, widgets, snapshotDir) # keeps the result so that simulating the same settings again only has to bake it
+
+ENSEMBLE_PARAMETERS = ['Viscosity', 'Stiffness', 'Delta', 'Buoyancy', 'RLOS'] # parameters which may differ between the variants of an ensemble
+ENSEMBLE_SETTINGS = ['viscosity', 'implicitViscosity', 'stiffness', 'delta', 'buoyancy', 'rlos'] # the solver settings they decide
+
+def findEnsembleSettings(params, variants, numParticles):
+    '''
+        gathers the solver constants of an ensemble, where every variant solves its own copy of the same particles.
+        The settings which can differ between variants hold a numpy array with the value of every particle, the
+        variants being laid out one after the other.
+
+        params:    dictionary containing values for each user specified parameter
+        variants:    list of dictionaries of the parameters from ENSEMBLE_PARAMETERS which each variant changes
+        numParticles:    number of particles of each variant
+        return:    dictionary of the solver constants
+    '''
+    for variant in variants:
+        for name in variant:
+            if name not in ENSEMBLE_PARAMETERS:
+                raise ValueError('%s cannot differ between the variants of an ensemble, only %s can.' % (name, ', '.join(ENSEMBLE_PARAMETERS)))
+    each = [findSolverSettings(dict(params, **variant)) for variant in variants] # e.g a variant may solve its viscosity implicitly while another does not
+    settings = dict(each[0])
+    for name in ENSEMBLE_SETTINGS:
+        settings[name] = np.repeat(np.array([s[name] for s in each], dtype=np.float64), numParticles)
+    return settings
+
+def simulateEnsemble(outDir, params, variants, positions, numFrames, mode='Thread', lag=OUTPUT_LAG, action='Rollback'):
+    '''
+        solves several variants of the liquid parameters of one spawn layout together, writing a particle cache for
+        each. All variants are held in one solver state, one after the other, so every stage runs once per frame for
+        the whole ensemble instead of once per variant. Each variant finds its neighbours in a grid of its own.
+
+        outDir:    directory the cache of every variant is written into, as variant_001, variant_002 and so on,
+                   along with variants.json listing the parameters of each
+        params:    dictionary containing values for each user specified parameter, shared by every variant
+        variants:    list of dictionaries of the parameters from ENSEMBLE_PARAMETERS which each variant changes
+        positions:    list of x,y,z coordinates of the spawned particles
+        numFrames:    number of frames, solved from frame 1 like the simulations in maya
+        mode:    one of OUTPUT_MODES the caches are written in
+        lag:    most frames the cache writers may fall behind
+        action:    one of HEALTH_ACTIONS, taken for the whole ensemble when any variant diverges
+        return:    list of the cache directory of every variant, raises a FloatingPointError when the ensemble diverged
+    '''
+    backend = BACKENDS['NumPy'] # every stage takes the per-particle settings as numpy arrays
+    if not loadBackend(backend):
+        raise ImportError('ensembles need numpy')
+    n, count = len(positions), len(variants)
+    settings = findEnsembleSettings(params, variants, n)
+    state = createSolverState(backend, [list(pos) for pos in positions]*count, [list(params['Initial Velocity'][0])]*(n*count))
+    state['variant'] = np.repeat(np.arange(count), n)
+    if not os.path.exists(outDir):
+        os.makedirs(outDir)
+    with open(os.path.join(outDir, 'variants.json'), 'w') as variantFile:
+        json.dump([dict(variant, cache='variant_%03d' % (v+1)) for v, variant in enumerate(variants)], variantFile, indent=1, sort_keys=True)
+    cacheDirs = [os.path.join(outDir, 'variant_%03d' % (v+1)) for v in range(count)]
+    attributes = {'particleRadius': params['Particle Radius'], 'clusterRadius': params['Cluster Radius'], 'timeStep': params['Time Difference'], 'mass': params['Mass'], 'tankSize': 0.6}
+    outputs = []
+    for cacheDir in cacheDirs:
+        clearParticleCache(cacheDir)
+        outputs.append(startOutput(createOutput(os.path.basename(cacheDir), writeCacheView, (cacheDir, attributes), None, mode, lag)))
+    phase, startTime, monitor = [params.get('Type Of Liquid', 0)]*n, time.time(), createHealthMonitor(action)
+    try:
+        for frame in range(1, numFrames):
+            state['offset'] = SPAWN_OFFSET if frame == 1 else None
+            monitor['frame'] = frame
+            stepMonitored(backend, state, settings, monitor)
+            data = readFrame(backend, state)
+            for v, output in enumerate(outputs):
+                part = slice(v*n, (v+1)*n)
+                frameData = {'id': list(range(n)), 'position': data['position'][part], 'velocity': data['velocity'][part], 'phase': phase,
+                             'density': data['density'][part], 'pressure': data['pressure'][part]}
+                sendToOutput(output, createFrameView(frame, frameData, {}))
+    finally:
+        for output in outputs:
+            stopOutput(output) # the frames solved before a diverging step are still written
+    if monitor['rollbacks']:
+        print 'Rolled back %d steps which broke a health limit, the last steps were split into %d substeps.' % (monitor['rollbacks'], monitor['substeps'])
+    seconds = time.time() - startTime
+    print 'Solved %d variants of %d particles in %.1f seconds, %.3f seconds per variant and frame.' % (count, n, seconds, seconds/max(count*(numFrames-1), 1))
+    return cacheDirs
+
+def parseEnsembleVariants(values):
+    '''
+        reads the variants of an ensemble from the command line, every combination of the given values being one variant
+
+        values:    list of strings of the form Name=value,value,...
+        return:    list of dictionaries of the parameters of each variant
+    '''
+    names, choices = [], []
+    for value in values:
+        name, numbers = value.split('=', 1)
+        names.append(name)
+        choices.append([float(number) for number in numbers.split(',')])
+    return [dict(zip(names, combination)) for combination in itertools.product(*choices)]
+
+def buildSpatialGrid(positions, cellSize, active=None):
+    '''
+        sorts particles into a sparse uniform grid so that particles close to a point can be found by only visiting
+        the surrounding grid cells
+        
+        positions:    list of x,y,z coordinates of each particle
+        cellSize:    width of each grid cell
+        active:    optional list of booleans marking which particles of a particle pool are in use, the others are
+                   left out of the grid
+        return:    dictionary of occupied grid cells to a list of indices of particles within that cell, in ascending order
+    '''
+    grid = {}
+    for i in range(len(positions)):
+        if active is not None and not active[i]:
+            continue
+        try:
+            grid.setdefault(findGridCell(positions[i], cellSize), []).append(i)
+        except (ValueError, OverflowError): # a position which is not a number or infinite has no cell, like it has no neighbours
+            pass
+    return grid
+
+def findNearbyParticles(point, grid, cellSize):
+    '''
+        finds the indices of particles within the grid cell of a point and the 26 cells surrounding it
+        
+        point:    x,y,z coordinates of the point
+        grid:    dictionary of grid cells to particle indices from buildSpatialGrid
+        cellSize:    width of each grid cell
+        return:    list of particle indices that may lie within cellSize of the point, which is empty for a point
+                   that is not a number or infinite
+    '''
+    try:
+        cx, cy, cz = findGridCell(point, cellSize)
+    except (ValueError, OverflowError):
+        return []
+    nearby = []
+    for x in (cx-1, cx, cx+1):
+        for y in (cy-1, cy, cy+1):
+            for z in (cz-1, cz, cz+1):
+                nearby.extend(grid.get((x, y, z), ()))
+    return nearby
+
+def findSurfaceParticles(positions, grid, supportRadius):
+    '''
+        flags particles close to the free surface of the fluid. Particles inside the fluid are surrounded evenly by 
+        their neighbours, whereas the neighbours of a surface particle are all pulled to one side of it.
+        
+        positions:    list of x,y,z coordinates of each particle
+        grid:    dictionary of grid cells to particle indices, built with a cell size of supportRadius
+        supportRadius:    radius within which particles are counted as neighbours
+        return:    list of booleans, True for particles at the surface of the fluid
+    '''
+    surface = []
+    for i in range(len(positions)):
+        pos, count, centre = positions[i], 0, [0.0, 0.0, 0.0]
+        for j in findNearbyParticles(pos, grid, supportRadius):
+            d = [positions[j][l] - pos[l] for l in range(3)]
+            if d[0]**2 + d[1]**2 + d[2]**2 < supportRadius**2:
+                count += 1
+                centre = [centre[l] + d[l] for l in range(3)]
+        offset = m.sqrt(sum([(c/count)**2 for c in centre])) # distance from the particle to the centre of its neighbourhood
+        surface.append(count < 8 or offset > 0.2*supportRadius)
+    return surface
+
+def evaluateDensityField(point, positions, grid, supportRadius):
+    '''
+        evaluates the smoothed particle density field at a point, where each particle contributes (1 - r^2/h^2)^3 
+        within its support radius h
+        
+        point:    x,y,z coordinates where the field is evaluated
+        positions:    list of x,y,z coordinates of each particle
+        grid:    dictionary of grid cells to particle indices, built with a cell size of supportRadius
+        supportRadius:    radius of influence of each particle
+        return:    value of the density field at the point
+    '''
+    value, h2 = 0.0, supportRadius**2
+    for j in findNearbyParticles(point, grid, supportRadius):
+        r2 = (positions[j][0]-point[0])**2 + (positions[j][1]-point[1])**2 + (positions[j][2]-point[2])**2
+        if r2 < h2:
+            value += (1.0 - r2/h2)**3
+    return value
+
+def buildNarrowBand(positions, voxelSize, supportRadius):
+    '''
+        builds a sparse grid of density field samples around the surface of the fluid. Only grid corners within the
+        support radius of a surface particle are sampled, so the memory used scales with the surface area of the fluid 
+        rather than the volume of its bounding box.
+        
+        positions:    list of x,y,z coordinates of each particle
+        voxelSize:    width of each cell of the sparse grid
+        supportRadius:    radius of influence of each particle
+        return:    the spatial grid of particles and a dictionary of sampled grid corners (i,j,k) to density field values
+    '''
+    grid = buildSpatialGrid(positions, supportRadius)
+    surface = findSurfaceParticles(positions, grid, supportRadius)
+    reach = int(m.ceil(supportRadius/voxelSize))
+    band = {}
+    for i in range(len(positions)):
+        if not surface[i]:
+            continue # corners only touched by interior particles lie well inside the fluid and never hold part of the surface
+        ci, cj, ck = [int(m.floor(positions[i][l]/voxelSize)) for l in range(3)]
+        for x in range(ci-reach, ci+reach+2):
+            for y in range(cj-reach, cj+reach+2):
+                for z in range(ck-reach, ck+reach+2):
+                    if (x, y, z) not in band:
+                        band[(x, y, z)] = evaluateDensityField((x*voxelSize, y*voxelSize, z*voxelSize), positions, grid, supportRadius)
+    return grid, band
+
+CUBE_CORNERS = [(0,0,0), (1,0,0), (1,1,0), (0,1,0), (0,0,1), (1,0,1), (1,1,1), (0,1,1)]
+CUBE_TETRAHEDRA = [(0,5,1,6), (0,1,2,6), (0,2,3,6), (0,3,7,6), (0,7,4,6), (0,4,5,6)]
+# every grid cell is split into six tetrahedra around the diagonal between corners 0 and 6, which splits the faces of neighbouring cells the same way
+
+def marchTetrahedra(band, positions, grid, voxelSize, supportRadius, isoLevel):
+    '''
+        extracts the surface of the fluid from the sparse density grid. Each grid cell touching the narrow band is
+        split into tetrahedra, and triangles are placed where the density field crosses the iso level. Vertices on 
+        shared edges are reused, so the resulting mesh is closed.
+        
+        band:    dictionary of grid corners to density field values from buildNarrowBand, corners missing from the 
+                 band are evaluated when they are first needed
+        positions:    list of x,y,z coordinates of each particle
+        grid:    dictionary of grid cells to particle indices, built with a cell size of supportRadius
+        voxelSize:    width of each cell of the sparse grid
+        supportRadius:    radius of influence of each particle
+        isoLevel:    density field value at the surface of the fluid
+        return:    a list of vertex coordinates and a list of triangles as vertex index triples
+    '''
+    cells = set()
+    for (x, y, z) in band.keys():
+        for c in CUBE_CORNERS:
+            cells.add((x-c[0], y-c[1], z-c[2])) # every cell having a sampled corner may hold part of the surface
+    vertices, faces, edgeVertex = [], [], {}
+    
+    def cornerValue(key):
+        if key not in band:
+            band[key] = evaluateDensityField((key[0]*voxelSize, key[1]*voxelSize, key[2]*voxelSize), positions, grid, supportRadius)
+        return band[key]
+    
+    def edgePoint(a, b):
+        edge = (a, b) if a < b else (b, a)
+        if edge not in edgeVertex:
+            va, vb = band[a], band[b]
+            t = (isoLevel - va)/(vb - va) # linear interpolation of the crossing point along the edge
+            edgeVertex[edge] = len(vertices)
+            vertices.append(tuple([(a[l] + t*(b[l]-a[l]))*voxelSize for l in range(3)]))
+        return edgeVertex[edge]
+    
+    def addTriangle(tri, inside, outside):
+        p = [vertices[v] for v in tri]
+        e1, e2 = [p[1][l]-p[0][l] for l in range(3)], [p[2][l]-p[0][l] for l in range(3)]
+        normal = (e1[1]*e2[2]-e1[2]*e2[1], e1[2]*e2[0]-e1[0]*e2[2], e1[0]*e2[1]-e1[1]*e2[0])
+        direction = [sum([c[l] for c in outside])/len(outside) - sum([c[l] for c in inside])/len(inside) for l in range(3)]
+        if sum([normal[l]*direction[l] for l in range(3)]) < 0:
+            tri = (tri[0], tri[2], tri[1]) # flips the triangle so that its normal points out of the fluid
+        faces.append(tri)
+    
+    for (x, y, z) in cells:
+        corners = [(x+c[0], y+c[1], z+c[2]) for c in CUBE_CORNERS]
+        values = [cornerValue(c) for c in corners]
+        if min(values) > isoLevel or max(values) <= isoLevel:
+            continue # the surface does not pass through this cell
+        for tet in CUBE_TETRAHEDRA:
+            inside = [corners[t] for t in tet if values[t] > isoLevel]
+            outside = [corners[t] for t in tet if values[t] <= isoLevel]
+            if len(inside) == 1 or len(inside) == 3:
+                single, others = (inside[0], outside) if len(inside) == 1 else (outside[0], inside)
+                addTriangle(tuple([edgePoint(single, o) for o in others]), inside, outside)
+            elif len(inside) == 2:
+                a, b, c, d = inside[0], inside[1], outside[0], outside[1]
+                addTriangle((edgePoint(a, c), edgePoint(a, d), edgePoint(b, d)), inside, outside)
+                addTriangle((edgePoint(a, c), edgePoint(b, d), edgePoint(b, c)), inside, outside)
+    return vertices, faces
+
+def writeObjMesh(path, vertices, faces):
+    '''
+        writes a triangle mesh to a .obj file
+        
+        path:    file path of the .obj
+        vertices:    list of x,y,z vertex coordinates
+        faces:    list of triangles as triples of indices into vertices
+    '''
+    objFile = open(path, 'w')
+    objFile.write(''.join(['v %.6f %.6f %.6f\n' % v for v in vertices]))
+    objFile.write(''.join(['f %d %d %d\n' % (f[0]+1, f[1]+1, f[2]+1) for f in faces])) # .obj indices start at 1
+    objFile.close()
+
+def meshCacheFrame(job):
+    '''
+        builds the fluid surface mesh of a single cached frame and writes it to a .obj file. This runs within 
+        worker processes, so it takes all of its values as a single tuple.
+        
+        job:    tuple of (cache file path, output directory, voxel size, support radius, iso level), where a voxel 
+                size, support radius or iso level of None is derived from the particle radius stored in the cache
+        return:    tuple of the frame number, number of vertices, number of triangles and number of sampled grid corners
+    '''
+    cachePath, outDir, voxelSize, supportRadius, isoLevel = job
+    data = readParticleCache(cachePath)
+    particleRadius = data['attributes']['particleRadius']
+    if supportRadius is None:
+        supportRadius = max(3*particleRadius, data['attributes']['clusterRadius']) # wide enough for neighbouring particles to blend into one surface
+    if voxelSize is None:
+        voxelSize = supportRadius/4.0
+    if isoLevel is None:
+        isoLevel = (1.0 - (particleRadius/supportRadius)**2)**3 # a lone particle is meshed as a sphere of the particle radius
+    grid, band = buildNarrowBand(data['position'], voxelSize, supportRadius)
+    vertices, faces = marchTetrahedra(band, data['position'], grid, voxelSize, supportRadius, isoLevel)
+    writeObjMesh(os.path.join(outDir, 'fluidMesh.%04d.obj' % data['frame']), vertices, faces)
+    return data['frame'], len(vertices), len(faces), len(band)
+
+def meshParticleCache(cacheDir, outDir, voxelSize=None, supportRadius=None, isoLevel=None, processes=None):
+    '''
+        reconstructs the surface of the fluid for every frame of a particle cache, writing one .obj mesh per frame.
+        Frames are meshed in parallel by worker processes and each mesh is written as soon as its frame is done. 
+        
+        cacheDir:    directory containing the particle cache
+        outDir:    directory the .obj meshes are written to
+        voxelSize:    width of each cell of the sparse grid, derived from the support radius when not given
+        supportRadius:    radius of influence of each particle, derived from the cached particle radius when not given
+        isoLevel:    density field value at the surface of the fluid
+        processes:    number of worker processes, defaults to the number of cpus. Within maya use 1, as maya cannot 
+                      start worker processes of itself.
+        return:    list of (frame, vertices, triangles, sampled corners) tuples in the order frames finished
+    '''
+    if not os.path.isdir(outDir):
+        os.makedirs(outDir)
+    jobs = [(findCacheFile(cacheDir, f), outDir, voxelSize, supportRadius, isoLevel) for f in listCacheFrames(cacheDir)]
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    results = []
+    if processes <= 1:
+        meshed = (meshCacheFrame(job) for job in jobs)
+    else:
+        pool = multiprocessing.Pool(processes)
+        meshed = pool.imap_unordered(meshCacheFrame, jobs) # frames are handed back as they finish, so meshes stream out while others are still being built
+    for frame, numVerts, numFaces, bandSize in meshed:
+        print 'Meshed frame %d: %d vertices, %d triangles, %d grid samples' % (frame, numVerts, numFaces, bandSize)
+        results.append((frame, numVerts, numFaces, bandSize))
+    if processes > 1:
+        pool.close()
+        pool.join()
+    return results
+
+FLIPBOOK_VIEWS = {'front': ((1.0, 0.0, 0.0), (0.0, 1.0, 0.0), (0.0, 0.0, -1.0)), 'side': ((0.0, 0.0, -1.0), (0.0, 1.0, 0.0), (-1.0, 0.0, 0.0)),
+                  'top': ((1.0, 0.0, 0.0), (0.0, 0.0, -1.0), (0.0, -1.0, 0.0))}
+# right, up and forward directions of the orthographic flipbook cameras, the perspective camera looks down on the fluid from the front right
+FLIPBOOK_RAMP = [(0.05, 0.15, 0.5), (0.15, 0.55, 0.9), (0.95, 0.95, 0.9), (0.95, 0.5, 0.1)] # colours from the lowest to the highest density or speed
+PHASE_COLOURS = {0: (0.6, 0.6, 0.6), 1: (0.95, 0.93, 0.85), 2: (0.4, 0.22, 0.1), 3: (0.25, 0.5, 0.95)} # custom liquid, milk, coffee and water
+FLIPBOOK_BACKGROUND = (40, 40, 46)
+
+def writePng(path, width, height, pixels):
+    '''
+        writes an 8 bit RGB image to a .png file
+
+        path:    file path of the .png
+        width, height:    size of the image in pixels
+        pixels:    string of width*height*3 bytes, one row after another from the top of the image
+    '''
+    rows = ''.join(['\x00' + pixels[y*width*3:(y+1)*width*3] for y in range(height)]) # every row starts with filter type 0, unfiltered
+    def chunk(tag, data):
+        return struct.pack('!I', len(data)) + tag + data + struct.pack('!I', zlib.crc32(tag + data) & 0xffffffff)
+    pngFile = open(path, 'wb')
+    pngFile.write('\x89PNG\r\n\x1a\n' + chunk('IHDR', struct.pack('!IIBBBBB', width, height, 8, 2, 0, 0, 0)) +
+                  chunk('IDAT', zlib.compress(rows, 6)) + chunk('IEND', ''))
+    pngFile.close()
+
+def scanParticleCache(paths, colourBy, samples=10):
+    '''
+        finds the space taken up by the particles and the range of the coloured field over a sample of cached frames,
+        so that every image of a flipbook uses the same camera and colours
+
+        paths:    list of cache file paths
+        colourBy:    'density', 'velocity' or 'phase'
+        samples:    most frames to read
+        return:    the lowest and highest x,y,z coordinates, and the lowest and highest value of the coloured field
+    '''
+    low, high, values = [float('inf')]*3, [float('-inf')]*3, []
+    for path in paths[::max(len(paths)//samples, 1)]:
+        data = readParticleCache(path)
+        for pos in data['position']:
+            low, high = [min(low[l], pos[l]) for l in range(3)], [max(high[l], pos[l]) for l in range(3)]
+        values.extend(findColourValues(data, colourBy))
+    if not values:
+        return [-1.0]*3, [1.0]*3, (0.0, 1.0)
+    return low, high, (min(values), max(values))
+
+def findColourValues(data, colourBy):
+    '''
+        data:    dictionary of a cached frame from readParticleCache
+        colourBy:    'density', 'velocity' or 'phase'
+        return:    list of the value each particle is coloured by, where velocity is coloured by speed
+    '''
+    if colourBy == 'velocity':
+        return [m.sqrt(v[0]**2 + v[1]**2 + v[2]**2) for v in data['velocity']]
+    return list(data[colourBy])
+
+def findFlipbookColours(values, colourBy, valueRange):
+    '''
+        values:    list of the value each particle is coloured by
+        colourBy:    'density', 'velocity' or 'phase'
+        valueRange:    lowest and highest value, mapped to the ends of FLIPBOOK_RAMP
+        return:    list of r,g,b colours between 0 and 1 for every particle
+    '''
+    if colourBy == 'phase':
+        return [PHASE_COLOURS.get(int(v), PHASE_COLOURS[0]) for v in values]
+    colours, span = [], (valueRange[1] - valueRange[0]) or 1.0
+    for v in values:
+        t = min(max((v - valueRange[0])/span, 0.0), 1.0)*(len(FLIPBOOK_RAMP) - 1)
+        k = min(int(t), len(FLIPBOOK_RAMP) - 2)
+        colours.append(tuple([FLIPBOOK_RAMP[k][l] + (t - k)*(FLIPBOOK_RAMP[k+1][l] - FLIPBOOK_RAMP[k][l]) for l in range(3)]))
+    return colours
+
+def createFlipbookCamera(view, low, high, width, height):
+    '''
+        frames the particles with an orthographic or perspective camera
+
+        view:    'perspective' or a key of FLIPBOOK_VIEWS
+        low, high:    lowest and highest x,y,z coordinates of the particles from scanParticleCache
+        width, height:    size of the images in pixels
+        return:    dictionary of the camera position, its right, up and forward directions, whether it is a perspective
+                   camera, and the scale from scene units to pixels (at a distance of one for the perspective camera)
+    '''
+    centre = [(low[l] + high[l])/2 for l in range(3)]
+    extent = max([high[l] - low[l] for l in range(3)] + [1e-6])
+    if view == 'perspective':
+        eye = [centre[0] + 1.2*extent, centre[1] + 0.9*extent, centre[2] + 1.8*extent]
+        forward = [centre[l] - eye[l] for l in range(3)]
+        length = m.sqrt(sum([f*f for f in forward]))
+        forward = [f/length for f in forward]
+        right = [-forward[2], 0.0, forward[0]] # forward crossed with the world up
+        length = m.sqrt(sum([r*r for r in right]))
+        right = [r/length for r in right]
+        up = [right[1]*forward[2] - right[2]*forward[1], right[2]*forward[0] - right[0]*forward[2], right[0]*forward[1] - right[1]*forward[0]]
+        scale = 0.5*min(width, height)/m.tan(m.radians(20)) # a 40 degree field of view
+        return {'position': eye, 'right': right, 'up': up, 'forward': forward, 'perspective': True, 'scale': scale}
+    right, up, forward = FLIPBOOK_VIEWS[view]
+    position = [centre[l] - 2*extent*forward[l] for l in range(3)]
+    return {'position': position, 'right': list(right), 'up': list(up), 'forward': list(forward), 'perspective': False,
+            'scale': 0.9*min(width, height)/extent}
+
+def splatParticles(positions, colours, radius, camera, width, height):
+    '''
+        draws every particle as a shaded disc facing the camera. The depth of each pixel is the depth of the front of
+        the particle's sphere, and the nearest particle covering a pixel wins, so overlapping particles cut into each
+        other like spheres. With numpy every pixel covered by every particle is found at once and sorted by depth.
+
+        positions:    list of x,y,z coordinates of each particle
+        colours:    list of r,g,b colours between 0 and 1 of each particle
+        radius:    particle radius in scene units
+        camera:    dictionary from createFlipbookCamera
+        width, height:    size of the image in pixels
+        return:    string of width*height*3 bytes of the image
+    '''
+    if np is not None:
+        points = np.array(positions, dtype=np.float64).reshape(-1, 3) - camera['position']
+        depth = points.dot(camera['forward'])
+        scale = camera['scale']/np.maximum(depth, 1e-6) if camera['perspective'] else np.full(len(points), camera['scale'])
+        x, y = width/2.0 + scale*points.dot(camera['right']), height/2.0 - scale*points.dot(camera['up'])
+        pixelRadius = np.maximum(radius*scale, 0.5)
+        image = np.empty((height*width, 3), dtype=np.uint8)
+        image[:] = FLIPBOOK_BACKGROUND
+        reach = int(m.ceil(pixelRadius.max())) if len(points) else 0
+        offsets = np.array([(dx, dy) for dy in range(-reach, reach+1) for dx in range(-reach, reach+1)], dtype=np.float64).reshape(-1, 2)
+        particle = np.repeat(np.arange(len(points)), len(offsets))
+        px = np.floor(x)[particle] + np.tile(offsets[:,0], len(points))
+        py = np.floor(y)[particle] + np.tile(offsets[:,1], len(points))
+        d2 = ((px + 0.5 - x[particle])**2 + (py + 0.5 - y[particle])**2)/pixelRadius[particle]**2
+        keep = (d2 <= 1.0) & (px >= 0) & (px < width) & (py >= 0) & (py < height) & (depth[particle] > 0)
+        particle, d2, pixel = particle[keep], d2[keep], (py[keep]*width + px[keep]).astype(np.int64)
+        shade = np.sqrt(1.0 - d2)
+        order = np.lexsort((depth[particle] - radius*shade, pixel)) # fragments by pixel, nearest first
+        pixel, particle, shade = pixel[order], particle[order], shade[order]
+        first = np.ones(len(pixel), dtype=bool)
+        first[1:] = pixel[1:] != pixel[:-1]
+        lit = np.array(colours, dtype=np.float64).reshape(-1, 3)[particle[first]]*(0.35 + 0.65*shade[first])[:,None]
+        image[pixel[first]] = np.clip(255*lit, 0, 255).astype(np.uint8)
+        return image.tobytes()
+    image, nearest = bytearray(FLIPBOOK_BACKGROUND*(width*height)), [float('inf')]*(width*height)
+    for pos, colour in zip(positions, colours):
+        point = [pos[l] - camera['position'][l] for l in range(3)]
+        depth = sum([point[l]*camera['forward'][l] for l in range(3)])
+        if depth <= 0:
+            continue # behind the camera
+        scale = camera['scale']/depth if camera['perspective'] else camera['scale']
+        x = width/2.0 + scale*sum([point[l]*camera['right'][l] for l in range(3)])
+        y = height/2.0 - scale*sum([point[l]*camera['up'][l] for l in range(3)])
+        pixelRadius = max(radius*scale, 0.5)
+        reach = int(m.ceil(pixelRadius))
+        for py in range(int(m.floor(y)) - reach, int(m.floor(y)) + reach + 1):
+            for px in range(int(m.floor(x)) - reach, int(m.floor(x)) + reach + 1):
+                d2 = ((px + 0.5 - x)**2 + (py + 0.5 - y)**2)/pixelRadius**2
+                if d2 > 1.0 or px < 0 or px >= width or py < 0 or py >= height:
+                    continue
+                shade = m.sqrt(1.0 - d2)
+                if depth - radius*shade < nearest[py*width + px]:
+                    nearest[py*width + px] = depth - radius*shade
+                    image[3*(py*width + px):3*(py*width + px) + 3] = bytearray([min(max(int(255*c*(0.35 + 0.65*shade)), 0), 255) for c in colour])
+    return str(image)
+
+def renderCacheFrame(job):
+    '''
+        renders a single cached frame to a .png file. This runs within worker processes, so it takes all of its
+        values as a single tuple.
+
+        job:    tuple of (cache file path, output directory, camera, colourBy, value range, width, height)
+        return:    tuple of the frame number and the number of particles drawn
+    '''
+    cachePath, outDir, camera, colourBy, valueRange, width, height = job
+    data = readParticleCache(cachePath)
+    colours = findFlipbookColours(findColourValues(data, colourBy), colourBy, valueRange)
+    pixels = splatParticles(data['position'], colours, data['attributes']['particleRadius'], camera, width, height)
+    writePng(os.path.join(outDir, 'flipbook.%04d.png' % data['frame']), width, height, pixels)
+    return data['frame'], data['count']
+
+def renderFlipbook(cacheDir, outDir, view='perspective', colourBy='density', width=640, height=480, valueRange=None, processes=None):
+    '''
+        renders every frame of a particle cache to a .png sequence without maya, for reviewing simulations quickly.
+        Frames are rendered in parallel by worker processes, all framed by the same camera and coloured over the
+        same range.
+
+        cacheDir:    directory containing the particle cache
+        outDir:    directory the .png images are written to
+        view:    'perspective', 'front', 'side' or 'top'
+        colourBy:    'density', 'velocity' (coloured by speed) or 'phase'
+        width, height:    size of the images in pixels
+        valueRange:    lowest and highest value of the coloured field, found from a sample of frames when not given
+        processes:    number of worker processes, defaults to the number of cpus
+        return:    list of (frame, particles drawn) tuples in the order frames finished
+    '''
+    if not os.path.isdir(outDir):
+        os.makedirs(outDir)
+    paths = [findCacheFile(cacheDir, f) for f in listCacheFrames(cacheDir)]
+    if not paths:
+        return []
+    low, high, foundRange = scanParticleCache(paths, colourBy)
+    camera = createFlipbookCamera(view, low, high, width, height)
+    jobs = [(path, outDir, camera, colourBy, valueRange or foundRange, width, height) for path in paths]
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    results = []
+    if processes <= 1:
+        rendered = (renderCacheFrame(job) for job in jobs)
+    else:
+        pool = multiprocessing.Pool(processes)
+        rendered = pool.imap_unordered(renderCacheFrame, jobs)
+    for frame, count in rendered:
+        results.append((frame, count))
+    if processes > 1:
+        pool.close()
+        pool.join()
+    print 'Rendered %d frames to %s' % (len(results), outDir)
+    return results
+
+def readExactly(sock, size):
+    '''
+        reads a number of bytes from a socket, waiting until all of them have arrived
+
+        sock:    connected socket
+        size:    number of bytes to read
+        return:    the bytes read
+    '''
+    chunks, remaining = [], size
+    while remaining > 0:
+        chunk = sock.recv(min(remaining, 1 << 20))
+        if not chunk:
+            raise EOFError('connection closed by the other process')
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
+
+def sendMessage(sock, message):
+    '''
+        sends a message between the processes of a distributed simulation. Arrays are sent as raw bytes after a json
+        header holding every other value, the same way frames are stored in the particle cache.
+
+        sock:    connected socket
+        message:    dictionary of names to json values or array.array values
+    '''
+    header = {'byteorder': sys.byteorder, 'values': {}, 'arrays': []}
+    payload = []
+    for name, value in message.items():
+        if isinstance(value, array.array):
+            header['arrays'].append([name, value.typecode, len(value)])
+            payload.append(value.tostring())
+        else:
+            header['values'][name] = value
+    header, payload = json.dumps(header).encode('utf-8'), b''.join(payload)
+    sock.sendall(struct.pack('!II', len(header), len(payload)) + header + payload)
+            
+def receiveMessage(sock):
+    '''
+        receives a message sent by sendMessage
+                
+        sock:    connected socket
+        return:    dictionary of the names to the values of the message
+    '''
+    headerSize, payloadSize = struct.unpack('!II', readExactly(sock, 8))
+    header = json.loads(readExactly(sock, headerSize).decode('utf-8'))
+    payload, offset = readExactly(sock, payloadSize), 0
+    message = dict(header['values'])
+    for name, typecode, count in header['arrays']:
+        values = array.array(str(typecode))
+        values.fromstring(payload[offset:offset + count*values.itemsize])
+        if header['byteorder'] != sys.byteorder:
+            values.byteswap()
+        offset += count*values.itemsize
+        message[name] = values
+    return message
+            
+def packParticles(particles, fields=('id', 'position', 'velocity')):
+    '''
+        packs particles into arrays ready to be sent with sendMessage
+        
+        particles:    dictionary of field names to a list of the value of that field for every particle
+        fields:    names of the fields to pack, ids are packed as integers and every other field as doubles
+        return:    dictionary of field names to arrays
+    '''
+    packed = {}
+    for name in fields:
+        if name == 'id':
+            packed[name] = array.array('i', particles[name])
+        elif particles[name] and isinstance(particles[name][0], (list, tuple)):
+            packed[name] = array.array('d', [v for value in particles[name] for v in value])
+        else:
+            packed[name] = array.array('d', particles[name])
+    return packed
+        
+def unpackParticles(message, fields=('id', 'position', 'velocity')):
+    '''
+        unpacks the particles of a message packed by packParticles
+
+        message:    dictionary from receiveMessage
+        fields:    names of the fields to unpack, position and velocity are unpacked into x,y,z lists
+        return:    dictionary of field names to a list of the value of that field for every particle
+    '''
+    particles = {}
+    for name in fields:
+        values = message[name]
+        if name in ('position', 'velocity'):
+            particles[name] = [list(values[j:j+3]) for j in range(0, len(values), 3)]
+        else:
+            particles[name] = list(values)
+    return particles
+
+def findSlabBounds(xs, numSlabs, haloWidth):
+    '''
+        splits the domain into slabs along the x axis holding roughly the same number of particles. Slabs are kept at
+        least a halo wide, so the neighbours of every particle are within its own slab or the slabs either side of it.
+
+        xs:    list of the x coordinate of every particle
+        numSlabs:    the number of slabs wanted
+        haloWidth:    the greatest distance between two neighbouring particles
+        return:    list of the x coordinates dividing the slabs, in increasing order
+    '''
+    xs = sorted(xs)
+    cuts = []
+    for n in range(1, numSlabs):
+        cut = xs[len(xs)*n//numSlabs] if xs else 0.0
+        if not cuts or cut - cuts[-1] >= haloWidth:
+            cuts.append(cut)
+    return cuts
+
+def findSlab(x, cuts):
+    '''
+        finds the slab owning a position along the x axis
+
+        x:    x coordinate of the particle
+        cuts:    list of the x coordinates dividing the slabs, from findSlabBounds
+        return:    index of the slab
+    '''
+    return bisect.bisect_right(cuts, x)
+
+def findSlabParticles(particles, cuts, numSlabs):
+    '''
+        sorts particles into the slabs that own them
+
+        particles:    dictionary of the id, position and velocity of every particle
+        cuts:    list of the x coordinates dividing the slabs, from findSlabBounds
+        numSlabs:    number of slabs
+        return:    list holding a dictionary of the id, position and velocity of the particles of each slab
+    '''
+    slabs = [{'id': [], 'position': [], 'velocity': []} for k in range(numSlabs)]
+    for pId, pos, vel in zip(particles['id'], particles['position'], particles['velocity']):
+        slab = slabs[findSlab(pos[0], cuts)]
+        slab['id'].append(pId)
+        slab['position'].append(pos)
+        slab['velocity'].append(vel)
+    return slabs
+
+def exchangeWithPeers(peers, messages):
+    '''
+        sends a message to every neighbouring slab and receives one back from each. Messages are sent from separate
+        threads so that two workers sending large halos to each other at once cannot wait on each other forever.
+
+        peers:    dictionary of 'lower' and 'upper' to the socket connected to that neighbouring slab
+        messages:    dictionary of 'lower' and 'upper' to the message for that neighbour
+        return:    dictionary of 'lower' and 'upper' to the message received from that neighbour
+    '''
+    senders = [threading.Thread(target=sendMessage, args=(peers[side], messages[side])) for side in peers]
+    for sender in senders:
+        sender.start()
+    received = dict([(side, receiveMessage(peers[side])) for side in peers])
+    for sender in senders:
+        sender.join()
+    return received
+
+def runWorker(address):
+    '''
+        solves one slab of a distributed simulation. Every frame the worker swaps the particles within a halo of its
+        slab boundaries with the neighbouring slabs, solves its own particles together with the halo particles of its
+        neighbours and sends its particles back to the coordinator, which passes particles that left the slab on to
+        their new owner.
+
+        address:    (host, port) of the coordinator
+    '''
+    coordinator = socket.create_connection(tuple(address))
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind((coordinator.getsockname()[0], 0)) # the neighbouring slabs connect on the same network the coordinator is reached on
+    listener.listen(1)
+    sendMessage(coordinator, {'kind': 'hello', 'address': listener.getsockname()})
+    setup = receiveMessage(coordinator)
+    settings, haloWidth = setup['settings'], setup['haloWidth']
+    backend = selectBackend(setup['backend'])
+    peers = {}
+    if setup['lowerPeer']:
+        peers['lower'] = socket.create_connection(tuple(setup['lowerPeer']))
+    if setup['hasUpper']:
+        peers['upper'] = listener.accept()[0]
+    listener.close()
+    particles = {'id': [], 'position': [], 'velocity': []}
+    while True:
+        message = receiveMessage(coordinator)
+        if message['kind'] == 'stop':
+            break
+        low, high = message['low'], message['high']
+        migrants = unpackParticles(message) # particles which moved into this slab on the previous frame
+        if message['reset']:
+            particles = migrants # the slabs were rebalanced, so the coordinator sent every particle this slab now owns
+        else:
+            for name in particles:
+                particles[name] += migrants[name]
+        numOwned = len(particles['id'])
+        halo = {'lower': [j for j in range(numOwned) if low is not None and particles['position'][j][0] < low + haloWidth],
+                'upper': [j for j in range(numOwned) if high is not None and particles['position'][j][0] >= high - haloWidth]}
+        sent = dict([(side, packParticles(dict([(name, [particles[name][j] for j in halo[side]]) for name in particles]))) for side in peers])
+        ghosts = dict([(side, unpackParticles(received)) for side, received in exchangeWithPeers(peers, sent).items()])
+        sides = [side for side in ['lower', 'upper'] if side in ghosts]
+        positions = particles['position'] + [p for side in sides for p in ghosts[side]['position']]
+        velocities = particles['velocity'] + [v for side in sides for v in ghosts[side]['velocity']]
+        state = createSolverState(backend, positions, velocities)
+        state['offset'] = message['offset']
+        stepFluid(backend, state, settings, SOLVER_STAGES[:2])
+        density = backend['toScalars'](state['density'])
+        received = exchangeWithPeers(peers, dict([(side, {'density': array.array('d', [density[j] for j in halo[side]])}) for side in peers]))
+        density = density[:numOwned] + [d for side in sides for d in received[side]['density']] # halo particles take the density found by their own slab
+        state['density'] = backend['fromScalars'](density)
+        state['pressure'] = backend['fromScalars']([settings['stiffness']*(d - settings['density']) for d in density])
+        stepFluid(backend, state, settings, SOLVER_STAGES[2:])
+        result = {'id': particles['id'], 'position': backend['toVectors'](state['position'])[:numOwned],
+                  'velocity': backend['toVectors'](state['velocity'])[:numOwned], 'density': density[:numOwned],
+                  'pressure': backend['toScalars'](state['pressure'])[:numOwned]}
+        reply = packParticles(result, ('id', 'position', 'velocity', 'density', 'pressure'))
+        reply['kind'] = 'frame'
+        sendMessage(coordinator, reply)
+        inside = [j for j in range(numOwned) if (low is None or result['position'][j][0] >= low) and (high is None or result['position'][j][0] < high)]
+        particles = dict([(name, [result[name][j] for j in inside]) for name in particles]) # particles that left are sent to their new slab by the coordinator
+    for sock in list(peers.values()) + [coordinator]:
+        sock.close()
+    
+def checkDistributedBudget(params, particles, numWorkers, budget):
+    '''
+        compares the cost of a distributed simulation against a budget, taking each worker to solve an equal share of
+        the particles with the neighbour counts of the whole spawn
+    
+        params:    dictionary containing values for each user specified parameter
+        particles:    dictionary of the id, position and velocity of every particle at the start
+        numWorkers:    number of workers sharing the simulation
+        budget:    dictionary of 'Time Budget' in minutes and 'Memory Budget' in megabytes per worker
+        return:    list of messages describing each budget the simulation goes over, empty if it fits
+    '''
+    settings = findSolverSettings(params)
+    neighbours = max(estimateNeighbours(particles['position'], settings, rd.Random(0)), min(findSettledNeighbours(settings), len(particles['id'])))
+    calibration = loadCalibration()
+    backend = params['Backend'] if params['Backend'] in BACKENDS and loadBackend(BACKENDS[params['Backend']]) else findAvailableBackends()[0]
+    cost, share = calibration.get(backend, DEFAULT_CALIBRATION[backend]), float(len(particles['id']))/max(numWorkers, 1)
+    frameSeconds = cost['particleSeconds']*share + cost['pairSeconds']*share*neighbours
+    plan = {'backend': backend, 'particles': len(particles['id']), 'spawnNeighbours': neighbours, 'clusterRadius': settings['clusterRadius'], 'settledNeighbours': findSettledNeighbours(settings),
+            'frameSeconds': frameSeconds, 'totalSeconds': frameSeconds*max(params['No. of Frames']-1, 0),
+            'memoryBytes': cost['particleBytes']*share + cost['pairBytes']*share*neighbours}
+    print formatPlan(plan)
+    return checkBudget(plan, budget)
+
+def simulateDistributed(cacheDir, params, particles, startFrame, numFrames, numWorkers, localWorkers=None, host='127.0.0.1', port=0, backend='Auto', rebalanceInterval=10):
+    '''
+        coordinates a simulation split into slabs along the x axis, each solved by a worker process. Workers can run
+        on this machine or join from other machines with the worker command, and all of them talk over TCP. The
+        coordinator gathers the particles of every frame into the particle cache.
+    
+        cacheDir:    directory the particle cache is written to
+        params:    dictionary containing values for each user specified parameter
+        particles:    dictionary of the id, position and velocity of every particle at the start
+        startFrame:    first frame to solve, the particles are offset into the container when this is frame 1
+        numFrames:    the simulation ends before this frame, like the No. of Frames slider
+        numWorkers:    number of slabs to split the domain into
+        localWorkers:    number of workers started on this machine, the rest have to join from other machines.
+                         Defaults to all of them.
+        host:    interface the coordinator listens on
+        port:    port the coordinator listens on, 0 picks a free port
+        backend:    name of the backend every worker solves with
+        rebalanceInterval:    number of frames between checks that the slabs still hold similar numbers of particles,
+                              0 keeps the slabs where they started
+        return:    number of frames written
+    '''
+    settings = findSolverSettings(params)
+    haloWidth = settings['clusterRadius'] + 2*settings['particleRadius'] # the furthest apart two neighbouring particles can be
+    cuts = findSlabBounds([p[0] for p in particles['position']], numWorkers, haloWidth)
+    numSlabs = len(cuts) + 1
+    if numSlabs < numWorkers:
+        print 'Only %d slabs are at least %.3f wide, so %d workers are used.' % (numSlabs, haloWidth, numSlabs)
+    localWorkers = numSlabs if localWorkers is None else min(localWorkers, numSlabs)
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((host, port))
+    server.listen(numSlabs)
+    address = ('127.0.0.1' if host in ('', '0.0.0.0') else host, server.getsockname()[1])
+    print 'Coordinator listening on %s:%d for %d workers.' % (host, address[1], numSlabs)
+    processes = [multiprocessing.Process(target=runWorker, args=(address,)) for n in range(localWorkers)]
+    for process in processes:
+        process.daemon = True
+        process.start()
+    workers, frames = [], 0
+    try:
+        for n in range(numSlabs):
+            conn = server.accept()[0]
+            workers.append((conn, receiveMessage(conn)['address']))
+        for k, (conn, peerAddress) in enumerate(workers):
+            sendMessage(conn, {'kind': 'setup', 'settings': settings, 'backend': backend, 'haloWidth': haloWidth,
+                               'lowerPeer': workers[k-1][1] if k > 0 else None, 'hasUpper': k < numSlabs-1})
+        clearParticleCache(cacheDir)
+        attributes = {'particleRadius': settings['particleRadius'], 'clusterRadius': settings['clusterRadius'], 'timeStep': settings['timeStep'],
+                      'mass': settings['mass'], 'tankSize': settings['tankSize']}
+        frameData, reset = particles, True # the first step hands every worker all of its particles
+        for frame in range(startFrame, numFrames):
+            if not reset and rebalanceInterval > 0 and (frame - startFrame) % rebalanceInterval == 0:
+                counts = [len(mig['id']) for mig in findSlabParticles(frameData, cuts, numSlabs)]
+                newCuts = findSlabBounds([p[0] for p in frameData['position']], numSlabs, haloWidth)
+                if max(counts) > 1.25*len(frameData['id'])/numSlabs and len(newCuts) == len(cuts):
+                    cuts, reset = newCuts, True # particles have drifted, so the slabs are moved to share them out evenly again
+                    print 'Rebalanced slabs holding %s particles.' % ', '.join([str(n) for n in counts])
+            migrants = findSlabParticles(frameData, cuts, numSlabs) if reset else migrants
+            for k, (conn, peerAddress) in enumerate(workers):
+                step = packParticles(migrants[k])
+                step.update({'kind': 'step', 'offset': SPAWN_OFFSET if frame==1 else None, # the same offset into the container as simulateFluid
+                             'low': cuts[k-1] if k > 0 else None, 'high': cuts[k] if k < len(cuts) else None, 'reset': reset})
+                sendMessage(conn, step)
+            reset = False
+            frameData = {'id': [], 'position': [], 'velocity': [], 'density': [], 'pressure': []}
+            migrants = [{'id': [], 'position': [], 'velocity': []} for k in range(numSlabs)]
+            owners = [] # the slab which solved each particle
+            for k, (conn, peerAddress) in enumerate(workers):
+                result = unpackParticles(receiveMessage(conn), ('id', 'position', 'velocity', 'density', 'pressure'))
+                for name in frameData:
+                    frameData[name] += result[name]
+                owners += [k]*len(result['id'])
+                for pId, pos, vel in zip(result['id'], result['position'], result['velocity']):
+                    slab = findSlab(pos[0], cuts)
+                    if slab != k: # the worker drops particles that left its slab, and the coordinator hands them to their new slab
+                        migrants[slab]['id'].append(pId)
+                        migrants[slab]['position'].append(pos)
+                        migrants[slab]['velocity'].append(vel)
+            if frame == 1:
+                newCuts = findSlabBounds([p[0] for p in frameData['position']], numSlabs, haloWidth)
+                if len(newCuts) == len(cuts):
+                    cuts, reset = newCuts, True # the offset and the walls of the container move the spawn, so the slabs are cut again where it landed
+            frameData['phase'] = [params.get('Type Of Liquid', 0)]*len(frameData['id'])
+            writeParticleCache(cacheDir, frame, frameData, attributes)
+            frames += 1
+            moving = len([k for pos, k in zip(frameData['position'], owners) if findSlab(pos[0], cuts) != k])
+            print 'Frame %d: %d particles, %d moving to another slab' % (frame, len(frameData['id']), moving)
+            frameData = dict([(name, frameData[name]) for name in ['id', 'position', 'velocity']])
+        for conn, peerAddress in workers:
+            sendMessage(conn, {'kind': 'stop'})
+    finally:
+        for conn, peerAddress in workers:
+            conn.close()
+        server.close()
+        for process in processes:
+            process.join(5)
+            if process.is_alive():
+                process.terminate()
+    return frames
+
+def runCommandLine(argv):
+    '''
+        runs the standalone particle cache tools when the script is started outside of maya, e.g 
+        python main.py mesh <cacheDir> <outDir>
+        python main.py export <cacheDir> <outDir> --format VTK
+        python main.py check-backends --particles 500
+        python main.py distribute <cacheDir> --workers 4
+        python main.py plan --particles 2000 --layout uniform-cylinder
+        python main.py ensemble <outDir> --vary Viscosity=1,3.5,10 --vary Stiffness=2,3
+        
+        argv:    list of command line arguments
+    '''
+    parser = argparse.ArgumentParser(description='Coffee Works particle cache tools')
+    commands = parser.add_subparsers(dest='command')
+    meshCmd = commands.add_parser('mesh', help='build a fluid surface mesh for every frame of a particle cache')
+    meshCmd.add_argument('cacheDir')
+    meshCmd.add_argument('outDir')
+    meshCmd.add_argument('--voxel-size', type=float, default=None)
+    meshCmd.add_argument('--support-radius', type=float, default=None)
+    meshCmd.add_argument('--iso-level', type=float, default=None)
+    meshCmd.add_argument('--processes', type=int, default=None)
+    compressCmd = commands.add_parser('compress', help='write a compressed copy of a particle cache')
+    compressCmd.add_argument('cacheDir')
+    compressCmd.add_argument('outDir')
+    compressCmd.add_argument('--precision', type=float, default=CACHE_PRECISION, help='rounding step of positions relative to the width of the tank')
+    compressCmd.add_argument('--keyframe-interval', type=int, default=CACHE_KEYFRAME_INTERVAL)
+    flipbookCmd = commands.add_parser('flipbook', help='render every frame of a particle cache to a .png sequence')
+    flipbookCmd.add_argument('cacheDir')
+    flipbookCmd.add_argument('outDir')
+    flipbookCmd.add_argument('--view', choices=['perspective'] + sorted(FLIPBOOK_VIEWS.keys()), default='perspective')
+    flipbookCmd.add_argument('--colour', choices=['density', 'velocity', 'phase'], default='density')
+    flipbookCmd.add_argument('--width', type=int, default=640)
+    flipbookCmd.add_argument('--height', type=int, default=480)
+    flipbookCmd.add_argument('--range', type=float, nargs=2, default=None, help='lowest and highest value of the coloured field')
+    flipbookCmd.add_argument('--processes', type=int, default=None)
+    exportCmd = commands.add_parser('export', help='export every frame of a particle cache to .ply, .vtk or .csv files')
+    exportCmd.add_argument('cacheDir')
+    exportCmd.add_argument('outDir')
+    exportCmd.add_argument('--format', choices=sorted(EXPORTERS.keys()), default='PLY')
+    distCmd = commands.add_parser('distribute', help='simulate particles split into slabs solved by separate worker processes, writing a particle cache')
+    distCmd.add_argument('cacheDir')
+    distCmd.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
+    distCmd.add_argument('--local-workers', type=int, default=None, help='workers started on this machine, the rest join with the worker command')
+    distCmd.add_argument('--particles', type=int, default=1000)
+    distCmd.add_argument('--frames', type=int, default=100)
+    distCmd.add_argument('--spawn-radius', type=float, default=DEFAULT_PARAMS['Spawn Radius'])
+    distCmd.add_argument('--seed', type=int, default=0)
+    distCmd.add_argument('--start', default=None, help='particle cache file to carry on from instead of spawning a random box')
+    distCmd.add_argument('--backend', choices=['Auto'] + BACKEND_PREFERENCE, default='Auto')
+    distCmd.add_argument('--rebalance-interval', type=int, default=10)
+    distCmd.add_argument('--time-budget', type=float, default=DEFAULT_BUDGET['Time Budget'], help='minutes')
+    distCmd.add_argument('--memory-budget', type=float, default=DEFAULT_BUDGET['Memory Budget'], help='megabytes per worker')
+    distCmd.add_argument('--force', action='store_true', help='run even if the simulation is over budget')
+    distCmd.add_argument('--host', default='127.0.0.1')
+    distCmd.add_argument('--port', type=int, default=0)
+    ensembleCmd = commands.add_parser('ensemble', help='simulate variants of the liquid parameters of one spawn layout together, writing a particle cache for each')
+    ensembleCmd.add_argument('outDir')
+    ensembleCmd.add_argument('--vary', action='append', default=[], metavar='NAME=VALUES',
+                             help='comma separated values of one of %s, e.g Viscosity=1,3.5,10. Every combination is simulated' % ', '.join(ENSEMBLE_PARAMETERS))
+    ensembleCmd.add_argument('--particles', type=int, default=1000)
+    ensembleCmd.add_argument('--frames', type=int, default=100)
+    ensembleCmd.add_argument('--layout', choices=sorted([name for name in SPAWN_LAYOUTS if name != 'emitter']), default='random-box')
+    ensembleCmd.add_argument('--spawn-radius', type=float, default=DEFAULT_PARAMS['Spawn Radius'])
+    ensembleCmd.add_argument('--seed', type=int, default=0)
+    ensembleCmd.add_argument('--writer-mode', choices=OUTPUT_MODES, default='Thread')
+    ensembleCmd.add_argument('--divergence-action', choices=HEALTH_ACTIONS, default='Rollback',
+                             help='solve a step which breaks a health limit again in smaller substeps, or stop straight away')
+    workerCmd = commands.add_parser('worker', help='join a distributed simulation running on another machine')
+    workerCmd.add_argument('coordinator', help='host:port printed by the coordinator')
+    planCmd = commands.add_parser('plan', help='predict how long a simulation will take and how much memory it needs')
+    planCmd.add_argument('--particles', type=int, default=1000)
+    planCmd.add_argument('--frames', type=int, default=100)
+    planCmd.add_argument('--layout', choices=sorted(SPAWN_LAYOUTS.keys()), default='random-box')
+    planCmd.add_argument('--spawn-radius', type=float, default=DEFAULT_PARAMS['Spawn Radius'])
+    planCmd.add_argument('--cluster-radius', type=float, default=DEFAULT_PARAMS['Cluster Radius'])
+    planCmd.add_argument('--target-neighbours', type=int, default=0, help='choose the cluster radius for this many neighbours instead of --cluster-radius')
+    planCmd.add_argument('--adapt-interval', type=int, default=0, help='frames between choosing the cluster radius again')
+    planCmd.add_argument('--max-neighbours', type=int, default=0, help='keep at most this many nearest neighbours of each particle, 0 keeps all')
+    planCmd.add_argument('--particle-radius', type=float, default=DEFAULT_PARAMS['Particle Radius'])
+    planCmd.add_argument('--poisson', action='store_true', help='spawn the random layouts with Poisson disk spacing')
+    planCmd.add_argument('--spawn-spacing', type=float, default=0.0, help='Poisson disk spacing, 0 fits the number of particles')
+    planCmd.add_argument('--backend', choices=['Auto'] + BACKEND_PREFERENCE, default='Auto')
+    planCmd.add_argument('--time-budget', type=float, default=DEFAULT_BUDGET['Time Budget'], help='minutes')
+    planCmd.add_argument('--memory-budget', type=float, default=DEFAULT_BUDGET['Memory Budget'], help='megabytes')
+    calibrateCmd = commands.add_parser('calibrate', help='time the backends on this machine so that plans use its own speed')
+    calibrateCmd.add_argument('--output', default=CALIBRATION_FILE)
+    checkCmd = commands.add_parser('check-backends', help='solve the same particles on every available backend and compare the results')
+    checkCmd.add_argument('--particles', type=int, default=200)
+    checkCmd.add_argument('--steps', type=int, default=3)
+    checkCmd.add_argument('--tolerance', type=float, default=1e-6)
+    checkCmd.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    if args.command == 'mesh':
+        meshParticleCache(args.cacheDir, args.outDir, args.voxel_size, args.support_radius, args.iso_level, args.processes)
+    elif args.command == 'compress':
+        compressParticleCache(args.cacheDir, args.outDir, args.precision, args.keyframe_interval)
+    elif args.command == 'flipbook':
+        renderFlipbook(args.cacheDir, args.outDir, args.view, args.colour, args.width, args.height, args.range, args.processes)
+    elif args.command == 'export':
+        exportParticleCache(args.cacheDir, args.outDir, args.format)
+    elif args.command == 'distribute':
+        startFrame = 1
+        if args.start:
+            data = readParticleCache(args.start)
+            particles, startFrame = {'id': data['id'], 'position': data['position'], 'velocity': data['velocity']}, data['frame'] + 1
+        else:
+            rd.seed(args.seed)
+            positions = [[rd.uniform(-args.spawn_radius, args.spawn_radius) for l in range(3)] for j in range(args.particles)] # the same spawn as the random box generator
+            particles = {'id': list(range(args.particles)), 'position': positions, 'velocity': [list(DEFAULT_PARAMS['Initial Velocity'][0])]*args.particles}
+        params = dict(DEFAULT_PARAMS, **{'Spawn Radius': args.spawn_radius, 'No. of Frames': args.frames - startFrame + 1, 'Backend': args.backend})
+        problems = checkDistributedBudget(params, particles, args.workers, {'Time Budget': args.time_budget, 'Memory Budget': args.memory_budget})
+        if problems and not args.force:
+            print '\n'.join(problems + ['Use --force to run it anyway.'])
+            sys.exit(1)
+        simulateDistributed(args.cacheDir, params, particles, startFrame, args.frames,
+                            args.workers, args.local_workers, args.host, args.port, args.backend, args.rebalance_interval)
+    elif args.command == 'ensemble':
+        params = dict(DEFAULT_PARAMS, **{'No. of Particles': args.particles, 'Spawn Layout': SPAWN_LAYOUTS[args.layout], 'Spawn Radius': args.spawn_radius})
+        try:
+            variants = parseEnsembleVariants(args.vary) or [{}]
+            findEnsembleSettings(params, variants, 0)
+        except ValueError as error:
+            print error
+            sys.exit(1)
+        positions = findSpawnPositions(params, rd.Random(args.seed))
+        try:
+            simulateEnsemble(args.outDir, params, variants, positions, args.frames, args.writer_mode, action=args.divergence_action)
+        except FloatingPointError as error: # the process ends straight away, so a diverging job frees its cores
+            print error
+            sys.exit(1)
+    elif args.command == 'worker':
+        host, port = args.coordinator.rsplit(':', 1)
+        runWorker((host, int(port)))
+    elif args.command == 'plan':
+        params = dict(DEFAULT_PARAMS, **{'No. of Particles': args.particles, 'No. of Frames': args.frames, 'Spawn Layout': SPAWN_LAYOUTS[args.layout],
+                                         'Spawn Radius': args.spawn_radius, 'Cluster Radius': args.cluster_radius,
+                                         'Particle Radius': args.particle_radius, 'Backend': args.backend, 'Pool Size': args.particles,
+                                         'Auto Cluster Radius': args.target_neighbours > 0, 'Target Neighbours': args.target_neighbours,
+                                         'Adapt Interval': args.adapt_interval, 'Poisson Disk': args.poisson, 'Spawn Spacing': args.spawn_spacing,
+                                         'Max Neighbours': args.max_neighbours})
+        plan = planSimulation(params)
+        print formatPlan(plan)
+        problems = checkBudget(plan, {'Time Budget': args.time_budget, 'Memory Budget': args.memory_budget})
+        if problems:
+            print '\n'.join(problems)
+            sys.exit(1)
+    elif args.command == 'calibrate':
+        calibrateBackends(args.output)
+    elif args.command == 'check-backends':
+        rd.seed(args.seed)
+        positions = [[rd.uniform(-0.4, 0.4) for l in range(3)] for j in range(args.particles)]
+        velocities = [list(DEFAULT_PARAMS['Initial Velocity'][0])]*args.particles
+        results = checkBackends(positions, velocities, findSolverSettings(DEFAULT_PARAMS), args.steps)
+        for name, pairList in sorted(results.keys(), key=lambda key: (BACKEND_PREFERENCE.index(key[0]), key[1])):
+            difference, seconds = results[(name, pairList)]
+            print '%-8s %s pairs  difference %.3g, %.4f seconds per frame' % (name, pairList, difference, seconds)
+        if max([difference for difference, seconds in results.values()]) > args.tolerance:
+            print 'The backends do not agree.'
+            sys.exit(1)
+                
+if __name__=='__main__':
+    if cmds is None:
+        runCommandLine(sys.argv[1:]) # outside of maya the tool runs the standalone cache tools from the command line
+    else:
+        createUI()      
\ No newline at end of file
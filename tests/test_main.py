@@ -0,0 +1,108 @@
+'''
+    checks of the standalone parts of the fluid solver which run without maya, using python 2.7:
+
+        python -m unittest discover tests
+'''
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import main
+
+
+def findDefaultParams(**changes):
+    '''
+        changes:    parameters which differ from the default scene
+        return:    the parameters of the default scene of the UI, 1000 particles spawned in a uniform box
+    '''
+    params = dict(main.DEFAULT_PARAMS, **{'No. of Particles': 1000, 'Spawn Layout': main.SPAWN_LAYOUTS['uniform-box'], 'No. of Frames': 20})
+    params.update(changes)
+    return params
+
+
+class AutoClusterRadiusTest(unittest.TestCase):
+
+    @unittest.skipIf(main.np is None, 'solving 1000 particles on the pure python backend takes minutes')
+    def testDefaultSceneStaysFinite(self):
+        params = findDefaultParams(**{'Auto Cluster Radius': True, 'Target Neighbours': 30, 'Backend': 'NumPy'})
+        positions = main.findSpawnPositions(params, main.rd.Random(0))
+        views = list(main.simulateFluid(params, positions)) # raises FloatingPointError if the health monitor gives up
+        stable = main.findStableClusterRadius(positions, params['Initial Velocity']*len(positions), main.findSolverSettings(params), main.SPAWN_OFFSET)
+        self.assertEqual(len(views), params['No. of Frames'] - 1)
+        self.assertTrue(views[0]['clusterRadius'] >= stable)
+
+
+class ParticleCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cacheDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cacheDir)
+
+    def testFrameReadsBackSortedById(self):
+        frameData = {'id': [2, 0, 1], 'position': [(0.5, -0.25, 0.125), (0.0, 1.0, 2.0), (-1.5, 0.75, 0.0)],
+                     'velocity': [(1.0, 0.0, 0.0), (0.0, -2.0, 0.0), (0.0, 0.0, 0.5)], 'density': [1.5, 2.5, 3.5],
+                     'pressure': [0.25, -0.5, 0.0], 'phase': [0, 1, 0]}
+        main.writeParticleCache(self.cacheDir, 7, frameData, {'particleRadius': 0.08})
+        data = main.readParticleCache(main.findCacheFile(self.cacheDir, 7))
+        self.assertEqual((data['frame'], data['count'], data['attributes']), (7, 3, {'particleRadius': 0.08}))
+        self.assertEqual(data['id'], [0, 1, 2])
+        self.assertEqual(data['position'], [(0.0, 1.0, 2.0), (-1.5, 0.75, 0.0), (0.5, -0.25, 0.125)])
+        self.assertEqual(data['density'], [2.5, 3.5, 1.5])
+        self.assertEqual(data['phase'], [1, 0, 0])
+        self.assertEqual(main.listCacheFrames(self.cacheDir), [7])
+
+    def testCompressedPositionsStayWithinPrecision(self):
+        random = main.rd.Random(0)
+        attributes = {'timeStep': 0.01, 'tankSize': 0.6}
+        positions = [[random.uniform(-0.6, 0.6) for l in range(3)] for j in range(50)]
+        velocities = [[random.uniform(-1.0, 1.0) for l in range(3)] for j in range(50)]
+        for frame in range(1, 16): # longer than CACHE_KEYFRAME_INTERVAL, so frames are predicted from the frame before
+            velocities = [[v + random.gauss(0.0, 0.1) for v in vel] for vel in velocities]
+            positions = [[p + 0.01*v for p, v in zip(pos, vel)] for pos, vel in zip(positions, velocities)]
+            main.writeParticleCache(self.cacheDir, frame, {'id': range(50), 'position': positions, 'velocity': velocities}, attributes)
+        outDir = os.path.join(self.cacheDir, 'compressed')
+        rawSize, packedSize = main.compressParticleCache(self.cacheDir, outDir)
+        quantum = main.findCacheQuanta(main.CACHE_PRECISION, attributes)[0]
+        for frame in range(1, 16):
+            raw = main.readParticleCache(main.findCacheFile(self.cacheDir, frame))
+            packed = main.readParticleCache(main.findCacheFile(outDir, frame))
+            error = max([abs(a - b) for p, q in zip(raw['position'], packed['position']) for a, b in zip(p, q)])
+            self.assertTrue(error <= 0.5*quantum + 1e-9, 'frame %d is %g from the cache' % (frame, error))
+        self.assertTrue(packedSize < rawSize)
+
+
+class RunKeyTest(unittest.TestCase):
+
+    def testKeyFollowsTheSimulatedMotion(self):
+        params = findDefaultParams()
+        key = main.findRunKey(params)
+        self.assertEqual(main.findRunKey(dict(params)), key)
+        self.assertEqual(main.findRunKey(findDefaultParams(**{'No. of Frames': 40, 'Backend': 'Python', 'Bake Mode': 'Decimated'})), key)
+        # a longer run on another backend continues the same stored frames
+        self.assertNotEqual(main.findRunKey(findDefaultParams(Viscosity=params['Viscosity']*2)), key)
+        self.assertNotEqual(main.findRunKey(findDefaultParams(**{'No. of Particles': 2000})), key)
+
+
+class NeighbourCapTest(unittest.TestCase):
+
+    @unittest.skipIf(main.np is None, 'compares the NumPy backend against the pure python one')
+    def testBackendsKeepTheSameNeighbours(self):
+        random = main.rd.Random(3)
+        positions = [[random.uniform(0, 1) for l in range(3)] for j in range(300)] + [[0.5 + random.uniform(0, 0.02), 0.5, 0.5] for j in range(300)]
+        nearest, found = main.findNearestNeighbours(0.1, positions, 0.01, 12)
+        neighbours, scale, capped = main.capNeighbours(nearest, found, 12)
+        pairs, pairsFound = main.findNearestPairs(main.np.array(positions), 0.1, 0.01, 12)
+        (I, J, D, mag), pairsScale, pairsCapped = main.capPairs(pairs, pairsFound, 12, len(positions))
+        self.assertEqual(set(zip(I.tolist(), J.tolist())), set([(i, j) for i in range(len(positions)) for j in neighbours[i]]))
+        self.assertTrue(main.np.allclose(pairsScale, scale))
+        self.assertEqual(pairsCapped, capped)
+        self.assertTrue(capped[0] >= 300) # every particle of the clump was capped
+
+
+if __name__ == '__main__':
+    unittest.main()